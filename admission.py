@@ -0,0 +1,207 @@
+"""
+Admission control for the HTTP endpoints.
+
+Routes are put in a budget with ``@limited('quote')`` or ``@limited('read')``
+so that cheap catalog reads keep working while the quote routes (which
+write history) are overloaded, and the other way round. Every budget has:
+
+- a rate limit per client (Flask-Limiter), answered with 429;
+- a concurrency limit: at most that many requests of the budget in flight
+  in this worker (useful with threaded workers), further ones are shed;
+- a latency budget: the predicted latency of a request is the time it
+  already spent queued in front of the worker (from the X-Request-Start
+  header set by the proxy) plus the budget's recent service time. When that
+  is over budget the request is shed before it does any work.
+
+Shed requests get a fast 503 with Retry-After. While a budget is shedding
+on latency, one request per Retry-After interval is still let through so
+the service time estimate recovers once the database does.
+
+    ADMISSION_<BUDGET>_CONCURRENCY     max requests in flight per worker, 0 = no limit
+    ADMISSION_<BUDGET>_LATENCY_BUDGET  seconds, 0 = no latency shedding
+    ADMISSION_<BUDGET>_RATE_LIMIT      e.g. "20 per second; 600 per minute", empty = none
+
+Rate limit counters live in RATELIMIT_STORAGE_URI, else REDIS_URL (see
+get_rate_limit_storage() in config_sample.py). With the memory:// fallback
+they are per worker, so a limit allows that many requests per worker.
+"""
+import math
+import os
+import threading
+import time
+
+from flask import request
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
+
+from metrics import Counter, gauge_lines
+
+try:
+    from config import get_rate_limit_storage
+except ImportError:
+    # config.py copied before the rate limit storage setting
+    def get_rate_limit_storage():
+        return os.environ.get('RATELIMIT_STORAGE_URI') or os.environ.get('REDIS_URL') or 'memory://'
+
+ENABLED = os.environ.get('ADMISSION_ENABLED', '1') == '1'
+RETRY_AFTER = float(os.environ.get('ADMISSION_RETRY_AFTER', 1))
+RATE_LIMIT_KEY_HEADER = os.environ.get('RATE_LIMIT_KEY_HEADER')  # e.g. X-API-Key, default is the client address
+SERVICE_TIME_ALPHA = 0.2
+RATE_LIMIT_STORAGE = get_rate_limit_storage()
+# False for memory://: every worker counts on its own
+RATE_LIMIT_SHARED = not RATE_LIMIT_STORAGE.startswith('memory://')
+
+ADMITTED = Counter('pricing_admission_admitted_total', 'Requests admitted', ('budget',))
+SHED = Counter('pricing_admission_shed_total', 'Requests shed with 503', ('budget', 'reason'))
+RATE_LIMITED = Counter('pricing_admission_rate_limited_total', 'Requests rejected with 429', ('budget',))
+
+
+class Budget(object):
+    def __init__(self, name, max_concurrency=0, latency_budget=0.0, rate_limit='', retry_after=RETRY_AFTER):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.latency_budget = latency_budget
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.service_time = None  # moving average of admitted requests, seconds
+        self.last_admitted = 0.0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, name, max_concurrency, latency_budget, rate_limit=''):
+        prefix = f'ADMISSION_{name.upper()}_'
+        return cls(name,
+                   int(os.environ.get(prefix + 'CONCURRENCY', max_concurrency)),
+                   float(os.environ.get(prefix + 'LATENCY_BUDGET', latency_budget)),
+                   os.environ.get(prefix + 'RATE_LIMIT', rate_limit))
+
+    def predicted_latency(self, queue_time):
+        return queue_time + (self.service_time or 0.0)
+
+    def admit(self, queue_time=0.0):
+        """
+        Take a slot for a request that has waited ``queue_time`` seconds.
+        Returns None when admitted, otherwise the reason it was shed.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self.max_concurrency and self.in_flight >= self.max_concurrency:
+                reason = 'concurrency'
+            elif (self.latency_budget and self.predicted_latency(queue_time) > self.latency_budget
+                  and now - self.last_admitted < self.retry_after):
+                reason = 'latency'
+            else:
+                self.in_flight += 1
+                self.last_admitted = now
+                reason = None
+        if reason is None:
+            ADMITTED.inc(1, self.name)
+        else:
+            SHED.inc(1, self.name, reason)
+        return reason
+
+    def release(self, duration):
+        with self._lock:
+            self.in_flight -= 1
+            if self.service_time is None:
+                self.service_time = duration
+            else:
+                self.service_time += SERVICE_TIME_ALPHA * (duration - self.service_time)
+
+    def retry_after_seconds(self):
+        return max(1, math.ceil(max(self.retry_after, self.service_time or 0.0)))
+
+    def stats(self):
+        return {
+            'in_flight': self.in_flight,
+            'max_concurrency': self.max_concurrency,
+            'latency_budget': self.latency_budget,
+            'service_time': self.service_time,
+            'rate_limit': self.rate_limit,
+        }
+
+
+budgets = {
+    'quote': Budget.from_env('quote', max_concurrency=0, latency_budget=2.0),
+    'read': Budget.from_env('read', max_concurrency=0, latency_budget=1.0),
+}
+
+
+def client_key():
+    if RATE_LIMIT_KEY_HEADER:
+        key = request.headers.get(RATE_LIMIT_KEY_HEADER)
+        if key:
+            return key
+    return get_remote_address()
+
+
+# Limits are checked by admit_request() rather than by Flask-Limiter's own
+# hook, so rejected requests are counted like any other.
+limiter = Limiter(
+    client_key,
+    auto_check=False,
+    headers_enabled=True,
+    storage_uri=RATE_LIMIT_STORAGE,
+    on_breach=lambda limit: RATE_LIMITED.inc(1, budget_of(request.endpoint) or 'none'),
+)
+
+_endpoint_budgets = {}
+
+
+def limited(name):
+    """
+    Route decorator putting a view in budget ``name``. Use it below @bp.route.
+    """
+    budget = budgets[name]
+
+    def decorator(view):
+        _endpoint_budgets[view.__name__] = name
+        return limiter.shared_limit(lambda: budget.rate_limit, scope=name)(view)
+    return decorator
+
+
+def budget_of(endpoint):
+    """
+    Budget name of a Flask endpoint ('blueprint.view'), or None.
+    """
+    if not endpoint:
+        return None
+    return _endpoint_budgets.get(endpoint.rsplit('.', 1)[-1])
+
+
+def queue_time(header, now=None):
+    """
+    Seconds since the proxy received the request, from an X-Request-Start
+    header such as "t=1700000000.123" (seconds, milliseconds and
+    microseconds are all accepted). 0 when missing or unparseable.
+    """
+    if not header:
+        return 0.0
+    try:
+        started = float(header.strip().removeprefix('t='))
+    except ValueError:
+        return 0.0
+    if started > 1e14:
+        started /= 1e6
+    elif started > 1e11:
+        started /= 1e3
+    return max(0.0, (time.time() if now is None else now) - started)
+
+
+def stats():
+    return {
+        'enabled': ENABLED,
+        'rate_limit_shared': RATE_LIMIT_SHARED,
+        'budgets': {name: budget.stats() for name, budget in budgets.items()},
+    }
+
+
+def metric_lines():
+    lines = ADMITTED.render() + SHED.render() + RATE_LIMITED.render()
+    for name, budget in budgets.items():
+        lines += gauge_lines(f'pricing_admission_{name}_in_flight', f'{name.capitalize()} requests in flight',
+                             budget.in_flight)
+        lines += gauge_lines(f'pricing_admission_{name}_service_time_seconds',
+                             f'Moving average service time of {name} requests', budget.service_time or 0.0)
+    return lines
@@ -1,205 +1,179 @@
-from flask import Flask, request, jsonify
+from flask import Blueprint, Flask, Response, g, request, jsonify, send_file
+from flask_limiter import RateLimitExceeded
+from flask.json.provider import DefaultJSONProvider
 from peewee import *
-from playhouse.pool import PooledMySQLDatabase
 import datetime
+import gc
 import json,os
+import time
+import zlib
 from decimal import Decimal
-from enum import Enum
-from config import get_db
-from flask import Flask, request, jsonify
-from peewee import *
-import datetime
-import json
-from decimal import Decimal
-from enum import Enum
 from playhouse.shortcuts import model_to_dict
-
-app = Flask(__name__)
-database=get_db()
-# Base Model Class
-class BaseModel(Model):
-    class Meta:
-        database = database
-
-# Parameter Types Enum
-class ParameterType(Enum):
-    MULTIPLIER = 'multiplier'
-    FIXED = 'fixed'
-    QUANTITY = 'quantity'
-
-# Models
-# Models
-class Service(BaseModel):
-    name = CharField(unique=True)
-    description = TextField(null=True)
-    base_price = DecimalField(decimal_places=2)
-    
-    class Meta:
-        table_name = 'services'
-
-class Parameter(BaseModel):
-    service = ForeignKeyField(Service, backref='parameters')
-    name = CharField()
-    description = TextField(null=True)
-    parameter_type = CharField()
-    is_required = BooleanField(default=False)
-    default_value = CharField(null=True)
-    
-    class Meta:
-        table_name = 'parameters'
-
-class ParameterOption(BaseModel):
-    parameter = ForeignKeyField(Parameter, backref='options')
-    value = CharField()
-    modifier = DecimalField(decimal_places=4)
-    
-    class Meta:
-        table_name = 'parameter_options'
-
-class PriceCalculation(BaseModel):
-    timestamp = DateTimeField(default=datetime.datetime.now)
-    service = ForeignKeyField(Service, backref='calculations')
-    input_params = TextField()
-    calculated_price = DecimalField(decimal_places=2)
-    base_price = DecimalField(decimal_places=2)
-    
-    class Meta:
-        table_name = 'price_calculations'
-# Rest of your application code remains the same...
-# (Keep all the route handlers and calculation functions as they were)
-
-@app.before_request
+from models import database, router, BaseModel, ParameterType, Service, Parameter, ParameterOption, PriceCalculation, init_db
+from catalog import catalog
+from pricing import PricingError
+from price_matrix import matrix_cache, price_matrix, signature
+from pool import pool_stats
+import admission
+import logs
+import metrics
+from admission import limited, limiter
+from logs import quote_log, request_log, trace_enabled
+from metrics import instrument_database, timed
+from migrations import MigrationError, migrate_up
+from retention import parse_month, retention_job
+from rollups import service_stats
+from quote_cache import canonical_params, quote_cache
+from read_cache import accepts_gzip, body_cache, cached_json, cached_response, conditional_response, dumps_text, etag_of
+from bulk_import import ImportFormatError, group_csv_rows, iter_records, summarize, validate_upload, write_catalog
+from history import history_writer, iter_calculations, new_ulid, record_calculation, record_calculations
+
+class TimedJSONProvider(DefaultJSONProvider):
+    # Attributes JSON encoding of responses to the 'serialize' phase
+    def response(self, *args, **kwargs):
+        with timed('serialize'):
+            return super().response(*args, **kwargs)
+
+bp = Blueprint('pricing', __name__, cli_group=None)
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', 1000))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 1000))
+PARAMETERS_CHUNK_SIZE = 500
+EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE', 1000))
+MAX_IMPORT_RECORDS = int(os.environ.get('MAX_IMPORT_RECORDS', 100000))
+MAX_REPORTED_ERRORS = 1000
+IMPORT_CHUNK_SIZE = int(os.environ.get('IMPORT_CHUNK_SIZE', 500))
+
+# Connections are checked out lazily by the first query of a request, so
+# routes served from memory never touch the pool. Teardown runs however the
+# request ended, including unhandled exceptions.
+@bp.before_app_request
 def before_request():
-    database.connect(reuse_if_open = True)
+    metrics.begin_request()
+    g.request_id = request.headers.get(logs.REQUEST_ID_HEADER, '')[:128] or new_ulid()
+    if request.headers.get('X-Consistent-Read') == '1':
+        router.pin_request()
+    return admit_request()
 
-@app.after_request
+def admit_request():
+    """
+    Rate limit and admission control (admission.py) for budgeted routes,
+    before the request does any work. Returns a 503 response when shed.
+    """
+    name = admission.budget_of(request.endpoint)
+    if name is None or not admission.ENABLED:
+        return None
+    limiter.check()
+    budget = admission.budgets[name]
+    reason = budget.admit(admission.queue_time(request.headers.get('X-Request-Start')))
+    if reason is not None:
+        response = jsonify({'error': f'Service overloaded ({reason}), retry later'})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(budget.retry_after_seconds())
+        return response
+    g.admitted = (budget, time.perf_counter())
+    return None
+
+@bp.app_errorhandler(RateLimitExceeded)
+def rate_limit_exceeded(e):
+    return jsonify({'error': f'Rate limit exceeded: {e.description}'}), 429
+
+@bp.after_app_request
 def after_request(response):
-    database.close()
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.count(endpoint, str(response.status_code))
+    timings = metrics.current()
+    total = None
+    if timings is not None:
+        total = metrics.observe(timings, endpoint, request.method, str(response.status_code))
+        response.headers['Server-Timing'] = metrics.server_timing(timings, total)
+    response.headers[logs.REQUEST_ID_HEADER] = g.request_id
+    if logs.REQUEST_LOG:
+        request_log.info('request', extra={
+            'method': request.method, 'path': request.path, 'status': response.status_code,
+            'duration_ms': None if total is None else round(total * 1000, 3)})
     return response
 
-def init_db():
-    MODELS = [Service, Parameter, ParameterOption, PriceCalculation]
-    database.create_tables(MODELS)
-init_db()
-
-# Helper function to calculate service price
-def calculate_parameter_cost(service_id, param_name, param_value):
+@bp.teardown_app_request
+def teardown_request(exc):
+    admitted = g.pop('admitted', None)
+    if admitted is not None:
+        budget, started = admitted
+        budget.release(time.perf_counter() - started)
+    metrics.end_request()
+    router.end_request()
+    if not database.is_closed():
+        database.close()
+
+# Helper functions to calculate service prices. All pricing rules live in
+# the compiled PricingPlan of each catalog service (pricing.py).
+def calculate_service_price(service_id, params):
     """
-    Calculate the cost for an individual parameter based on the service's pricing logic.
-    Returns the cost or modifier for that specific parameter.
+    Calculate service price based on dynamic parameters and service base price.
+    Reads the compiled catalog only, no database queries.
     """
     try:
         # Fetch the service and its base price
-        service = Service.get_by_id(service_id)
-        base_price = Decimal(str(service.base_price))
-        cost = Decimal('0.0')  # Default cost for the parameter
-
-        # Get the parameter associated with the service
-        parameter = Parameter.get(Parameter.service == service, Parameter.name == param_name)
-        
-        if parameter.is_required and param_value is None:
-            raise ValueError(f"Required parameter '{param_name}' is missing")
-
-        if param_value is not None:
-            if parameter.parameter_type == ParameterType.QUANTITY.value:
-                # Handle QUANTITY type directly (affects quantity multiplier)
-                quantity = Decimal(str(param_value))
-                cost = quantity * base_price  # The cost of quantity
-            else:
-                # Handle other types using ParameterOption
-                try:
-                    # Fetch the ParameterOption for this parameter and its value
-                    option = (ParameterOption
-                                  .select()
-                                  .where(
-                                      (ParameterOption.parameter_id == parameter.id) &  
-                                      (ParameterOption.value == str(param_value))
-                                  )
-                                  .get())
-
-                    # Apply the modifier for MULTIPLIER and FIXED types
-                    if parameter.parameter_type == ParameterType.MULTIPLIER.value:
-                        cost = base_price * option.modifier  # Multiplies the base price
-                    elif parameter.parameter_type == ParameterType.FIXED.value:
-                        cost = option.modifier  # Fixed price modifier
-
-                except ParameterOption.DoesNotExist:
-                    raise ValueError(f"Invalid value '{param_value}' for parameter '{param_name}'")
-
-        return cost
-    
+        service = catalog.get(service_id)
     except Exception as e:
-        raise ValueError(f"Error calculating cost for parameter '{param_name}': {str(e)}")
+        raise ValueError(f"Calculation error: {str(e)}")
+    return evaluate_service_price(service, params)
 
-def calculate_service_price(service_id, params):
+def evaluate_service_price(service, params):
     """
-    Calculate service price based on dynamic parameters and service base price.
+    Price ``params`` against an already compiled service.
     """
+    trace = trace_enabled(service.id)
+    started = time.perf_counter() if trace else None
     try:
-        # Fetch the service and its base price
-        service = Service.get_by_id(service_id)
-        base_price = Decimal(str(service.base_price))
-        multiplier = Decimal('1.0')
-        fixed_modifiers = Decimal('0.0')
-        quantity = Decimal('1.0')  # Default quantity if not provided
-        
-        # Get all parameters associated with the service
-        parameters = Parameter.select().where(Parameter.service == service)
-        
-        for parameter in parameters:
-            param_value = params.get(parameter.name, parameter.default_value)
-            
-            # Check if the parameter is required and missing
-            if parameter.is_required and param_value is None:
-                raise ValueError(f"Required parameter '{parameter.name}' is missing")
-            
-            if param_value is not None:
-                if parameter.parameter_type == ParameterType.QUANTITY.value:
-                    # Handle QUANTITY type directly
-                    
-                    quantity = Decimal(str(param_value))
-                 
-                    
-                else:
-                    # Handle other types using ParameterOption
-                    try:
-      
-                        option = (ParameterOption
-                                        .select()
-                                        .where(
-                                            (ParameterOption.parameter_id == parameter.id) &  # Use `parameter_id` if `parameter` is a ForeignKeyField
-                                            (ParameterOption.value == str(param_value))
-                                        )
-                                        .get())
-
-                        
-                        if parameter.parameter_type == ParameterType.MULTIPLIER.value:
-                            multiplier *= option.modifier
-                        elif parameter.parameter_type == ParameterType.FIXED.value:
-                            fixed_modifiers += option.modifier
-                        
-                    except ParameterOption.DoesNotExist:
-                        raise ValueError(f"Invalid value '{param_value}' for parameter '{parameter.name}'")
-        print(f"base {base_price} \n multiply {multiplier} \n fixed {fixed_modifiers}\n quantity {quantity}")
-        # Corrected final price calculation
-        total_price = (base_price * multiplier + fixed_modifiers) * quantity
-        print(total_price)
-        return max(total_price, Decimal('0.0'))  # Ensure price is not negative
-
+        total_price = service.plan.evaluate(params)
     except Exception as e:
         raise ValueError(f"Calculation error: {str(e)}")
+    if trace:
+        quote_log.debug('quote', extra={
+            'service_id': service.id, 'base_price': service.base_price, 'price': total_price,
+            'pricing_ms': round((time.perf_counter() - started) * 1000, 3)})
+    return total_price
+
+def evaluate_service_prices(service, params_list):
+    """
+    Price many parameter sets of an already compiled service at once.
+    Returns a list of (price, error) tuples in input order.
+    """
+    return service.plan.evaluate_many(params_list)
+
+def calculate_price_breakdown(service, params):
+    """
+    Price ``params`` for a compiled service with a per-parameter breakdown.
+    Returns (total price, list of per-parameter costs).
+    """
+    trace = trace_enabled(service.id)
+    started = time.perf_counter() if trace else None
+    recorded = []
+    total_price = service.plan.evaluate(params, recorded)
+    if trace:
+        quote_log.debug('quote breakdown', extra={
+            'service_id': service.id, 'base_price': service.base_price, 'price': total_price,
+            'breakdown': [{'parameter': evaluator.name, 'type': evaluator.kind, 'value': value, 'modifier': modifier}
+                          for evaluator, value, modifier in recorded],
+            'pricing_ms': round((time.perf_counter() - started) * 1000, 3)})
+    return total_price, service.plan.itemize(recorded)
 
 
 # Routes
 
-@app.route('/services', methods=['GET'])
+@bp.route('/services', methods=['GET'])
+@limited('read')
 def get_services():
-    Services=[model_to_dict(item) for item in Service.select()]
-    return jsonify(Services)
-    
+    """
+    All services. The body is cached per catalog version and sent with an
+    ETag, so polling clients mostly get a 304.
+    """
+    entry = cached_json(('services', router.primary_only()), catalog.current_version(),
+                        lambda: [model_to_dict(item) for item in Service.select().bind(router.reader())])
+    return cached_response(entry)
 
 
-@app.route('/services', methods=['POST'])
+@bp.route('/services', methods=['POST'])
 def create_service():
     """
     Create a new service
@@ -215,16 +189,20 @@ def create_service():
             description=data.get('description'),
             base_price=data['base_price']
         )
+        router.wrote()
+        catalog.refresh_service(service.id)
         
         return jsonify({
             'message': 'Service created successfully',
             'service_id': service.id
         }), 201
     
+    except IntegrityError as e:
+        return jsonify({'error': f'Service already exists: {e}'}), 409
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/parameters', methods=['POST'])
+@bp.route('/parameters', methods=['POST'])
 def create_parameter():
     """
     Create a new parameter for a service
@@ -238,62 +216,387 @@ def create_parameter():
         # Fetch the service
         service = Service.get_by_id(data['service_id'])
         
-        # Create the parameter
-        parameter = Parameter.create(
-            service=service,
-            name=data['name'],
-            description=data.get('description'),
-            parameter_type=data['parameter_type'],
-            is_required=data.get('is_required', False),
-            default_value=data.get('default_value')
-        )
-        
-        # Create options for the parameter
-        for option in data.get('options', []):
-            ParameterOption.create(
-                parameter=parameter,
-                value=option['value'],
-                modifier=option['modifier']
+        # Create the parameter and its options together or not at all
+        with database.atomic():
+            parameter = Parameter.create(
+                service=service,
+                name=data['name'],
+                description=data.get('description'),
+                parameter_type=data['parameter_type'],
+                is_required=data.get('is_required', False),
+                default_value=data.get('default_value')
             )
+            
+            # Create options for the parameter
+            options = data.get('options', [])
+            if options:
+                ParameterOption.insert_many([
+                    {'parameter': parameter, 'value': option['value'], 'modifier': option['modifier']}
+                    for option in options
+                ]).execute()
+        router.wrote()
+        catalog.refresh_service(service.id)
         
         return jsonify({'message': 'Parameter created successfully'}), 201
     
+    except IntegrityError as e:
+        # Unique (service_id, name) and (parameter_id, value) indexes
+        return jsonify({'error': f'Duplicate parameter or option: {e}'}), 409
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/parameters', methods=['GET'])
-def get_parameters():
+UPLOAD_FORMATS = {
+    'application/json': 'json',
+    'application/x-ndjson': 'ndjson',
+    'application/jsonl': 'ndjson',
+    'text/csv': 'csv',
+}
+UPLOAD_EXTENSIONS = {'.json': 'json', '.ndjson': 'ndjson', '.jsonl': 'ndjson', '.csv': 'csv'}
+
+def upload_source():
     """
-    Get all parameters
+    Return (binary stream, format) for the request body or a multipart 'file'
+    field. The body is read incrementally, never loaded as a whole.
+    """
+    if request.mimetype == 'multipart/form-data':
+        upload = request.files.get('file')
+        if upload is None:
+            raise ImportFormatError("Multipart uploads need a 'file' field")
+        extension = os.path.splitext(upload.filename or '')[1].lower()
+        fmt = UPLOAD_EXTENSIONS.get(extension) or UPLOAD_FORMATS.get(upload.mimetype)
+        if fmt is None:
+            raise ImportFormatError('Upload must be a .json, .ndjson or .csv file')
+        return upload.stream, fmt
+    fmt = request.args.get('format') or UPLOAD_FORMATS.get(request.mimetype)
+    if fmt is None:
+        raise ImportFormatError('Content-Type must be application/json, application/x-ndjson or text/csv')
+    return request.stream, fmt
+
+def import_catalog(allow_parameters):
+    stream, fmt = upload_source()
+    rows = iter_records(stream, fmt)
+    if fmt == 'csv':
+        rows = group_csv_rows(rows) if allow_parameters else (
+            (number, row) if isinstance(row, Exception) else (number, {
+                'name': row.get('name'),
+                'description': row.get('description') or None,
+                'base_price': row.get('base_price')
+            })
+            for number, row in rows
+        )
+    records, errors = validate_upload(rows, allow_parameters, MAX_IMPORT_RECORDS)
+    if errors:
+        return jsonify({
+            'error': 'Validation failed, nothing was imported',
+            'errors': errors[:MAX_REPORTED_ERRORS],
+            'error_count': len(errors)
+        }), 400
+
+    dry_run = request.args.get('dry_run', '').lower() in ('1', 'true', 'yes')
+    if dry_run:
+        return jsonify(dict(summarize(records), dry_run=True, message='Validation passed'))
+
+    summary = write_catalog(records, IMPORT_CHUNK_SIZE)
+    router.wrote()
+    catalog.load()
+    return jsonify(dict(summary, message='Import completed successfully', catalog_version=catalog.version)), 201
+
+@bp.route('/services/bulk', methods=['POST'])
+def create_services_bulk():
+    """
+    Create many services from a JSON array, NDJSON or CSV (name, description,
+    base_price) upload. Everything is validated first and written in one
+    transaction; ?dry_run=1 only validates.
     """
     try:
-        parameters = []
-        for param in Parameter.select():
-            options = [
-                {
-                    'value': opt.value,
-                    'modifier': float(opt.modifier)
-                } 
-                for opt in param.options
-            ]
-            
-            parameters.append({
+        return import_catalog(allow_parameters=False)
+    except ImportFormatError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@bp.route('/catalog/import', methods=['POST'])
+def import_catalog_upload():
+    """
+    Import services with their parameters and options (see bulk_import for
+    the record and CSV layouts). Same validation and dry-run as /services/bulk.
+    """
+    try:
+        return import_catalog(allow_parameters=True)
+    except ImportFormatError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def iter_parameters(service_id=None, after_id=0, limit=None, db=None):
+    """
+    Yield parameters with their options in id order.
+    Works in keyset chunks of PARAMETERS_CHUNK_SIZE with two queries per chunk,
+    so the full list is never held in memory. Reads from ``db`` (a replica
+    picked by the router) when given.
+    """
+    db = db or database
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = PARAMETERS_CHUNK_SIZE if remaining is None else min(remaining, PARAMETERS_CHUNK_SIZE)
+        query = Parameter.select().where(Parameter.id > after_id).bind(db)
+        if service_id is not None:
+            query = query.where(Parameter.service == service_id)
+        params = list(query.order_by(Parameter.id).limit(size))
+        if not params:
+            return
+
+        options = {}
+        option_rows = (ParameterOption
+                       .select(ParameterOption.parameter, ParameterOption.value, ParameterOption.modifier)
+                       .where(ParameterOption.parameter.in_([param.id for param in params]))
+                       .order_by(ParameterOption.id)
+                       .bind(db))
+        for opt in option_rows:
+            options.setdefault(opt.parameter_id, []).append({
+                'value': opt.value,
+                'modifier': float(opt.modifier)
+            })
+
+        for param in params:
+            yield {
                 'id': param.id,
-                'service_id': param.service.id,
+                'service_id': param.service_id,
                 'name': param.name,
                 'description': param.description,
                 'type': param.parameter_type,
                 'is_required': param.is_required,
                 'default_value': param.default_value,
-                'options': options
-            })
-        
-        return jsonify(parameters)
+                'options': options.get(param.id, [])
+            }
+
+        after_id = params[-1].id
+        if remaining is not None:
+            remaining -= len(params)
+        if len(params) < size:
+            return
+
+def stream_json_list(items, buffer_size=256):
+    """
+    Encode an iterable as a JSON array piece by piece.
+    """
+    yield '['
+    buffer = []
+    first = True
+    for item in items:
+        buffer.append(dumps_text(item) if first else ',' + dumps_text(item))
+        first = False
+        if len(buffer) >= buffer_size:
+            yield ''.join(buffer)
+            buffer = []
+    yield ''.join(buffer) + ']'
+
+@bp.route('/parameters', methods=['GET'])
+@limited('read')
+def get_parameters():
+    """
+    Get all parameters, optionally filtered by service_id.
+    Pass limit (and after_id from the X-Next-After-Id header) to page through
+    them; without limit or service_id the whole list is streamed. Pages and
+    per-service lists are cached per catalog version and support ETags.
+    """
+    try:
+        service_id = request.args.get('service_id', type=int)
+        after_id = request.args.get('after_id', 0, type=int)
+        limit = request.args.get('limit', type=int)
+
+        if limit is not None or service_id is not None:
+            if limit is not None and (limit <= 0 or limit > MAX_PAGE_SIZE):
+                return jsonify({'error': f'Limit must be between 1 and {MAX_PAGE_SIZE}'}), 400
+
+            def next_page(parameters):
+                if limit is not None and len(parameters) == limit:
+                    return {'X-Next-After-Id': str(parameters[-1]['id'])}
+                return None
+
+            # Bodies read from the primary are kept apart from replica ones
+            entry = cached_json(('parameters', service_id, after_id, limit, router.primary_only()),
+                                catalog.current_version(),
+                                lambda: list(iter_parameters(service_id, after_id, limit, router.reader())),
+                                next_page)
+            return cached_response(entry)
+
+        db = router.reader()
+
+        def generate():
+            # teardown has already released the request connection
+            with db.connection_context():
+                yield from stream_json_list(iter_parameters(service_id, after_id, db=db))
+
+        return stream_response(generate())
     
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/calculate-price', methods=['POST'])
+@bp.route('/services/<int:service_id>/price-matrix', methods=['GET'])
+@limited('read')
+def get_price_matrix(service_id):
+    """
+    Prices of every combination of a service's multiplier and fixed options.
+    Pass limit (and offset from the X-Next-Offset header) to page through
+    the cells; without limit they are all streamed. Nothing is written to
+    the calculation history.
+    """
+    try:
+        with timed('catalog'):
+            service, catalog_version = catalog.get_with_version(service_id)
+        with timed('pricing'):
+            matrix = price_matrix(service)
+
+        offset = request.args.get('offset', 0, type=int)
+        limit = request.args.get('limit', type=int)
+        if offset < 0:
+            return jsonify({'error': 'Offset must not be negative'}), 400
+        headers = {'X-Total-Count': str(matrix.size), 'X-Catalog-Version': str(catalog_version)}
+        # The cells only depend on the service's pricing data, not on the catalog version
+        etag = etag_of('price-matrix', signature(service), matrix.rounding, offset, limit)
+        if request.if_none_match.contains_weak(etag):
+            return conditional_response(etag, headers=headers)
+
+        if limit is not None:
+            if limit <= 0 or limit > MAX_PAGE_SIZE:
+                return jsonify({'error': f'Limit must be between 1 and {MAX_PAGE_SIZE}'}), 400
+            with timed('pricing'):
+                cells = list(matrix.cells(offset, limit))
+            response = jsonify(cells)
+            if offset + limit < matrix.size:
+                headers['X-Next-Offset'] = str(offset + limit)
+            response.headers.update(headers)
+        else:
+            response = stream_response(stream_json_list(matrix.cells(offset)), headers=headers)
+        response.set_etag(etag, weak=True)
+        return response
+
+    except Service.DoesNotExist as e:
+        return jsonify({'error': str(e)}), 404
+    except PricingError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def gzip_stream(chunks):
+    """
+    Gzip a stream of text chunks without buffering the whole body.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+def stream_response(chunks, mimetype='application/json', headers=None):
+    """
+    Stream text chunks, gzipped on the fly for clients that accept it.
+    """
+    if accepts_gzip():
+        response = Response(gzip_stream(chunks), mimetype=mimetype, headers=headers)
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(chunks, mimetype=mimetype, headers=headers)
+    response.vary.add('Accept-Encoding')
+    return response
+
+@bp.route('/calculations/export', methods=['GET'])
+def export_calculations():
+    """
+    Stream the calculation history as NDJSON, ordered by service, time and id.
+    Optional filters: service_id, start and end (ISO timestamps, end exclusive).
+    Pass gzip=1 for a compressed download.
+    """
+    try:
+        service_id = request.args.get('service_id', type=int)
+        start = request.args.get('start')
+        end = request.args.get('end')
+        start = datetime.datetime.fromisoformat(start) if start else None
+        end = datetime.datetime.fromisoformat(end) if end else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    db = router.reader()
+
+    def generate():
+        # teardown has already released the request connection
+        with db.connection_context():
+            for row in iter_calculations(service_id, start, end, EXPORT_CHUNK_SIZE, db):
+                yield json.dumps(row) + '\n'
+
+    if request.args.get('gzip') == '1':
+        response = Response(gzip_stream(generate()), mimetype='application/gzip')
+        response.headers['Content-Disposition'] = 'attachment; filename=calculations.ndjson.gz'
+        return response
+    return Response(generate(), mimetype='application/x-ndjson')
+
+@bp.route('/calculations/archive', methods=['GET'])
+def list_archives():
+    """
+    Months of calculation history moved to archive files by the retention job
+    """
+    return jsonify(retention_job.archives())
+
+@bp.route('/calculations/archive/<month>', methods=['GET'])
+def stream_archive(month):
+    """
+    Stream an archived month (YYYY-MM) back as NDJSON, with the same filters
+    as /calculations/export. gzip=1 without filters sends the archive file as is.
+    """
+    try:
+        path = retention_job.archive_path(parse_month(month))
+        service_id = request.args.get('service_id', type=int)
+        start = request.args.get('start')
+        end = request.args.get('end')
+        start = datetime.datetime.fromisoformat(start) if start else None
+        end = datetime.datetime.fromisoformat(end) if end else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not os.path.exists(path):
+        return jsonify({'error': f'No archive for {month}'}), 404
+
+    if request.args.get('gzip') == '1' and service_id is None and start is None and end is None:
+        return send_file(os.path.abspath(path), mimetype='application/gzip', as_attachment=True,
+                         download_name=os.path.basename(path))
+
+    def generate():
+        for row in retention_job.iter_archive(month, service_id, start, end):
+            yield json.dumps(row) + '\n'
+
+    if request.args.get('gzip') == '1':
+        response = Response(gzip_stream(generate()), mimetype='application/gzip')
+        response.headers['Content-Disposition'] = f'attachment; filename=calculations-{month}.ndjson.gz'
+        return response
+    return Response(generate(), mimetype='application/x-ndjson')
+
+@bp.route('/services/<int:service_id>/stats', methods=['GET'])
+@limited('read')
+def get_service_stats(service_id):
+    """
+    Quote volume and price statistics of a service per hour or day bucket.
+    Reads only the rollup table. Optional: period (hour or day, default
+    day), start and end (ISO timestamps, end exclusive).
+    """
+    try:
+        period = request.args.get('period', 'day')
+        start = request.args.get('start')
+        end = request.args.get('end')
+        start = datetime.datetime.fromisoformat(start) if start else None
+        end = datetime.datetime.fromisoformat(end) if end else None
+        with timed('catalog'):
+            catalog.get(service_id)
+        return jsonify(service_stats(service_id, period, start, end))
+    except Service.DoesNotExist as e:
+        return jsonify({'error': str(e)}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@bp.route('/calculate-price', methods=['POST'])
+@limited('quote')
 def calculate_price():
     """
     Calculate the price for a service based on parameters
@@ -312,45 +615,248 @@ def calculate_price():
 
 
         # Fetch the service to get the base price
-        service = Service.get_by_id(service_id)
+        with timed('catalog'):
+            service, catalog_version = catalog.get_with_version(service_id)
         missing_params=[]
-        for _parameter in service.parameters:
-            if _parameter.is_required and str(_parameter.name) not in params:
-                missing_params.append(_parameter.name)
+        for name in service.required:
+            if str(name) not in params:
+                missing_params.append(name)
         if len(missing_params)>0:
             return jsonify({'error': 'some parameters are required','missing_parameters':missing_params}), 500
 
 
         #dictparams=json.loads(params)
         # Calculate price
-        calculated_price = calculate_service_price(service_id, params)
+        with timed('pricing'):
+            calculated_price = quote_cache.get_or_compute(
+                ('price', service.id, canonical_params(service, params), catalog_version),
+                lambda: evaluate_service_price(service, params))
         
 
         # Store calculation in database
-        with database.atomic():
-            calculation = PriceCalculation.create(
-                service=service,
-                input_params=json.dumps({
-                    'service_id': service_id,
-                    'parameters': params
-                }),
-                calculated_price=calculated_price,
-                base_price=service.base_price
+        with timed('history'):
+            calculation = record_calculation(
+                service.id,
+                params,
+                calculated_price,
+                service.base_price
             )
         
         return jsonify({
-            'calculation_id': calculation.id,
+            'calculation_id': calculation['calculation_id'],
+            'calculation_uid': calculation['uid'],
             'service_id': service_id,
             'base_price': float(service.base_price),
             'calculated_price': float(calculated_price),
-            'timestamp': calculation.timestamp.isoformat(),
-            'input_parameters': params
+            'timestamp': calculation['timestamp'].isoformat(),
+            'input_parameters': params,
+            'catalog_version': catalog_version
         })
     
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/calculate-price-details', methods=['POST'])
+@bp.route('/stats', methods=['GET'])
+def get_stats():
+    """
+    Internal counters of the in-process subsystems
+    """
+    return jsonify({
+        'admission': admission.stats(),
+        'catalog': catalog.stats(),
+        'history': history_writer.stats(),
+        'logging': logs.pipeline.stats(),
+        'pool': pool_stats(database),
+        'quote_cache': quote_cache.stats(),
+        'price_matrix_cache': matrix_cache.stats(),
+        'read_cache': body_cache.stats(),
+        'retention': retention_job.stats(),
+        'router': router.stats()
+    })
+
+@metrics.register_collector
+def collect_subsystem_metrics():
+    lines = metrics.gauge_lines('pricing_catalog_version', 'Version of the in-process catalog', catalog.version)
+    for key, value in history_writer.stats().items():
+        if key in ('enabled', 'queue_capacity'):
+            continue
+        kind = 'gauge' if key == 'queue_depth' else 'counter'
+        name = f'pricing_history_{key}' if kind == 'gauge' else f'pricing_history_{key}_total'
+        lines += metrics.gauge_lines(name, f'Write-behind history {key}', value, kind)
+    for prefix, cache in (('quote_cache', quote_cache), ('price_matrix_cache', matrix_cache), ('read_cache', body_cache)):
+        for key, value in cache.stats().items():
+            kind = 'gauge' if key in ('size', 'capacity') else 'counter'
+            name = f'pricing_{prefix}_{key}' if kind == 'gauge' else f'pricing_{prefix}_{key}_total'
+            lines += metrics.gauge_lines(name, f"{prefix.replace('_', ' ').capitalize()} {key}", value, kind)
+    for key in ('archived', 'failures', 'partitions_added', 'partitions_dropped'):
+        lines += metrics.gauge_lines(f'pricing_retention_{key}_total', f'Retention job {key}',
+                                     getattr(retention_job, key), 'counter')
+    for key, value in pool_stats(database).items():
+        kind = 'gauge' if key in ('in_use', 'idle', 'max_connections', 'wait_seconds_max') else 'counter'
+        name = f'pricing_db_pool_{key}' if kind == 'gauge' else f'pricing_db_pool_{key}_total'
+        lines += metrics.gauge_lines(name, f'Connection pool {key}', value, kind)
+    for key in ('replica_reads', 'primary_reads', 'fallbacks'):
+        lines += metrics.gauge_lines(f'pricing_db_router_{key}_total', f'Database router {key.replace("_", " ")}',
+                                     getattr(router, key), 'counter')
+    lines += metrics.gauge_lines('pricing_log_queue_depth', 'Log records waiting for the listener',
+                                 logs.pipeline.stats()['queue_depth'])
+    lines += metrics.gauge_lines('pricing_log_dropped_total', 'Log records dropped on a full queue',
+                                 logs.pipeline.dropped, 'counter')
+    lines += admission.metric_lines()
+    return lines
+
+@bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Prometheus text exposition of request histograms and subsystem counters
+    """
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@bp.route('/calculate-price/batch', methods=['POST'])
+@limited('quote')
+def calculate_price_batch():
+    """
+    Calculate prices for a list of {service_id, parameters} items.
+    Items are grouped by service and priced together; errors are reported
+    per item and all successful calculations are stored with one insert.
+    """
+    try:
+        data = request.get_json()
+        
+        if not data:
+            return jsonify({'error': 'No input data provided'}), 400
+
+        items = data.get('items') if isinstance(data, dict) else data
+        if not isinstance(items, list) or not items:
+            return jsonify({'error': 'Items must be a non-empty list'}), 400
+        if len(items) > MAX_BATCH_SIZE:
+            return jsonify({'error': f'At most {MAX_BATCH_SIZE} items are allowed per batch'}), 400
+
+        # Version of the last catalog snapshot that priced an item
+        catalog_version = None
+        results = [None] * len(items)
+        groups = {}
+        for index, item in enumerate(items):
+            if not isinstance(item, dict) or not item.get('service_id'):
+                results[index] = {'index': index, 'error': 'Service ID is required'}
+                continue
+            service_id = item['service_id']
+            if not isinstance(service_id, (int, str)) or isinstance(service_id, bool):
+                results[index] = {'index': index, 'service_id': service_id,
+                                  'error': 'Service ID must be an integer or a string'}
+                continue
+            groups.setdefault(service_id, []).append(index)
+
+        timestamp = datetime.datetime.now()
+        rows = []
+        for service_id, indexes in groups.items():
+            try:
+                with timed('catalog'):
+                    service, catalog_version = catalog.get_with_version(service_id)
+            except Service.DoesNotExist as e:
+                for index in indexes:
+                    results[index] = {'index': index, 'service_id': service_id, 'error': str(e)}
+                continue
+
+            params_list = [items[index].get('parameters', {}) for index in indexes]
+            with timed('pricing'):
+                priced = evaluate_service_prices(service, params_list)
+            for index, params, (calculated_price, error) in zip(indexes, params_list, priced):
+                if error is not None:
+                    results[index] = {'index': index, 'service_id': service_id, 'error': error}
+                    continue
+                uid = new_ulid()
+                rows.append({
+                    'uid': uid,
+                    'timestamp': timestamp,
+                    'service': service.id,
+                    'parameters': params,
+                    'calculated_price': calculated_price,
+                    'base_price': service.base_price
+                })
+                results[index] = {
+                    'index': index,
+                    'calculation_uid': uid,
+                    'service_id': service_id,
+                    'base_price': float(service.base_price),
+                    'calculated_price': float(calculated_price),
+                    'input_parameters': params
+                }
+
+        # Store all successful calculations in one statement
+        with timed('history'):
+            record_calculations(rows)
+
+        return jsonify({
+            'results': results,
+            'timestamp': timestamp.isoformat(),
+            'catalog_version': catalog_version if catalog_version is not None else catalog.current_version()
+        })
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@bp.route('/calculate-price/what-if', methods=['POST'])
+@limited('quote')
+def calculate_price_what_if():
+    """
+    Price a selection and every alternative that switches one multiplier or
+    fixed parameter to another of its options, in one pass. For
+    configurators showing what each choice would cost; nothing is written
+    to the calculation history.
+    """
+    try:
+        data = request.get_json()
+
+        if not data:
+            return jsonify({'error': 'No input data provided'}), 400
+
+        service_id = data.get('service_id')
+        if not service_id:
+            return jsonify({'error': 'Service ID is required'}), 400
+
+        params = data.get('parameters', {})
+        if not isinstance(params, dict):
+            return jsonify({'error': 'Parameters must be an object'}), 400
+
+        with timed('catalog'):
+            service, catalog_version = catalog.get_with_version(service_id)
+        missing_params = [name for name in service.required if str(name) not in params]
+        if missing_params:
+            return jsonify({'error': 'Some parameters are required', 'missing_parameters': missing_params}), 400
+
+        with timed('pricing'):
+            calculated_price, alternatives = quote_cache.get_or_compute(
+                ('what-if', service.id, canonical_params(service, params), catalog_version),
+                lambda: service.plan.what_if(params))
+
+        return jsonify({
+            'service_id': service_id,
+            'base_price': float(service.base_price),
+            'calculated_price': float(calculated_price),
+            'input_parameters': params,
+            'alternatives': [{
+                'parameter': evaluator.name,
+                'type': evaluator.kind,
+                'value': value,
+                'options': [{
+                    'value': option,
+                    'price': float(price),
+                    'difference': float(price - calculated_price)
+                } for option, price in prices]
+            } for evaluator, value, prices in alternatives],
+            'catalog_version': catalog_version
+        })
+
+    except Service.DoesNotExist as e:
+        return jsonify({'error': str(e)}), 404
+    except PricingError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@bp.route('/calculate-price-details', methods=['POST'])
+@limited('quote')
 def calculate_price_details():
         """
         Calculate the price for a service based on parameters, with detailed response including affected parameters and their cost.
@@ -368,112 +874,97 @@ def calculate_price_details():
         params = data.get('parameters', {})
 
         # Fetch the service to get the base price
-        service = Service.get_by_id(service_id)
+        with timed('catalog'):
+            service, catalog_version = catalog.get_with_version(service_id)
         missing_params = []
-        for _parameter in service.parameters:
-            if _parameter.is_required and str(_parameter.name) not in params:
-                missing_params.append(_parameter.name)
+        for name in service.required:
+            if str(name) not in params:
+                missing_params.append(name)
         if len(missing_params) > 0:
             return jsonify({'error': 'Some parameters are required', 'missing_parameters': missing_params}), 500
 
-        # Calculate detailed price components
-        detailed_calculation = []
-        
-        q_params=[] #quantity params
-        m_params=[] #multipier params
-        f_params=[] #Fixed params
-        for _parameter in service.parameters:
-            param_name = str(_parameter.name)
-            param_value = params.get(param_name)
-            
-            if param_value is not None:  # If the parameter is provided in the request
-                print(_parameter.parameter_type)
-
-                if _parameter.parameter_type == ParameterType.QUANTITY.value:
-                    q_params.append((param_name,param_value))
-                elif  _parameter.parameter_type == ParameterType.MULTIPLIER.value:
-                    optionsdata=ParameterOption.get(ParameterOption.value== param_value,ParameterOption.parameter_id == _parameter.id)
-                    m_params.append((param_name,optionsdata.modifier))
-                    print(param_name,optionsdata.modifier)
-                elif _parameter.parameter_type == ParameterType.FIXED.value:
-                    optionsdata=ParameterOption.get_or_none(ParameterOption.value== param_value,ParameterOption.parameter_id == _parameter.id)
-                    #print("OPTIONS DATA",optionsdata)
-                    if optionsdata is None and  not str(param_value).isnumeric():
-                        return jsonify({"error":f"{param_name} is not VALID it must be predefined in options or Numeric."}),400
-
-                    f_params.append((param_name,optionsdata.modifier if optionsdata else param_value))
-                print(f_params)
-            
-            else:
-                # If the parameter is required but not provided
-                if _parameter.is_required:
-                    missing_params.append(param_name)
-        
-        # If some required parameters were missing
-        if missing_params:
-            return jsonify({'error': 'Some required parameters are missing', 'missing_parameters': missing_params}), 400
-        
-        quantity=Decimal(q_params[0][1] if len(q_params)>0 else 1)
-        total_calculated_price = service.base_price * quantity
-        detailed_calculation.append({
-                    'parameter': q_params[0][0],
-                    'value': q_params[0][1],
-                    'cost': service.base_price * quantity
-                })
-        for p in m_params:
-            # Perform multiplication for each multiplier parameter
-            param_name, param_value = p
-            price=Decimal(service.base_price)*quantity
-            price=Decimal(price)
-            # Assuming there's a function to apply the multiplier to the price
-            print(type(price))
-            print(param_value)
-            price *= Decimal(param_value)
-            detailed_calculation.append({
-                    'parameter': param_name,
-                    'value': param_value,
-                    'cost': price
-                })
-            total_calculated_price+= price
-        for p in f_params:
-            # Perform multiplication for each multiplier parameter
-            param_name, param_value = p
-            
-            price = Decimal(param_value)
-            detailed_calculation.append({
-                    'parameter': param_name,
-                    'value': param_value,
-                    'cost': price
-                })
-            total_calculated_price+= price
+        try:
+            with timed('pricing'):
+                total_calculated_price, detailed_calculation = quote_cache.get_or_compute(
+                    ('details', service.id, canonical_params(service, params), catalog_version),
+                    lambda: calculate_price_breakdown(service, params))
+        except PricingError as e:
+            return jsonify({'error': str(e)}), 400
+
         # Store calculation in database
-        with database.atomic():
-            calculation = PriceCalculation.create(
-                service=service,
-                input_params=json.dumps({
-                    'service_id': service_id,
-                    'parameters': params
-                }),
-                calculated_price=total_calculated_price,
-                base_price=service.base_price
+        with timed('history'):
+            calculation = record_calculation(
+                service.id,
+                params,
+                total_calculated_price,
+                service.base_price
             )
         
         return jsonify({
-            'calculation_id': calculation.id,
+            'calculation_id': calculation['calculation_id'],
+            'calculation_uid': calculation['uid'],
             'service_id': service_id,
             'base_price': float(service.base_price),
             'calculated_price': float(total_calculated_price),
-            'timestamp': calculation.timestamp.isoformat(),
+            'timestamp': calculation['timestamp'].isoformat(),
             'input_parameters': params,
-            'detailed_breakdown': detailed_calculation
+            'detailed_breakdown': detailed_calculation,
+            'catalog_version': catalog_version
         })
     
 #    except Exception as e:
 #        return jsonify({'error': str(e)}), 500
 
 
-# Create tables
-init_db()
+@bp.cli.command('migrate')
+def migrate_command():
+    """
+    Create missing tables and apply pending migrations (migrations.py).
+    """
+    init_db()
+    try:
+        migrate_up()
+    except MigrationError as e:
+        print(f'Migration failed: {e}')
+        raise SystemExit(1)
+    print('Database schema is up to date')
+
+def warm_up():
+    """
+    Load the catalog before workers are forked (gunicorn --preload, see
+    gunicorn.conf.py) so they start with it in copy-on-write memory. Open
+    connections are closed because sockets must not be shared across a fork,
+    and gc.freeze() keeps the collector from touching (and so copying) the
+    preloaded objects in every worker.
+    """
+    try:
+        catalog.load()
+    except Exception as e:
+        logs.log.warning('warm-up: catalog not preloaded, workers will load it lazily: %s', e)
+    finally:
+        if hasattr(database, 'close_all'):
+            database.close_all()
+        elif not database.is_closed():
+            database.close()
+        router.close_all()
+    gc.freeze()
+
+def create_app():
+    """
+    Build the Flask application. Nothing here touches the database: the
+    schema is created by `flask --app app migrate` and the catalog is loaded
+    by the first request that needs it, or by warm_up().
+    """
+    logs.configure()
+    app = Flask(__name__)
+    app.json = TimedJSONProvider(app)
+    app.register_blueprint(bp)
+    limiter.init_app(app)
+    for db in router.databases:
+        instrument_database(db)
+    return app
+
+app = create_app()
 
 if __name__ == '__main__':
     app.run(debug=True)
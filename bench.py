@@ -0,0 +1,464 @@
+"""
+Benchmark for the pricing endpoints.
+
+Seeds a synthetic catalog of SERVICES x PARAMETERS x OPTIONS and measures
+throughput, p50/p95/p99 latency and SQL queries per request for
+/calculate-price, /calculate-price-details, /parameters and /services.
+
+In-process mode (default) drives the Flask test client against a SQLite
+file through DATABASE_URL; --url runs the same scenarios over HTTP against
+a running server (e.g. gunicorn), where query counts are not available.
+
+    python bench.py --services 50 --parameters 10 --options 10 --save bench_baseline.json
+    python bench.py --services 50 --parameters 10 --options 10 --compare bench_baseline.json
+    python bench.py --url http://localhost:8151 --concurrency 8
+
+--startup N also measures worker start-up N times: a cold start (a fresh
+interpreter importing the app and serving its first quote) against a worker
+forked from a master that preloaded the app and its catalog, which is what
+gunicorn does with preload_app (gunicorn.conf.py).
+
+--lookups N times the hot indexed lookups N times each, with and without
+the indexes added by migrations.py: an option by (parameter_id, value), a
+parameter by (service_id, name) and one day of a service's history (seeded
+with --history-rows rows). Use a large --options/--parameters to see the
+difference the composite indexes make.
+
+--compare exits with status 1 when an endpoint's p95 latency grows by more
+than --tolerance or it issues more queries per request than the baseline.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+def percentile(sorted_values, pct):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(pct / 100.0 * len(sorted_values)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def catalog_spec(services, parameters, options):
+    """
+    Describe a synthetic catalog. Every service gets one quantity parameter
+    and ``parameters - 1`` parameters alternating between multiplier and
+    fixed, each with ``options`` options.
+    """
+    spec = []
+    for s in range(services):
+        params = [{
+            'name': 'units',
+            'parameter_type': 'quantity',
+            'is_required': True,
+            'options': []
+        }]
+        for p in range(parameters - 1):
+            parameter_type = 'multiplier' if p % 2 == 0 else 'fixed'
+            params.append({
+                'name': f'param_{p}',
+                'parameter_type': parameter_type,
+                'is_required': p == 0,
+                'default_value': 'opt_0',
+                'options': [
+                    {
+                        'value': f'opt_{o}',
+                        'modifier': 1 + o / 10.0 if parameter_type == 'multiplier' else o * 5
+                    }
+                    for o in range(options)
+                ]
+            })
+        spec.append({
+            'name': f'bench_service_{s}',
+            'description': 'Synthetic benchmark service',
+            'base_price': 10 + s,
+            'parameters': params
+        })
+    return spec
+
+
+def seed_models(spec):
+    """
+    Insert a catalog spec directly through the models. Returns the service ids.
+    """
+    from models import database, Service, Parameter, ParameterOption
+
+    service_ids = []
+    with database.atomic():
+        for service in spec:
+            service_id = Service.insert(
+                name=service['name'],
+                description=service['description'],
+                base_price=service['base_price']).execute()
+            service_ids.append(service_id)
+            for param in service['parameters']:
+                parameter_id = Parameter.insert(
+                    service=service_id,
+                    name=param['name'],
+                    parameter_type=param['parameter_type'],
+                    is_required=param['is_required'],
+                    default_value=param.get('default_value')).execute()
+                if param['options']:
+                    ParameterOption.insert_many([
+                        {'parameter': parameter_id, 'value': o['value'], 'modifier': o['modifier']}
+                        for o in param['options']
+                    ]).execute()
+    return service_ids
+
+
+def seed_http(session, url, spec):
+    """
+    Create a catalog spec through the public API. Returns the service ids.
+    """
+    service_ids = []
+    for service in spec:
+        response = session.post(url + '/services', json={
+            'name': service['name'],
+            'description': service['description'],
+            'base_price': service['base_price']})
+        response.raise_for_status()
+        service_id = response.json()['service_id']
+        service_ids.append(service_id)
+        for param in service['parameters']:
+            response = session.post(url + '/parameters', json=dict(param, service_id=service_id))
+            response.raise_for_status()
+    return service_ids
+
+
+def make_requests(spec, service_ids, count, rng):
+    """
+    Build ``count`` requests per endpoint as (method, path, json body) tuples.
+    """
+    def quote():
+        index = rng.randrange(len(service_ids))
+        params = {}
+        for param in spec[index]['parameters']:
+            if param['parameter_type'] == 'quantity':
+                params[param['name']] = str(rng.randint(1, 5))
+            else:
+                params[param['name']] = rng.choice(param['options'])['value']
+        return {'service_id': service_ids[index], 'parameters': params}
+
+    return {
+        'calculate-price': [('POST', '/calculate-price', quote()) for _ in range(count)],
+        'calculate-price-details': [('POST', '/calculate-price-details', quote()) for _ in range(count)],
+        'parameters': [('GET', f'/parameters?service_id={rng.choice(service_ids)}', None) for _ in range(count)],
+        'services': [('GET', '/services', None) for _ in range(count)],
+    }
+
+
+def measure(call, requests, concurrency=1, count_queries=None):
+    """
+    Run ``requests`` through ``call(method, path, body) -> status`` and
+    summarize latency, throughput, errors and (optionally) SQL queries.
+    """
+    latencies = []
+    errors = 0
+
+    def timed(request):
+        start = time.perf_counter()
+        status = call(*request)
+        return time.perf_counter() - start, status
+
+    queries_before = count_queries() if count_queries else 0
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(concurrency) as executor:
+            outcomes = list(executor.map(timed, requests))
+    else:
+        outcomes = [timed(request) for request in requests]
+    elapsed = time.perf_counter() - started
+
+    for latency, status in outcomes:
+        latencies.append(latency)
+        if status >= 400:
+            errors += 1
+    latencies.sort()
+    result = {
+        'requests': len(requests),
+        'errors': errors,
+        'throughput_rps': round(len(requests) / elapsed, 1) if elapsed else None,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'queries_per_request': None,
+    }
+    if count_queries:
+        result['queries_per_request'] = round((count_queries() - queries_before) / len(requests), 2)
+    return result
+
+
+def run_inprocess(spec, count, seed, warmup):
+    """
+    Seed and benchmark the app in this process through the Flask test client.
+    """
+    from app import app
+    from models import database, init_db
+
+    init_db()
+    service_ids = seed_models(spec)
+
+    queries = [0]
+    execute_sql = database.execute_sql
+
+    def counting(sql, *args, **kwargs):
+        queries[0] += 1
+        return execute_sql(sql, *args, **kwargs)
+    database.execute_sql = counting
+
+    client = app.test_client()
+
+    def call(method, path, body):
+        if method == 'POST':
+            return client.post(path, json=body).status_code
+        response = client.get(path)
+        response.get_data()  # consume streamed bodies
+        return response.status_code
+
+    rng = random.Random(seed)
+    results = {}
+    for endpoint, requests in make_requests(spec, service_ids, count, rng).items():
+        if warmup:
+            measure(call, requests[:warmup])
+        results[endpoint] = measure(call, requests, count_queries=lambda: queries[0])
+    database.execute_sql = execute_sql
+    return results, service_ids
+
+
+STARTUP_SCRIPT = (
+    "import time\n"
+    "started = time.perf_counter()\n"
+    "from app import app\n"
+    "response = app.test_client().get({path!r})\n"
+    "assert response.status_code == 200, response.get_data()\n"
+    "print(time.perf_counter() - started)\n"
+)
+
+
+def measure_startup(service_id, runs):
+    """
+    Median time to the first served request for a cold worker and for a
+    worker forked after warm_up(), in milliseconds.
+    """
+    path = f'/services/{service_id}/price-matrix?limit=1'
+    cold = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT.format(path=path)],
+                                capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        cold.append(float(output.strip().splitlines()[-1]))
+
+    from app import app, warm_up
+    warm_up()
+    preloaded = []
+    for _ in range(runs):
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_end)
+            started = time.perf_counter()
+            status = app.test_client().get(path).status_code
+            os.write(write_end, f'{time.perf_counter() - started if status == 200 else -1}'.encode())
+            os._exit(0)
+        os.close(write_end)
+        output = os.read(read_end, 64)
+        os.close(read_end)
+        os.waitpid(pid, 0)
+        if float(output) < 0:
+            raise RuntimeError('the forked worker could not serve its first request')
+        preloaded.append(float(output))
+
+    cold.sort()
+    preloaded.sort()
+    return {
+        'runs': runs,
+        'cold_start_ms': round(percentile(cold, 50) * 1000, 3),
+        'preloaded_worker_ms': round(percentile(preloaded, 50) * 1000, 3),
+    }
+
+
+def measure_lookups(service_ids, runs, history_rows=50000, seed=1):
+    """
+    Latency of the indexed lookups without and with the indexes of
+    migrations 1-3, on the in-process database.
+    """
+    import datetime
+    from playhouse.migrate import SchemaMigrator
+    from migrations import HISTORY_INDEX, OPTION_INDEX, PARAMETER_INDEX, add_index, drop_index, migrate_up
+    from models import database, Parameter, ParameterOption, PriceCalculation
+
+    rng = random.Random(seed)
+    now = datetime.datetime.now()
+    with database.atomic():
+        for start in range(0, history_rows, 1000):
+            PriceCalculation.insert_many([{
+                'service': rng.choice(service_ids),
+                'timestamp': now - datetime.timedelta(seconds=rng.randrange(30 * 86400)),
+                'input_params': '{}',
+                'calculated_price': 10,
+                'base_price': 10,
+            } for _ in range(min(1000, history_rows - start))]).execute()
+
+    options = list(ParameterOption.select(ParameterOption.parameter, ParameterOption.value).tuples())
+    parameters = list(Parameter.select(Parameter.service, Parameter.name).tuples())
+    samples = [(rng.choice(options), rng.choice(parameters), rng.choice(service_ids),
+                now - datetime.timedelta(days=rng.randrange(1, 30))) for _ in range(runs)]
+
+    def timings(query):
+        latencies = []
+        for sample in samples:
+            started = time.perf_counter()
+            list(query(*sample))
+            latencies.append(time.perf_counter() - started)
+        latencies.sort()
+        return {'p50_us': round(percentile(latencies, 50) * 1e6, 1),
+                'p95_us': round(percentile(latencies, 95) * 1e6, 1)}
+
+    PO, P, PC = ParameterOption, Parameter, PriceCalculation
+    lookups = {
+        'option_by_value': lambda option, parameter, service_id, day: PO.select().where(
+            (PO.parameter == option[0]) & (PO.value == option[1])),
+        'parameter_by_name': lambda option, parameter, service_id, day: P.select().where(
+            (P.service == parameter[0]) & (P.name == parameter[1])),
+        'history_day': lambda option, parameter, service_id, day: PC.select(PC.id, PC.calculated_price).where(
+            (PC.service == service_id) & (PC.timestamp >= day) & (PC.timestamp < day + datetime.timedelta(days=1))),
+    }
+    quiet = lambda line: None
+    migrator = SchemaMigrator.from_database(database)
+    indexes = ((HISTORY_INDEX, False), (PARAMETER_INDEX, True), (OPTION_INDEX, True))
+    migrate_up(log=quiet)
+    for (table, columns), unique in indexes:
+        drop_index(migrator, table, columns, unique, log=quiet)
+    before = {name: timings(query) for name, query in lookups.items()}
+    for (table, columns), unique in indexes:
+        add_index(migrator, table, columns, unique, log=quiet)
+    after = {name: timings(query) for name, query in lookups.items()}
+    return {'history_rows': history_rows, 'options': len(options), 'parameters': len(parameters),
+            'before': before, 'after': after}
+
+
+def run_http(url, spec, count, seed, warmup, concurrency, seed_catalog):
+    """
+    Benchmark a running server over HTTP.
+    """
+    import requests as http
+
+    session = http.Session()
+    if seed_catalog:
+        service_ids = seed_http(session, url, spec)
+    else:
+        service_ids = [s['id'] for s in session.get(url + '/services').json()]
+        if not service_ids:
+            raise SystemExit('The server has no services; run without --no-seed first')
+
+    def call(method, path, body):
+        return session.request(method, url + path, json=body).status_code
+
+    rng = random.Random(seed)
+    results = {}
+    for endpoint, requests in make_requests(spec, service_ids, count, rng).items():
+        if warmup:
+            measure(call, requests[:warmup])
+        results[endpoint] = measure(call, requests, concurrency=concurrency)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Return a list of regressions of ``results`` against ``baseline``.
+    """
+    regressions = []
+    for endpoint, base in baseline['results'].items():
+        current = results.get(endpoint)
+        if current is None:
+            continue
+        if current['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append(
+                f"{endpoint}: p95 {current['p95_ms']}ms > baseline {base['p95_ms']}ms (+{tolerance:.0%})")
+        if (base.get('queries_per_request') is not None and current.get('queries_per_request') is not None
+                and current['queries_per_request'] > base['queries_per_request']):
+            regressions.append(
+                f"{endpoint}: {current['queries_per_request']} queries/request > baseline {base['queries_per_request']}")
+        if current['errors'] > base['errors']:
+            regressions.append(f"{endpoint}: {current['errors']} errors > baseline {base['errors']}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the pricing endpoints')
+    parser.add_argument('--services', type=int, default=20)
+    parser.add_argument('--parameters', type=int, default=6)
+    parser.add_argument('--options', type=int, default=5)
+    parser.add_argument('--requests', type=int, default=500, help='measured requests per endpoint')
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--url', help='benchmark a running server instead of the in-process app')
+    parser.add_argument('--concurrency', type=int, default=1, help='parallel clients in HTTP mode')
+    parser.add_argument('--no-seed', action='store_true', help='use the services already on the server (HTTP mode)')
+    parser.add_argument('--no-quote-cache', action='store_true', help='disable the quote cache (in-process mode)')
+    parser.add_argument('--startup', type=int, default=0, metavar='RUNS',
+                        help='also measure worker start-up RUNS times (in-process mode)')
+    parser.add_argument('--lookups', type=int, default=0, metavar='RUNS',
+                        help='also time indexed lookups with and without the migrations (in-process mode)')
+    parser.add_argument('--history-rows', type=int, default=50000, help='history rows seeded for --lookups')
+    parser.add_argument('--save', help='write the results as a JSON baseline')
+    parser.add_argument('--compare', help='compare against a JSON baseline and fail on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed p95 growth, default 0.25')
+    args = parser.parse_args(argv)
+
+    spec = catalog_spec(args.services, args.parameters, args.options)
+    config = {
+        'mode': 'http' if args.url else 'inprocess',
+        'services': args.services,
+        'parameters': args.parameters,
+        'options': args.options,
+        'requests': args.requests,
+        'concurrency': args.concurrency if args.url else 1,
+    }
+
+    if args.url:
+        results = run_http(args.url.rstrip('/'), spec, args.requests, args.seed,
+                           args.warmup, args.concurrency, not args.no_seed)
+    else:
+        if not os.environ.get('DATABASE_URL'):
+            fd, path = tempfile.mkstemp(suffix='.db', prefix='bench_')
+            os.close(fd)
+            os.environ['DATABASE_URL'] = 'sqlite:///' + path
+        if args.no_quote_cache:
+            os.environ['QUOTE_CACHE_SIZE'] = '0'
+        results, service_ids = run_inprocess(spec, args.requests, args.seed, args.warmup)
+
+    report = {'config': config, 'results': results}
+    if args.startup and not args.url:
+        report['startup'] = measure_startup(service_ids[0], args.startup)
+    if args.lookups and not args.url:
+        report['lookups'] = measure_lookups(service_ids, args.lookups, args.history_rows, args.seed)
+    print(json.dumps(report, indent=2))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('config') != config:
+            print('warning: baseline was recorded with a different configuration', file=sys.stderr)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,418 @@
+"""
+Bulk catalog import.
+
+Uploads are parsed as a stream (JSON array, NDJSON or CSV), every record is
+validated before anything is written, and the whole import is then stored
+with chunked ``insert_many`` calls inside a single ``database.atomic()``.
+Either every row is written or none is.
+
+A catalog record is a service with nested parameters and options:
+
+    {"name": "Car Wash", "base_price": 50, "parameters": [
+        {"name": "Car Size", "parameter_type": "multiplier",
+         "options": [{"value": "Small", "modifier": 1.0}]}]}
+
+Records may use ``service_id`` instead of ``name``/``base_price`` to add
+parameters to an existing service. In CSV uploads each row carries one
+option (see CSV_COLUMNS) and rows are grouped into services and parameters.
+"""
+import codecs
+import csv
+import io
+import json
+from decimal import Decimal, InvalidOperation
+
+from models import database, ParameterType, Service, Parameter, ParameterOption
+
+CHUNK_SIZE = 500
+PARAMETER_TYPES = tuple(t.value for t in ParameterType)
+CSV_COLUMNS = ('service_id', 'service_name', 'service_description', 'base_price',
+               'parameter_name', 'parameter_type', 'parameter_description',
+               'is_required', 'default_value', 'option_value', 'modifier')
+
+
+class ImportFormatError(ValueError):
+    pass
+
+
+def iter_json_array(stream, chunk_size=1 << 16):
+    """
+    Yield the elements of a top-level JSON array read incrementally from a
+    binary stream, without holding the whole document in memory.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buffer, pos, eof = '', 0, False
+    state = 'start'  # start -> first -> (sep -> item)* -> done
+
+    while True:
+        while pos < len(buffer) and buffer[pos] in ' \t\r\n':
+            pos += 1
+        if pos >= len(buffer) and not eof:
+            chunk = stream.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[pos:] + utf8.decode(chunk or b'', final=eof)
+            pos = 0
+            continue
+        if pos >= len(buffer):
+            raise ImportFormatError('Unexpected end of JSON input')
+
+        char = buffer[pos]
+        if state == 'start':
+            if char != '[':
+                raise ImportFormatError('Expected a JSON array')
+            pos += 1
+            state = 'first'
+        elif state == 'sep':
+            if char == ']':
+                return
+            if char != ',':
+                raise ImportFormatError(f"Expected ',' or ']' in JSON input, found {char!r}")
+            pos += 1
+            state = 'item'
+        else:
+            if char == ']' and state == 'first':
+                return
+            try:
+                value, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError as e:
+                if eof:
+                    raise ImportFormatError(f'Invalid JSON input: {e}')
+                value, end = None, None
+            if end is None or (end == len(buffer) and not eof):
+                # Incomplete value (or a number cut at the chunk boundary)
+                chunk = stream.read(chunk_size)
+                eof = not chunk
+                buffer = buffer[pos:] + utf8.decode(chunk or b'', final=eof)
+                pos = 0
+                continue
+            pos = end
+            state = 'sep'
+            yield value
+
+
+def iter_ndjson(stream):
+    """
+    Yield (line number, record) pairs; undecodable lines yield an ImportFormatError.
+    """
+    for number, line in enumerate(io.TextIOWrapper(stream, encoding='utf-8'), 1):
+        if not line.strip():
+            continue
+        try:
+            yield number, json.loads(line)
+        except ValueError as e:
+            yield number, ImportFormatError(f'Invalid JSON: {e}')
+
+
+def iter_csv(stream):
+    """
+    Yield (line number, row dict) pairs from a CSV upload with a header row.
+    """
+    reader = csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8', newline=''))
+    for row in reader:
+        yield reader.line_num, {k.strip(): (v.strip() if isinstance(v, str) else v)
+                                for k, v in row.items() if k}
+
+
+def iter_records(stream, fmt):
+    """
+    Yield (row number, record) pairs from an upload in ``fmt`` ('json',
+    'ndjson' or 'csv'). CSV rows are returned flat.
+    """
+    if fmt == 'json':
+        return enumerate(iter_json_array(stream), 1)
+    if fmt == 'ndjson':
+        return iter_ndjson(stream)
+    if fmt == 'csv':
+        return iter_csv(stream)
+    raise ImportFormatError(f'Unsupported upload format {fmt!r}')
+
+
+def group_csv_rows(rows):
+    """
+    Fold flat CSV option rows into nested service records, keeping the line
+    number of the first row of each service.
+    """
+    services = {}
+    for number, row in rows:
+        if isinstance(row, Exception):
+            yield number, row
+            continue
+        key = ('id', row.get('service_id')) if row.get('service_id') else ('name', row.get('service_name'))
+        entry = services.get(key)
+        if entry is None:
+            record = {'parameters': []}
+            if key[0] == 'id':
+                record['service_id'] = row['service_id']
+            else:
+                record['name'] = row.get('service_name')
+                record['description'] = row.get('service_description') or None
+                record['base_price'] = row.get('base_price')
+            entry = services[key] = (number, record, {})
+        record, parameters = entry[1], entry[2]
+        name = row.get('parameter_name')
+        if not name:
+            continue
+        parameter = parameters.get(name)
+        if parameter is None:
+            parameter = parameters[name] = {
+                'name': name,
+                'parameter_type': row.get('parameter_type'),
+                'description': row.get('parameter_description') or None,
+                'is_required': row.get('is_required') or False,
+                'default_value': row.get('default_value') or None,
+                'options': [],
+            }
+            record['parameters'].append(parameter)
+        if row.get('option_value'):
+            parameter['options'].append({'value': row['option_value'], 'modifier': row.get('modifier')})
+    for number, record, _ in services.values():
+        yield number, record
+
+
+def _decimal(value, field, errors, places):
+    try:
+        number = Decimal(str(value))
+    except (InvalidOperation, ValueError):
+        errors.append(f"'{field}' must be a number")
+        return None
+    if not number.is_finite():
+        errors.append(f"'{field}' must be a number")
+        return None
+    if number.as_tuple().exponent < -places:
+        errors.append(f"'{field}' allows at most {places} decimal places")
+    return number
+
+
+def _bool(value, field, errors):
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in ('1', 'true', 'yes', 'y'):
+        return True
+    if text in ('0', 'false', 'no', 'n', ''):
+        return False
+    errors.append(f"'{field}' must be a boolean")
+    return False
+
+
+def validate_record(record, allow_parameters=True):
+    """
+    Normalize one service record. Returns (clean record, list of errors).
+    """
+    errors = []
+    if not isinstance(record, dict):
+        return None, ['Record must be an object']
+
+    clean = {'parameters': []}
+    if record.get('service_id') not in (None, ''):
+        try:
+            clean['service_id'] = int(record['service_id'])
+        except (TypeError, ValueError):
+            errors.append("'service_id' must be an integer")
+    else:
+        name = record.get('name')
+        if not isinstance(name, str) or not name.strip():
+            errors.append("'name' is required")
+        else:
+            clean['name'] = name.strip()
+        clean['description'] = record.get('description')
+        if record.get('base_price') in (None, ''):
+            errors.append("'base_price' is required")
+        else:
+            clean['base_price'] = _decimal(record['base_price'], 'base_price', errors, 2)
+
+    parameters = record.get('parameters') or []
+    if parameters and not allow_parameters:
+        errors.append("Parameters are not accepted here, use /catalog/import")
+        parameters = []
+    if not isinstance(parameters, list):
+        errors.append("'parameters' must be a list")
+        parameters = []
+
+    seen_parameters = set()
+    for index, parameter in enumerate(parameters):
+        prefix = f'parameters[{index}]'
+        if not isinstance(parameter, dict):
+            errors.append(f'{prefix} must be an object')
+            continue
+        name = parameter.get('name')
+        if not isinstance(name, str) or not name.strip():
+            errors.append(f"{prefix}: 'name' is required")
+            continue
+        name = name.strip()
+        if name in seen_parameters:
+            errors.append(f"{prefix}: duplicate parameter '{name}'")
+        seen_parameters.add(name)
+        parameter_type = parameter.get('parameter_type')
+        if parameter_type not in PARAMETER_TYPES:
+            errors.append(f"{prefix}: 'parameter_type' must be one of {', '.join(PARAMETER_TYPES)}")
+        default_value = parameter.get('default_value')
+        clean_parameter = {
+            'name': name,
+            'description': parameter.get('description'),
+            'parameter_type': parameter_type,
+            'is_required': _bool(parameter.get('is_required', False), f'{prefix}.is_required', errors),
+            'default_value': None if default_value is None else str(default_value),
+            'options': [],
+        }
+        options = parameter.get('options') or []
+        if not isinstance(options, list):
+            errors.append(f"{prefix}: 'options' must be a list")
+            options = []
+        seen_values = set()
+        for option_index, option in enumerate(options):
+            option_prefix = f'{prefix}.options[{option_index}]'
+            if not isinstance(option, dict) or option.get('value') in (None, ''):
+                errors.append(f"{option_prefix}: 'value' is required")
+                continue
+            value = str(option['value'])
+            if value in seen_values:
+                errors.append(f"{option_prefix}: duplicate option value '{value}'")
+            seen_values.add(value)
+            if option.get('modifier') in (None, ''):
+                errors.append(f"{option_prefix}: 'modifier' is required")
+                continue
+            modifier = _decimal(option['modifier'], f'{option_prefix}.modifier', errors, 4)
+            clean_parameter['options'].append({'value': value, 'modifier': modifier})
+        clean['parameters'].append(clean_parameter)
+    return clean, errors
+
+
+def _chunks(items, size=CHUNK_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def validate_upload(rows, allow_parameters=True, max_rows=None):
+    """
+    Validate every record of an upload, including checks against the
+    database (existing service names, unknown service ids, parameter names
+    already defined). Returns (clean records, list of row errors).
+    """
+    records = []
+    errors = []
+    names = {}
+    service_parameters = {}
+    for number, record in rows:
+        if max_rows is not None and len(records) >= max_rows:
+            errors.append({'row': number, 'errors': [f'At most {max_rows} records are allowed']})
+            break
+        if isinstance(record, Exception):
+            errors.append({'row': number, 'errors': [str(record)]})
+            continue
+        clean, record_errors = validate_record(record, allow_parameters)
+        if clean is not None and 'name' in clean:
+            if clean['name'] in names:
+                record_errors.append(f"Duplicate service name '{clean['name']}' (row {names[clean['name']]})")
+            else:
+                names[clean['name']] = number
+        if clean is not None and 'service_id' in clean:
+            # Records adding parameters to the same service must not repeat a name
+            for parameter in clean['parameters']:
+                key = (clean['service_id'], parameter['name'])
+                if key in service_parameters and service_parameters[key] != number:
+                    record_errors.append(f"Duplicate parameter '{parameter['name']}' for service "
+                                         f"{clean['service_id']} (row {service_parameters[key]})")
+                else:
+                    service_parameters[key] = number
+        if record_errors:
+            errors.append({'row': number, 'errors': record_errors})
+        records.append((number, clean))
+
+    new_names = [clean['name'] for _, clean in records if clean and 'name' in clean]
+    existing_names = set()
+    for chunk in _chunks(new_names):
+        existing_names.update(name for (name,) in Service.select(Service.name).where(Service.name.in_(chunk)).tuples())
+
+    service_ids = list({clean['service_id'] for _, clean in records if clean and 'service_id' in clean})
+    known_ids = set()
+    existing_parameters = set()
+    for chunk in _chunks(service_ids):
+        known_ids.update(i for (i,) in Service.select(Service.id).where(Service.id.in_(chunk)).tuples())
+        existing_parameters.update(
+            Parameter.select(Parameter.service, Parameter.name).where(Parameter.service.in_(chunk)).tuples())
+
+    for number, clean in records:
+        if clean is None:
+            continue
+        record_errors = []
+        if clean.get('name') in existing_names:
+            record_errors.append(f"Service '{clean['name']}' already exists")
+        if 'service_id' in clean:
+            if clean['service_id'] not in known_ids:
+                record_errors.append(f"Service {clean['service_id']} does not exist")
+            for parameter in clean['parameters']:
+                if (clean['service_id'], parameter['name']) in existing_parameters:
+                    record_errors.append(f"Parameter '{parameter['name']}' already exists for service {clean['service_id']}")
+        if record_errors:
+            errors.append({'row': number, 'errors': record_errors})
+
+    merged = {}
+    for error in errors:
+        merged.setdefault(error['row'], []).extend(error['errors'])
+    errors = [{'row': row, 'errors': messages} for row, messages in sorted(merged.items())]
+    return [clean for _, clean in records if clean is not None], errors
+
+
+def summarize(records):
+    parameters = sum(len(r['parameters']) for r in records)
+    options = sum(len(p['options']) for r in records for p in r['parameters'])
+    return {
+        'services': sum(1 for r in records if 'name' in r),
+        'parameters': parameters,
+        'options': options,
+    }
+
+
+def write_catalog(records, chunk_size=CHUNK_SIZE):
+    """
+    Insert validated records with chunked insert_many in one transaction.
+    """
+    with database.atomic():
+        new_services = [r for r in records if 'name' in r]
+        for chunk in _chunks(new_services, chunk_size):
+            Service.insert_many([
+                {'name': r['name'], 'description': r['description'], 'base_price': r['base_price']}
+                for r in chunk
+            ]).execute()
+        # insert_many does not report every generated id, so read them back by unique name
+        for chunk in _chunks(new_services, chunk_size):
+            ids = dict(Service.select(Service.name, Service.id)
+                       .where(Service.name.in_([r['name'] for r in chunk])).tuples())
+            for record in chunk:
+                record['service_id'] = ids[record['name']]
+
+        parameter_rows = [
+            (record['service_id'], parameter)
+            for record in records for parameter in record['parameters']
+        ]
+        for chunk in _chunks(parameter_rows, chunk_size):
+            Parameter.insert_many([
+                {
+                    'service': service_id,
+                    'name': p['name'],
+                    'description': p['description'],
+                    'parameter_type': p['parameter_type'],
+                    'is_required': p['is_required'],
+                    'default_value': p['default_value'],
+                }
+                for service_id, p in chunk
+            ]).execute()
+
+        service_ids = list({service_id for service_id, _ in parameter_rows})
+        parameter_ids = {}
+        for chunk in _chunks(service_ids, chunk_size):
+            for service_id, name, parameter_id in (Parameter
+                                                   .select(Parameter.service, Parameter.name, Parameter.id)
+                                                   .where(Parameter.service.in_(chunk))
+                                                   .tuples()):
+                parameter_ids[(service_id, name)] = parameter_id
+
+        option_rows = [
+            {'parameter': parameter_ids[(service_id, p['name'])], 'value': o['value'], 'modifier': o['modifier']}
+            for service_id, p in parameter_rows for o in p['options']
+        ]
+        for chunk in _chunks(option_rows, chunk_size):
+            ParameterOption.insert_many(chunk).execute()
+    return summarize(records)
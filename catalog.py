@@ -0,0 +1,259 @@
+"""
+In-process compiled pricing catalog.
+
+Services, parameters and options change a few times a day but are read on
+every quote, so they are compiled once into plain Python objects: each
+service maps to its parameters and each parameter holds a dict from option
+value to modifier. Pricing then needs no database reads at all.
+
+Every rebuild or patch that changes something bumps ``Catalog.version`` so
+responses (and anything cached against the catalog) can tell which snapshot
+they were computed from. Periodic reloads that find the same content keep
+the version, so those caches stay valid.
+"""
+import hashlib
+import os
+import threading
+import time
+from decimal import Decimal
+
+from models import Service, Parameter, ParameterOption, router
+from pricing import compile_plan
+
+MISSING_CACHE_SIZE = 10000  # unknown service ids remembered between loads
+
+
+class CompiledParameter(object):
+    def __init__(self, id, name, parameter_type, is_required, default_value, options):
+        self.id = id
+        self.name = name
+        self.parameter_type = parameter_type
+        self.is_required = is_required
+        self.default_value = default_value
+        self.options = options  # option value -> Decimal modifier
+
+
+class CompiledService(object):
+    def __init__(self, id, name, base_price, parameters):
+        self.id = id
+        self.name = name
+        self.base_price = base_price
+        self.parameters = parameters  # tuple of CompiledParameter, in id order
+        self.required = tuple(p.name for p in parameters if p.is_required)
+        self.plan = compile_plan(self)
+
+
+def _compile(services, parameters, options):
+    """
+    Build CompiledService objects from already fetched rows.
+    When an option value is duplicated the lowest id wins.
+    """
+    options_by_param = {}
+    for opt in options:
+        options_by_param.setdefault(opt.parameter_id, {}).setdefault(
+            opt.value, Decimal(str(opt.modifier)))
+
+    params_by_service = {}
+    for param in parameters:
+        params_by_service.setdefault(param.service_id, []).append(CompiledParameter(
+            param.id,
+            param.name,
+            param.parameter_type,
+            param.is_required,
+            param.default_value,
+            options_by_param.get(param.id, {}),
+        ))
+
+    return {
+        service.id: CompiledService(
+            service.id,
+            service.name,
+            Decimal(str(service.base_price)),
+            tuple(params_by_service.get(service.id, ())),
+        )
+        for service in services
+    }
+
+
+def catalog_digest(services):
+    """
+    Digest of everything compiled into {id: CompiledService}, to tell
+    whether a reload found anything new.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for service_id in sorted(services):
+        service = services[service_id]
+        digest.update(repr((service.id, service.name, str(service.base_price), [
+            (p.id, p.name, p.parameter_type, p.is_required, p.default_value,
+             [(value, str(modifier)) for value, modifier in p.options.items()])
+            for p in service.parameters
+        ])).encode('utf-8'))
+    return digest.digest()
+
+
+def _fetch(service_ids=None):
+    """
+    Load services with their parameters and options in three queries.
+    Full loads may read from a replica; single services are refreshed after
+    a write or for a service another worker just created, so they are read
+    from the primary.
+    """
+    db = router.reader() if service_ids is None else router.primary
+    services = Service.select().bind(db)
+    parameters = Parameter.select().order_by(Parameter.id).bind(db)
+    options = ParameterOption.select().order_by(ParameterOption.id).bind(db)
+    if service_ids is not None:
+        services = services.where(Service.id.in_(service_ids))
+        parameters = parameters.where(Parameter.service.in_(service_ids))
+        options = (options
+                   .join(Parameter)
+                   .where(Parameter.service.in_(service_ids)))
+    return _compile(list(services), list(parameters), list(options))
+
+
+class Catalog(object):
+    """
+    Thread-safe holder of the compiled catalog.
+
+    Readers only ever see a complete dict; writers build a new one and swap
+    it in under a lock. ``max_age`` (seconds, 0 disables) forces a periodic
+    full reload so workers that did not handle a write eventually catch up.
+    Ids found missing on the primary are remembered until then, so unknown
+    ids do not cost a query each.
+    """
+
+    def __init__(self, max_age=None):
+        if max_age is None:
+            max_age = float(os.environ.get('CATALOG_MAX_AGE', 60))
+        self.max_age = max_age
+        self.version = 0
+        self._services = None
+        self._digest = None  # of _services as last loaded, None after a patch
+        self._missing = set()
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def load(self):
+        """
+        Rebuild the whole catalog from the database. The version only moves
+        when the content differs from what is loaded.
+        """
+        while True:
+            seen = self.version
+            services = _fetch()
+            digest = catalog_digest(services)
+            with self._lock:
+                if self.version != seen:
+                    # Patched while fetching; fetch again rather than lose the patch
+                    continue
+                if self._services is None or digest != self._digest:
+                    self._services = services
+                    self.version += 1
+                self._digest = digest
+                self._missing = set()
+                self._loaded_at = time.monotonic()
+                return self.version
+
+    def refresh_service(self, service_id):
+        """
+        Patch a single service after a write, without a full rebuild.
+        """
+        service_id = int(service_id)
+        if self._services is None:
+            # Nothing loaded yet, the next read does a full load anyway.
+            return self.version
+        compiled = _fetch([service_id])
+        with self._lock:
+            self._missing.discard(service_id)
+            services = dict(self._services or {})
+            if service_id not in compiled and service_id not in services:
+                return self.version
+            if service_id in compiled:
+                services[service_id] = compiled[service_id]
+            else:
+                services.pop(service_id, None)
+            self._services = services
+            self._digest = None
+            self.version += 1
+        return self.version
+
+    def clear(self):
+        """
+        Drop everything; the next read triggers a full load.
+        """
+        with self._lock:
+            self._services = None
+            self.version += 1
+
+    def _current(self):
+        services = self._services
+        if services is None or (
+                self.max_age and time.monotonic() - self._loaded_at > self.max_age):
+            self.load()
+            services = self._services
+        return services
+
+    def get(self, service_id):
+        """
+        Return the CompiledService for ``service_id``.
+        Raises Service.DoesNotExist for unknown services.
+        """
+        try:
+            service_id = int(service_id)
+        except (TypeError, ValueError):
+            raise Service.DoesNotExist(f"Service {service_id!r} does not exist")
+
+        service = self._current().get(service_id)
+        if service is None:
+            if service_id in self._missing:
+                raise Service.DoesNotExist(f"Service {service_id} does not exist")
+            # The service may have been created by another worker.
+            self.refresh_service(service_id)
+            service = self._services.get(service_id)
+            if service is None:
+                with self._lock:
+                    if len(self._missing) >= MISSING_CACHE_SIZE:
+                        self._missing = set()
+                    self._missing.add(service_id)
+                raise Service.DoesNotExist(f"Service {service_id} does not exist")
+        return service
+
+    def get_with_version(self, service_id):
+        """
+        Return ``(CompiledService, version)`` read from the same snapshot.
+        """
+        while True:
+            version = self.version
+            service = self.get(service_id)
+            if self.version == version:
+                return service, version
+
+    def services(self):
+        return list(self._current().values())
+
+    def current_version(self):
+        """
+        Version of the catalog reads see now, reloading it first if expired.
+        """
+        self._current()
+        return self.version
+
+    def stats(self):
+        services = self._services
+        return {
+            'mode': 'process',
+            'version': self.version,
+            'services': len(services) if services is not None else 0,
+        }
+
+
+def _make_catalog():
+    # CATALOG_SNAPSHOT_PATH shares one mmapped catalog between all workers
+    path = os.environ.get('CATALOG_SNAPSHOT_PATH')
+    if path:
+        from catalog_snapshot import SnapshotCatalog
+        return SnapshotCatalog(path)
+    return Catalog()
+
+
+catalog = _make_catalog()
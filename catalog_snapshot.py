@@ -0,0 +1,401 @@
+"""
+Catalog snapshot shared by all workers of a host.
+
+Instead of every gunicorn worker querying and holding the whole catalog,
+one process serializes it into a compact, array-backed file that all
+workers mmap (put CATALOG_SNAPSHOT_PATH on tmpfs such as /dev/shm and the
+pages are shared memory). Enable it by setting CATALOG_SNAPSHOT_PATH.
+
+Files, for CATALOG_SNAPSHOT_PATH=/dev/shm/pricing-catalog:
+
+    pricing-catalog.gen     8 byte generation counter, mmapped by everyone
+    pricing-catalog.<gen>   snapshot data of that generation
+    pricing-catalog.lock    serializes writers
+
+A writer (a full load, or any catalog write through the API) builds the next
+generation's file, renames it into place and only then bumps the counter.
+When the data is the same as the current generation's, as for most
+expiry reloads, the writer only refreshes that file's published_at and
+the generation stays, so caches keyed on it stay valid.
+Readers compare the counter with the generation they have mapped on every
+lookup, which costs one 8 byte read, and remap when it moved. Services are
+decoded from the mapped arrays only when they are priced and kept in a
+bounded cache, so a worker's memory does not grow with the catalog.
+
+Data layout (little endian, int64 columns):
+
+    header    magic, format, generation, published_at, counts
+    services  id, name, base_price coefficient, base_price exponent, first parameter, parameter count
+    params    id, name, parameter_type, is_required, default_value, first option, option count
+    options   value, modifier coefficient, modifier exponent
+    strings   offsets (count + 1), then one UTF-8 blob
+
+Strings are indexes into the string table (-1 for None) and decimals are
+stored as (coefficient, exponent) so they decode to exactly the Decimal the
+database returned.
+"""
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from decimal import Decimal
+
+from catalog import Catalog, CompiledParameter, CompiledService, _fetch
+from models import Service, router
+
+MAGIC = b'PCAT'
+FORMAT = 1
+HEADER = struct.Struct('<4sIQdQQQQQ')  # magic, format, generation, published_at, services, params, options, strings, blob bytes
+PUBLISHED_AT = struct.Struct('<d')
+PUBLISHED_AT_OFFSET = struct.calcsize('<4sIQ')
+CONTROL = struct.Struct('<Q')
+SERVICE_COLUMNS = 6
+PARAM_COLUMNS = 7
+OPTION_COLUMNS = 3
+
+
+def _split_decimal(value):
+    sign, digits, exponent = value.as_tuple()
+    coefficient = int(''.join(map(str, digits)) or 0)
+    return -coefficient if sign else coefficient, exponent
+
+
+def _join_decimal(coefficient, exponent):
+    return Decimal(coefficient).scaleb(exponent)
+
+
+def encode(services, generation, published_at=None):
+    """
+    Serialize {id: CompiledService} into the snapshot format.
+    """
+    strings = {}
+    string_list = []
+
+    def intern(text):
+        if text is None:
+            return -1
+        index = strings.get(text)
+        if index is None:
+            index = strings[text] = len(string_list)
+            string_list.append(text)
+        return index
+
+    service_rows = array('q')
+    param_rows = array('q')
+    option_rows = array('q')
+    param_count = 0
+    option_count = 0
+    for service_id in sorted(services):
+        service = services[service_id]
+        coefficient, exponent = _split_decimal(service.base_price)
+        service_rows.extend((service.id, intern(service.name), coefficient, exponent,
+                             param_count, len(service.parameters)))
+        for parameter in service.parameters:
+            param_rows.extend((parameter.id, intern(parameter.name), intern(parameter.parameter_type),
+                               1 if parameter.is_required else 0, intern(parameter.default_value),
+                               option_count, len(parameter.options)))
+            param_count += 1
+            for value, modifier in parameter.options.items():
+                coefficient, exponent = _split_decimal(modifier)
+                option_rows.extend((intern(value), coefficient, exponent))
+                option_count += 1
+
+    encoded = [s.encode('utf-8') for s in string_list]
+    offsets = array('q', [0])
+    for item in encoded:
+        offsets.append(offsets[-1] + len(item))
+    blob = b''.join(encoded)
+
+    header = HEADER.pack(MAGIC, FORMAT, generation, published_at or time.time(), len(services),
+                         param_count, option_count, len(string_list), len(blob))
+    return b''.join([header, service_rows.tobytes(), param_rows.tobytes(), option_rows.tobytes(),
+                     offsets.tobytes(), blob])
+
+
+class SnapshotFile(object):
+    """
+    Read-only view of one mmapped snapshot generation. Nothing is copied:
+    the columns are memoryviews over the mapping.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, fmt, self.generation, _, services, params, options,
+         strings, blob) = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or fmt != FORMAT:
+            raise ValueError(f'{path} is not a catalog snapshot')
+        self.size = len(self._mmap)
+        view = memoryview(self._mmap)
+        offset = HEADER.size
+
+        def column(count):
+            nonlocal offset
+            part = view[offset:offset + count * 8].cast('q')
+            offset += count * 8
+            return part
+
+        self.services = column(services * SERVICE_COLUMNS)
+        self.params = column(params * PARAM_COLUMNS)
+        self.options = column(options * OPTION_COLUMNS)
+        self.offsets = column(strings + 1)
+        self.blob = view[offset:offset + blob]
+        self.service_count = services
+
+    @property
+    def published_at(self):
+        # Rewritten in place by writers that found nothing new
+        return PUBLISHED_AT.unpack_from(self._mmap, PUBLISHED_AT_OFFSET)[0]
+
+    def string(self, index):
+        if index < 0:
+            return None
+        return bytes(self.blob[self.offsets[index]:self.offsets[index + 1]]).decode('utf-8')
+
+    def find(self, service_id):
+        """
+        Row of ``service_id`` (binary search over the sorted ids), or None.
+        """
+        low, high = 0, self.service_count
+        services = self.services
+        while low < high:
+            middle = (low + high) // 2
+            current = services[middle * SERVICE_COLUMNS]
+            if current < service_id:
+                low = middle + 1
+            elif current > service_id:
+                high = middle
+            else:
+                return middle
+        return None
+
+    def service(self, row):
+        """
+        Decode the CompiledService stored at ``row``.
+        """
+        s = self.services
+        base = row * SERVICE_COLUMNS
+        service_id, name, coefficient, exponent, first, count = s[base:base + SERVICE_COLUMNS]
+        parameters = []
+        p, o = self.params, self.options
+        for index in range(first, first + count):
+            base = index * PARAM_COLUMNS
+            param_id, param_name, param_type, is_required, default, first_option, options = \
+                p[base:base + PARAM_COLUMNS]
+            option_values = {}
+            for option in range(first_option, first_option + options):
+                value, option_coefficient, option_exponent = o[option * OPTION_COLUMNS:(option + 1) * OPTION_COLUMNS]
+                option_values[self.string(value)] = _join_decimal(option_coefficient, option_exponent)
+            parameters.append(CompiledParameter(
+                param_id, self.string(param_name), self.string(param_type), bool(is_required),
+                self.string(default), option_values))
+        return CompiledService(service_id, self.string(name), _join_decimal(coefficient, exponent),
+                               tuple(parameters))
+
+    def service_ids(self):
+        return [self.services[row * SERVICE_COLUMNS] for row in range(self.service_count)]
+
+
+class SnapshotCatalog(Catalog):
+    """
+    Catalog backed by the shared snapshot. ``version`` is the snapshot
+    generation, so it is the same in every worker.
+    """
+
+    def __init__(self, path, max_age=None, cache_size=None):
+        if max_age is None:
+            max_age = float(os.environ.get('CATALOG_MAX_AGE', 60))
+        if cache_size is None:
+            cache_size = int(os.environ.get('CATALOG_SNAPSHOT_CACHE', 1024))
+        self.path = path
+        self.max_age = max_age
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        self._control = None
+        self._snapshot = None
+        self._compiled = OrderedDict()
+        self._stale = False
+        self.remaps = 0
+
+    @property
+    def version(self):
+        snapshot = self._sync()
+        return snapshot.generation if snapshot is not None else 0
+
+    def _generation(self):
+        if self._control is None:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            fd = os.open(self.path + '.gen', os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if os.fstat(fd).st_size < CONTROL.size:
+                    os.ftruncate(fd, CONTROL.size)
+                self._control = mmap.mmap(fd, CONTROL.size)
+            finally:
+                os.close(fd)
+        return CONTROL.unpack_from(self._control, 0)[0]
+
+    def _sync(self):
+        """
+        Map the current generation if it changed. Returns the SnapshotFile or
+        None when nothing has been published yet.
+        """
+        generation = self._generation()
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.generation == generation:
+            return snapshot
+        if generation == 0:
+            return None
+        with self._lock:
+            for _ in range(5):
+                snapshot = self._snapshot
+                if snapshot is not None and snapshot.generation == generation:
+                    return snapshot
+                try:
+                    mapped = SnapshotFile(f'{self.path}.{generation}')
+                except FileNotFoundError:
+                    # Superseded while we were looking, read the counter again
+                    generation = self._generation()
+                    continue
+                # The previous mapping is unmapped once no reader holds it any more
+                self._snapshot = mapped
+                self._compiled = OrderedDict()
+                self.remaps += 1
+                return mapped
+        raise RuntimeError(f'Could not map catalog snapshot {self.path}')
+
+    def publish(self, build, expected=None):
+        """
+        Write the services returned by ``build()`` as the next generation
+        and make it current, unless they are what the current generation
+        holds already. With ``expected``, skip the rebuild when another
+        process has already published something newer than that generation.
+        """
+        with open(self.path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                current = self._generation()
+                if expected is not None and current != expected:
+                    return current
+                services = build()
+                generation = current + 1
+                data = encode(services, generation)
+                if current and self._republish(current, data):
+                    generation = current
+                else:
+                    temporary = f'{self.path}.{generation}.tmp'
+                    with open(temporary, 'wb') as f:
+                        f.write(data)
+                    os.replace(temporary, f'{self.path}.{generation}')
+                    CONTROL.pack_into(self._control, 0, generation)
+                    # Keep the previous generation for readers that are just remapping
+                    stale = f'{self.path}.{generation - 2}'
+                    if generation > 2 and os.path.exists(stale):
+                        os.unlink(stale)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        self._stale = False
+        self._sync()
+        return generation
+
+    def _republish(self, generation, data):
+        """
+        Refresh published_at of ``generation`` when its data equals
+        ``data``. Returns whether it did.
+        """
+        try:
+            with open(f'{self.path}.{generation}', 'r+b') as f:
+                f.seek(HEADER.size)
+                if f.read() != data[HEADER.size:]:
+                    return False
+                f.seek(PUBLISHED_AT_OFFSET)
+                f.write(PUBLISHED_AT.pack(time.time()))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def load(self):
+        """
+        Rebuild the snapshot from the database and publish it to all workers.
+        """
+        return self.publish(_fetch)
+
+    def refresh_service(self, service_id):
+        """
+        Publish a new snapshot after a write so every worker remaps. It is
+        read from the primary, which replicas may not have caught up with.
+        """
+        if self._sync() is None:
+            return 0
+        with router.use_primary():
+            return self.load()
+
+    def clear(self):
+        """
+        Force a rebuild from the database on the next read.
+        """
+        self._stale = True
+
+    def _current(self):
+        snapshot = self._sync()
+        if snapshot is None or self._stale or (
+                self.max_age and time.time() - snapshot.published_at > self.max_age):
+            seen = snapshot.generation if snapshot is not None and not self._stale else None
+            # Only one worker rebuilds an expired snapshot, the others map its result
+            self.publish(_fetch, expected=seen)
+            snapshot = self._sync()
+        return snapshot
+
+    def get(self, service_id):
+        try:
+            service_id = int(service_id)
+        except (TypeError, ValueError):
+            raise Service.DoesNotExist(f"Service {service_id!r} does not exist")
+
+        snapshot = self._current()
+        row = snapshot.find(service_id)
+        if row is None:
+            # Only rebuild for services that really exist, not for every bad id
+            if not Service.select().where(Service.id == service_id).exists():
+                raise Service.DoesNotExist(f"Service {service_id} does not exist")
+            with router.use_primary():
+                self.load()
+            snapshot = self._sync()
+            row = snapshot.find(service_id)
+            if row is None:
+                raise Service.DoesNotExist(f"Service {service_id} does not exist")
+
+        key = (snapshot.generation, row)
+        compiled = self._compiled
+        service = compiled.get(key)
+        if service is None:
+            service = snapshot.service(row)
+            with self._lock:
+                if self._snapshot is snapshot:
+                    compiled[key] = service
+                    while len(compiled) > self.cache_size:
+                        compiled.popitem(last=False)
+        return service
+
+    def services(self):
+        snapshot = self._current()
+        return [self.get(service_id) for service_id in snapshot.service_ids()]
+
+    def current_version(self):
+        return self._current().generation
+
+    def stats(self):
+        snapshot = self._sync()
+        return {
+            'mode': 'snapshot',
+            'path': self.path,
+            'version': snapshot.generation if snapshot else 0,
+            'services': snapshot.service_count if snapshot else 0,
+            'snapshot_bytes': snapshot.size if snapshot else 0,
+            'decoded_services': len(self._compiled),
+            'remaps': self.remaps,
+        }
@@ -1,25 +1,54 @@
 from peewee import *
-from playhouse.pool import PooledMySQLDatabase
+from playhouse.db_url import connect
+from pool import InstrumentedPooledMySQLDatabase
 import os
-db_name = os.environ.get("DB_NAME")
-db_user = os.environ.get("DB_USER")
-db_host = os.environ.get("DB_HOST")
-db_password = os.environ.get("DB_PASSWORD")
+REQUIRED_SETTINGS = ("DB_NAME", "DB_USER", "DB_HOST", "DB_PASSWORD")
+
+def _pooled_mysql(host, port):
+    return InstrumentedPooledMySQLDatabase(
+        str(os.environ.get("DB_NAME")),
+        max_connections=int(os.environ.get("DB_POOL_SIZE", 32)),
+        stale_timeout=int(os.environ.get("DB_POOL_STALE_TIMEOUT", 100)),
+        # Seconds a checkout waits for a free connection before failing
+        timeout=float(os.environ.get("DB_POOL_TIMEOUT", 5)),
+        # Ping pooled connections before handing them out
+        pre_ping=os.environ.get("DB_POOL_PRE_PING", "1") == "1",
+        user=str(os.environ.get("DB_USER")),
+        password=str(os.environ.get("DB_PASSWORD")),
+        host=host,
+        port=port,
+    )
 
-if not all([db_name, db_user, db_host, db_password]):
-    raise ValueError("One or more required environment variables are missing",str([db_name, db_user, db_host, db_password]))
-else:
-    print("All environment variables are set",str([db_name, db_user, db_host, db_password]) )        
 def get_db():
+    # e.g. sqlite:///bench.db, overrides the MySQL settings (benchmarks, local runs)
+    database_url = os.environ.get("DATABASE_URL")
+    if database_url:
+        return connect(database_url)
+
+    # Report missing settings by name only, never their values
+    missing = [name for name in REQUIRED_SETTINGS if not os.environ.get(name)]
+    if missing:
+        raise ValueError("Missing required environment variables: " + ", ".join(missing))
  
-    db = PooledMySQLDatabase(
-    str(os.environ.get("DB_NAME")),
-    max_connections=32,
-    stale_timeout=100,
-    user=str(os.environ.get("DB_USER")),
-    password=str(os.environ.get("DB_PASSWORD")),
-    host=str(os.environ.get("DB_HOST")),
-    port=3306
+    return _pooled_mysql(str(os.environ.get("DB_HOST")), int(os.environ.get("DB_PORT", 3306)))
+
+def get_replicas():
+    # Read replicas for router.py, e.g. DATABASE_REPLICA_URLS=sqlite:///replica.db
+    # or DB_REPLICA_HOSTS=replica1,replica2:3307 (same name and credentials as the primary)
+    urls = os.environ.get("DATABASE_REPLICA_URLS")
+    if urls:
+        return [connect(url.strip()) for url in urls.split(",") if url.strip()]
+    replicas = []
+    for address in os.environ.get("DB_REPLICA_HOSTS", "").split(","):
+        if address.strip():
+            host, _, port = address.strip().partition(":")
+            replicas.append(_pooled_mysql(host, int(port or os.environ.get("DB_PORT", 3306))))
+    return replicas
 
-            )
-    return db
+def get_rate_limit_storage():
+    # Flask-Limiter storage for the ADMISSION_*_RATE_LIMIT limits (admission.py).
+    # With memory:// every gunicorn worker keeps its own counters, so a client can
+    # make up to limit x workers requests: size the limits per worker (e.g. 600 per
+    # minute overall with 4 workers -> "150 per minute"). Set RATELIMIT_STORAGE_URI
+    # or REDIS_URL (e.g. redis://cache:6379/0) to share the counters between workers.
+    return os.environ.get("RATELIMIT_STORAGE_URI") or os.environ.get("REDIS_URL") or "memory://"
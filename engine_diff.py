@@ -0,0 +1,168 @@
+"""
+Differential test of the integer pricing engine against the Decimal one.
+
+Every quote is priced by both engines; the Decimal result, rounded to minor
+units with the same rounding mode, must equal the integer result, and
+both must reject the same invalid inputs with the same error.
+
+    python engine_diff.py --samples 1000               # the catalog in the database
+    python engine_diff.py --random-catalogs 500        # synthetic catalogs, no database
+    python engine_diff.py --random-catalogs 500 --rounding ROUND_HALF_EVEN
+
+Exits with status 1 and prints the first mismatches when the engines disagree.
+"""
+import argparse
+import random
+import sys
+from decimal import Decimal
+
+from catalog import CompiledParameter, CompiledService
+from pricing import (FIXED, MULTIPLIER, QUANTITY, ROUNDING, ROUNDING_MODES, IntegerPricingPlan,
+                     PricingError, PricingPlan, round_price)
+
+# Non-finite quantities are left out: the Decimal engine prices 'Infinity'
+# while the integer engine rejects it as an invalid quantity.
+QUANTITIES = ('1', '2', '3', '10', '0', '-1', '2.5', '0.333', '1.005', '12.3456789', '1e2', '2E-3',
+              7, 1.5, True, '', 'abc')
+
+
+def random_decimal(rng, low, high, places):
+    scale = 10 ** places
+    return Decimal(rng.randint(low * scale, high * scale)).scaleb(-places)
+
+
+def random_service(rng, service_id, max_parameters=6, max_options=5):
+    """
+    A synthetic CompiledService with prices and modifiers at the model
+    precision (2 and 4 decimals). At most four multipliers are used so the
+    Decimal engine stays within its 28 digit context and is exact.
+    """
+    parameters = []
+    multipliers = 0
+    for index in range(rng.randint(0, max_parameters)):
+        kind = rng.choice((MULTIPLIER, FIXED, QUANTITY))
+        if kind == MULTIPLIER:
+            if multipliers == 4:
+                kind = FIXED
+            else:
+                multipliers += 1
+        options = {}
+        if kind != QUANTITY:
+            for option in range(rng.randint(1, max_options)):
+                if kind == MULTIPLIER:
+                    options[f'opt_{option}'] = random_decimal(rng, 0, 3, 4)
+                else:
+                    options[f'opt_{option}'] = random_decimal(rng, -500, 500, rng.choice((0, 2, 4)))
+        default = rng.choice([None] + list(options)) if options else rng.choice((None, '1', '2'))
+        parameters.append(CompiledParameter(
+            index + 1, f'param_{index}', kind, rng.random() < 0.3, default, options))
+    return CompiledService(service_id, f'service_{service_id}', random_decimal(rng, 0, 1000, 2), tuple(parameters))
+
+
+def random_params(service, rng):
+    """
+    Mostly valid parameter sets, with missing and invalid values mixed in.
+    """
+    params = {}
+    for parameter in service.parameters:
+        roll = rng.random()
+        if roll < 0.1:
+            continue
+        if parameter.parameter_type == QUANTITY:
+            params[parameter.name] = rng.choice(QUANTITIES)
+        elif roll < 0.13 or not parameter.options:
+            params[parameter.name] = 'not_an_option'
+        else:
+            params[parameter.name] = rng.choice(list(parameter.options))
+    return params
+
+
+def _outcome(evaluate, params, rounding=None):
+    try:
+        price = evaluate(params)
+        if rounding is not None:
+            price = round_price(price, rounding)
+    except PricingError as e:
+        return ('error', str(e))
+    except Exception:
+        return ('error', None)
+    return ('price', price)
+
+
+def _same(expected, actual):
+    if expected[0] != actual[0]:
+        return False
+    # Only pricing errors carry a message worth comparing
+    if expected[0] == 'error' and None in (expected[1], actual[1]):
+        return True
+    return expected == actual
+
+
+def compare(service, params_list, rounding=None):
+    """
+    Price ``params_list`` with both engines one by one and in a batch.
+    Returns a list of (params, Decimal outcome, integer outcome) mismatches.
+    """
+    rounding = rounding or ROUNDING
+    decimal_plan = PricingPlan.compile(service)
+    integer_plan = IntegerPricingPlan.compile(service, rounding)
+    if not isinstance(integer_plan, IntegerPricingPlan):
+        raise ValueError(f'Service {service.id} has values the integer engine cannot hold exactly')
+
+    mismatches = []
+    for params in params_list:
+        expected = _outcome(decimal_plan.evaluate, params, rounding)
+        actual = _outcome(integer_plan.evaluate, params)
+        if not _same(expected, actual):
+            mismatches.append((params, expected, actual))
+
+    batch = integer_plan.evaluate_many(params_list)
+    for params, (price, error) in zip(params_list, batch):
+        expected = _outcome(decimal_plan.evaluate, params, rounding)
+        actual = ('price', price) if error is None else ('error', error)
+        if not _same(expected, actual):
+            mismatches.append((params, expected, actual))
+    return mismatches
+
+
+def run_random(catalogs, samples, seed, rounding):
+    rng = random.Random(seed)
+    mismatches = []
+    for service_id in range(1, catalogs + 1):
+        service = random_service(rng, service_id)
+        params_list = [random_params(service, rng) for _ in range(samples)]
+        mismatches += [(service_id,) + m for m in compare(service, params_list, rounding)]
+    return mismatches
+
+
+def run_catalog(samples, seed, rounding):
+    from catalog import _fetch
+    rng = random.Random(seed)
+    mismatches = []
+    for service in _fetch().values():
+        params_list = [random_params(service, rng) for _ in range(samples)]
+        mismatches += [(service.id,) + m for m in compare(service, params_list, rounding)]
+    return mismatches
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare the integer and Decimal pricing engines')
+    parser.add_argument('--samples', type=int, default=200, help='quotes per service')
+    parser.add_argument('--random-catalogs', type=int, default=0,
+                        help='test this many synthetic services instead of the database catalog')
+    parser.add_argument('--rounding', default=ROUNDING, choices=ROUNDING_MODES)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    if args.random_catalogs:
+        mismatches = run_random(args.random_catalogs, args.samples, args.seed, args.rounding)
+    else:
+        mismatches = run_catalog(args.samples, args.seed, args.rounding)
+    for service_id, params, expected, actual in mismatches[:20]:
+        print(f'service {service_id} {params!r}: decimal {expected} != integer {actual}')
+    print(f'{len(mismatches)} mismatches')
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,41 @@
+# Picked up automatically by gunicorn from the working directory.
+import os
+
+# Import the app once in the master and fork workers from it, so each worker
+# starts without importing anything (GUNICORN_PRELOAD=0 to disable, e.g.
+# when using --reload).
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+def when_ready(server):
+    # Runs in the master before the first worker is forked.
+    if server.cfg.preload_app:
+        from app import warm_up
+        warm_up()
+    warn_per_worker_rate_limits(server)
+
+def warn_per_worker_rate_limits(server):
+    # memory:// rate limit counters are per worker (see config_sample.py)
+    if server.cfg.workers > 1:
+        import admission
+        limits = [b.rate_limit for b in admission.budgets.values() if b.rate_limit]
+        if limits and not admission.RATE_LIMIT_SHARED:
+            from logs import log
+            log.warning('rate limits are counted per worker: clients get up to %d times %s; '
+                        'set RATELIMIT_STORAGE_URI to share them', server.cfg.workers, ', '.join(limits))
+
+def pre_fork(server, worker):
+    # Runs in the master. One worker at a time runs the retention thread
+    # (RETENTION_ENABLED=1); when it exits, the next worker forked takes over.
+    worker.run_retention = not any(getattr(w, 'run_retention', False) for w in server.WORKERS.values())
+
+def post_fork(server, worker):
+    if worker.run_retention:
+        from retention import retention_job
+        retention_job.ensure_started()
+
+def worker_exit(server, worker):
+    # Write out any calculation rows still queued in write-behind mode.
+    from history import history_writer
+    from logs import pipeline
+    history_writer.stop()
+    pipeline.stop()
@@ -0,0 +1,390 @@
+"""
+Persistence of PriceCalculation history.
+
+By default every calculation is inserted synchronously. With
+HISTORY_WRITE_BEHIND=1 rows go to a bounded in-process queue instead and a
+background thread bulk-inserts them, either when HISTORY_BATCH_SIZE rows are
+waiting or every HISTORY_FLUSH_INTERVAL seconds. When the queue is full new
+rows are dropped and counted rather than blocking the request.
+
+Rows carry a client-side ULID (``uid``) so callers get a stable calculation
+id before the row is written. Both paths update the hourly and daily
+rollups (see rollups.py): a write-behind flush in its insert's transaction,
+a synchronous insert right after it commits, in a short transaction of its
+own, so quotes do not queue behind each other's locks on the bucket rows.
+
+The request parameters of a calculation are stored once per distinct set:
+``parameter_sets`` holds their canonical JSON (sorted keys, no whitespace)
+under a 64 bit hash of it, and each calculation row only carries that id.
+Quotes repeat the same few sets, so rows shrink to a few fixed-size
+columns, and a worker that has already stored a set (PARAMETER_SET_CACHE_SIZE
+most recent ones) inserts nothing but the id. The service id is the row's
+own. Read paths rebuild the original ``{"service_id", "parameters"}``
+document, from the set or from rows still stored inline.
+"""
+import atexit
+import datetime
+import hashlib
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from decimal import Decimal
+
+from peewee import JOIN
+
+from models import database, ParameterSet, PriceCalculation
+from quote_cache import QuoteCache
+from rollups import update_rollups
+
+log = logging.getLogger('pricing.history')
+
+_CROCKFORD = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+_STOP = object()
+CENTS = Decimal('0.01')
+
+
+def new_ulid():
+    """
+    Return a 26 character ULID: 48 bits of millisecond time followed by
+    80 random bits. ULIDs sort by creation time, which keeps inserts at the
+    end of the unique index.
+    """
+    value = (int(time.time() * 1000) << 80) | int.from_bytes(os.urandom(10), 'big')
+    chars = []
+    for _ in range(26):
+        chars.append(_CROCKFORD[value & 31])
+        value >>= 5
+    return ''.join(reversed(chars))
+
+
+def parameter_set(parameters):
+    """
+    The ParameterSet (id, canonical JSON) of request parameters.
+    """
+    text = json.dumps(parameters, sort_keys=True, separators=(',', ':'))
+    digest = hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True), text
+
+
+# Set id -> canonical JSON stored under it, for sets known to be in the table
+parameter_sets = QuoteCache(
+    max_size=int(os.environ.get('PARAMETER_SET_CACHE_SIZE', 10000)), ttl=float('inf'))
+
+
+def _load_or_insert(set_id, text):
+    stored = ParameterSet.select(ParameterSet.parameters).where(ParameterSet.id == set_id).scalar()
+    if stored is None:
+        ParameterSet.insert(id=set_id, parameters=text).on_conflict_ignore().execute()
+        stored = text
+    return stored
+
+
+def store_parameter_set(parameters):
+    """
+    Make sure the set of ``parameters`` is stored and return its id, or None
+    in the unlikely case another set already has the same hash.
+    """
+    set_id, text = parameter_set(parameters)
+    stored = parameter_sets.get_or_compute(set_id, lambda: _load_or_insert(set_id, text))
+    return set_id if stored == text else None
+
+
+def compact_rows(rows):
+    """
+    Turn the 'parameters' of calculation rows into parameter_set_id
+    references. Sets are committed on their own, before the rows: an unused
+    set is harmless, a row pointing at a missing one is not.
+    """
+    for row in rows:
+        if 'parameters' not in row:
+            row.setdefault('parameter_set_id', None)
+            continue
+        parameters = row.pop('parameters')
+        row['parameter_set_id'] = store_parameter_set(parameters)
+        row['input_params'] = None if row['parameter_set_id'] is not None else json.dumps({
+            'service_id': row['service'],
+            'parameters': parameters
+        })
+    return rows
+
+
+def decode_input_params(service_id, input_params, parameters):
+    """
+    The {'service_id', 'parameters'} document of a calculation, from its
+    ParameterSet JSON when it has one, otherwise from the inline text.
+    """
+    if parameters is not None:
+        return {'service_id': service_id, 'parameters': json.loads(parameters)}
+    return json.loads(input_params)
+
+
+class HistoryWriter(object):
+    def __init__(self, enabled=None, max_queue=None, batch_size=None, flush_interval=None):
+        env = os.environ.get
+        self.enabled = env('HISTORY_WRITE_BEHIND', '0') == '1' if enabled is None else enabled
+        self.max_queue = int(env('HISTORY_QUEUE_SIZE', 10000)) if max_queue is None else max_queue
+        self.batch_size = int(env('HISTORY_BATCH_SIZE', 500)) if batch_size is None else batch_size
+        self.flush_interval = (float(env('HISTORY_FLUSH_INTERVAL', 1.0))
+                               if flush_interval is None else flush_interval)
+        self._queue = queue.Queue(maxsize=self.max_queue)
+        self._thread = None
+        self._pid = None
+        self._stopping = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self.enqueued = 0
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        self.flushes = 0
+
+    def submit(self, row):
+        """
+        Queue a row for insertion. Returns False when the row was dropped.
+        """
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.enqueued += 1
+        return True
+
+    def _ensure_started(self):
+        # Threads do not survive a fork, so start one per worker process.
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name='history-writer', daemon=True)
+            self._thread.start()
+
+    def _drain(self, limit):
+        rows = []
+        while len(rows) < limit:
+            try:
+                row = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if row is not _STOP:
+                rows.append(row)
+        return rows
+
+    def _write(self, rows):
+        if not rows:
+            return
+        try:
+            database.connect(reuse_if_open=True)
+            try:
+                compact_rows(rows)
+                with database.atomic():
+                    PriceCalculation.insert_many(rows).execute()
+                    update_rollups(rows)
+            finally:
+                database.close()
+        except Exception as e:
+            self.failed += len(rows)
+            log.error('history writer: failed to insert %d rows: %s', len(rows), e)
+        else:
+            self.written += len(rows)
+            self.flushes += 1
+
+    def flush(self):
+        """
+        Write everything currently queued, in batches.
+        """
+        with self._flush_lock:
+            rows = self._drain(self.batch_size)
+            while rows:
+                self._write(rows)
+                rows = self._drain(self.batch_size)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            deadline = time.monotonic() + self.flush_interval
+            rows = []
+            while len(rows) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    row = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if row is _STOP:
+                    break
+                rows.append(row)
+            if rows:
+                with self._flush_lock:
+                    self._write(rows)
+
+    def stop(self, timeout=5.0):
+        """
+        Stop the flusher and write whatever is left. Called on worker exit.
+        """
+        self._stopping.set()
+        thread = self._thread
+        if thread is not None and thread.is_alive() and self._pid == os.getpid():
+            try:
+                # Wake the flusher up if it is waiting for rows.
+                self._queue.put_nowait(_STOP)
+            except queue.Full:
+                pass
+            thread.join(timeout)
+        self._thread = None
+        self.flush()
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'queue_depth': self._queue.qsize(),
+            'queue_capacity': self.max_queue,
+            'enqueued': self.enqueued,
+            'dropped': self.dropped,
+            'written': self.written,
+            'failed': self.failed,
+            'flushes': self.flushes,
+        }
+
+
+history_writer = HistoryWriter()
+atexit.register(history_writer.stop)
+
+
+def _update_rollups(rows):
+    # After the insert has committed. The calculations are stored either way,
+    # so a failure is only logged (rollups.py backfill repairs the buckets).
+    try:
+        with database.atomic():
+            update_rollups(rows)
+    except Exception as e:
+        log.error('failed to update rollups for %d calculations: %s', len(rows), e)
+
+
+def record_calculation(service_id, parameters, calculated_price, base_price, timestamp=None):
+    """
+    Store one calculation of request ``parameters`` and return its row dict,
+    including ``calculation_id``.
+
+    In write-behind mode the row is only queued and ``calculation_id`` is the
+    ULID; otherwise it is the auto-increment id of the inserted row.
+    """
+    row = {
+        'uid': new_ulid(),
+        'timestamp': timestamp or datetime.datetime.now(),
+        'service': service_id,
+        'parameters': parameters,
+        'calculated_price': calculated_price,
+        'base_price': base_price,
+    }
+    if history_writer.enabled:
+        history_writer.submit(dict(row))
+        row['calculation_id'] = row['uid']
+    else:
+        compact_rows([row])
+        calculation = PriceCalculation.create(**row)
+        _update_rollups([row])
+        row['calculation_id'] = calculation.id
+    return row
+
+
+def record_calculations(rows):
+    """
+    Store many calculation rows (each already carrying a ``uid``) at once.
+    Rows give either their request ``parameters`` or ``input_params`` text.
+    """
+    if not rows:
+        return
+    if history_writer.enabled:
+        for row in rows:
+            history_writer.submit(row)
+    else:
+        compact_rows(rows)
+        PriceCalculation.insert_many(rows).execute()
+        _update_rollups(rows)
+
+
+EXPORT_COLUMNS = (PriceCalculation.id, PriceCalculation.uid, PriceCalculation.service,
+                  PriceCalculation.timestamp, PriceCalculation.input_params, ParameterSet.parameters,
+                  PriceCalculation.calculated_price, PriceCalculation.base_price)
+
+
+def select_calculations(db=None):
+    """
+    Query of EXPORT_COLUMNS, with the parameter set of each row joined in.
+    """
+    return (PriceCalculation.select(*EXPORT_COLUMNS)
+            .join(ParameterSet, JOIN.LEFT_OUTER, on=(PriceCalculation.parameter_set_id == ParameterSet.id))
+            .bind(db or database))
+
+
+def calculation_dict(id, uid, service, timestamp, input_params, parameters, calculated_price, base_price):
+    """
+    JSON-ready form of a calculation row selected as EXPORT_COLUMNS tuples.
+    """
+    return {
+        'id': id,
+        'uid': uid,
+        'service_id': service,
+        'timestamp': timestamp.isoformat(),
+        'input_params': decode_input_params(service, input_params, parameters),
+        'calculated_price': str(Decimal(calculated_price).quantize(CENTS)),
+        'base_price': str(Decimal(base_price).quantize(CENTS)),
+    }
+
+
+def iter_calculations(service_id=None, start=None, end=None, chunk_size=1000, db=None):
+    """
+    Yield calculation rows as dicts ordered by (service_id, timestamp, id).
+
+    Rows are read in keyset chunks that follow the composite index, so
+    memory stays flat and no long-running cursor is held open. ``db`` is the
+    database to read from (e.g. a replica), the primary by default.
+    """
+    for rows in iter_calculation_chunks(service_id, start, end, chunk_size, db):
+        for row in rows:
+            yield calculation_dict(*row)
+
+
+def row_key(row):
+    """
+    Keyset position (service_id, timestamp, id) of an EXPORT_COLUMNS tuple.
+    """
+    return (row[2], row[3], row[0])
+
+
+def iter_calculation_chunks(service_id=None, start=None, end=None, chunk_size=1000, db=None, after=None):
+    """
+    Yield lists of EXPORT_COLUMNS tuples, in iter_calculations() order,
+    starting after the row_key() ``after`` when given.
+    """
+    PC = PriceCalculation
+    last = after
+    while True:
+        query = select_calculations(db)
+        if service_id is not None:
+            query = query.where(PC.service == service_id)
+        if start is not None:
+            query = query.where(PC.timestamp >= start)
+        if end is not None:
+            query = query.where(PC.timestamp < end)
+        if last is not None:
+            last_service, last_timestamp, last_id = last
+            # Expanded row comparison, which MySQL can resolve from the index
+            query = query.where(
+                (PC.service > last_service) |
+                ((PC.service == last_service) & (PC.timestamp > last_timestamp)) |
+                ((PC.service == last_service) & (PC.timestamp == last_timestamp) & (PC.id > last_id)))
+        rows = list(query.order_by(PC.service, PC.timestamp, PC.id).limit(chunk_size).tuples())
+        if rows:
+            yield rows
+        if len(rows) < chunk_size:
+            return
+        last = row_key(rows[-1])
@@ -0,0 +1,222 @@
+"""
+Structured, non-blocking logging.
+
+The service logs through 'pricing' and its child loggers. ``configure()``
+(called by create_app) gives that logger a QueueHandler: the request thread
+only creates the record and puts it on a bounded queue, and a QueueListener
+thread, one per worker process, formats it and writes it to stderr. When
+the queue is full records are dropped and counted rather than blocking.
+
+Records are written as JSON lines (LOG_FORMAT=text for plain lines):
+
+    {"ts": "2025-01-11T14:30:00.123Z", "level": "DEBUG", "logger": "pricing.quotes",
+     "message": "quote", "request_id": "01J...", "service_id": 3, "price": "150.00",
+     "timings": {"catalog": 0.012, "db": 0.437, "queries": 1}}
+
+Fields passed with ``extra=`` become JSON fields. Inside a request the
+request id (the X-Request-Id header, or a generated ULID returned in that
+header) and the request's phase timings so far, in milliseconds, are added
+on the request thread; everything else happens on the listener thread.
+
+Calculation traces go to 'pricing.quotes' at DEBUG level, for a sample of
+quotes. Check ``trace_enabled(service_id)`` before building one:
+
+    LOG_LEVEL                INFO, DEBUG for calculation traces
+    LOG_TRACE_SAMPLE_RATE    fraction of quotes traced at DEBUG, default 1.0
+    LOG_TRACE_SAMPLE_RATES   per-service rates, e.g. "3=1,7=0.01"
+    LOG_REQUESTS             1 to log every request with its timings
+    LOG_QUEUE_SIZE           records waiting for the listener, default 10000
+"""
+import atexit
+import datetime
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+from flask import g, has_request_context
+
+import metrics
+
+LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+FORMAT = os.environ.get('LOG_FORMAT', 'json')
+QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+REQUEST_LOG = os.environ.get('LOG_REQUESTS', '0') == '1'
+REQUEST_ID_HEADER = 'X-Request-Id'
+TRACE_SAMPLE_RATE = float(os.environ.get('LOG_TRACE_SAMPLE_RATE', 1.0))
+
+
+def parse_rates(value):
+    """
+    Parse "3=1,7=0.01" into {3: 1.0, 7: 0.01}.
+    """
+    rates = {}
+    for item in (value or '').split(','):
+        if item.strip():
+            service_id, rate = item.split('=')
+            rates[int(service_id)] = float(rate)
+    return rates
+
+
+TRACE_SAMPLE_RATES = parse_rates(os.environ.get('LOG_TRACE_SAMPLE_RATES'))
+
+log = logging.getLogger('pricing')
+quote_log = logging.getLogger('pricing.quotes')
+request_log = logging.getLogger('pricing.requests')
+
+# Attributes every LogRecord has; anything else was passed with extra=
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+
+def trace_enabled(service_id):
+    """
+    Whether to log a calculation trace for ``service_id`` now: DEBUG is
+    enabled and the quote is in the service's sample.
+    """
+    if not quote_log.isEnabledFor(logging.DEBUG):
+        return False
+    rate = TRACE_SAMPLE_RATES.get(service_id, TRACE_SAMPLE_RATE)
+    return rate >= 1.0 or random.random() < rate
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc)
+                  .isoformat(timespec='milliseconds').replace('+00:00', 'Z'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class RequestContextFilter(logging.Filter):
+    """
+    Add the request id and phase timings of the current request. Runs on the
+    thread that logs, before the record is queued.
+    """
+    def filter(self, record):
+        if has_request_context():
+            record.request_id = g.get('request_id')
+            timings = metrics.current()
+            if timings is not None and not hasattr(record, 'timings'):
+                phases = {phase: round(seconds * 1000, 3) for phase, seconds in timings.phases.items()}
+                phases['db'] = round(timings.query_time * 1000, 3)
+                phases['queries'] = timings.queries
+                record.timings = phases
+        return True
+
+
+class _QueueHandler(QueueHandler):
+    def __init__(self, pipeline):
+        super().__init__(None)
+        self.pipeline = pipeline
+
+    def prepare(self, record):
+        # Formatting is left to the listener thread
+        return record
+
+    def enqueue(self, record):
+        self.pipeline.put(record)
+
+
+class LogPipeline(object):
+    def __init__(self, max_queue=QUEUE_SIZE):
+        self.max_queue = max_queue
+        self.handler = _QueueHandler(self)
+        self.handler.addFilter(RequestContextFilter())
+        self.output = None
+        self._queue = None
+        self._listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self.enqueued = 0
+        self.dropped = 0
+
+    def set_output(self, stream=None, fmt=None):
+        output = logging.StreamHandler(stream or sys.stderr)
+        if (fmt or FORMAT) == 'json':
+            output.setFormatter(JSONFormatter())
+        else:
+            output.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s'))
+        self.stop()
+        self.output = output
+
+    def _ensure_started(self):
+        # Threads do not survive a fork, so start one listener (with its own
+        # queue) per worker process.
+        if self._listener is not None and self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._listener is not None and self._pid == os.getpid():
+                return
+            if self.output is None:
+                self.set_output()
+            self._pid = os.getpid()
+            self._queue = queue.Queue(maxsize=self.max_queue)
+            self._listener = QueueListener(self._queue, self.output, respect_handler_level=True)
+            self._listener.start()
+
+    def put(self, record):
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return
+        self.enqueued += 1
+
+    def stop(self):
+        """
+        Write out the queued records and stop the listener. Called on
+        worker exit.
+        """
+        listener = self._listener
+        self._listener = None
+        if listener is None or self._pid != os.getpid():
+            return
+        # QueueListener.stop() puts its sentinel with put_nowait
+        while True:
+            try:
+                listener.stop()
+                break
+            except queue.Full:
+                time.sleep(0.01)
+        self.output.flush()
+
+    def stats(self):
+        return {
+            'level': logging.getLevelName(log.getEffectiveLevel()),
+            'queue_depth': self._queue.qsize() if self._queue is not None else 0,
+            'queue_capacity': self.max_queue,
+            'enqueued': self.enqueued,
+            'dropped': self.dropped,
+        }
+
+
+pipeline = LogPipeline()
+atexit.register(pipeline.stop)
+
+
+def configure(level=None, stream=None, fmt=None):
+    """
+    Send the service's log records through the queue. Safe to call more
+    than once; ``stream`` and ``fmt`` replace the output.
+    """
+    log.setLevel(level or LEVEL)
+    if stream is not None or fmt is not None:
+        pipeline.set_output(stream, fmt)
+    if pipeline.handler not in log.handlers:
+        log.addHandler(pipeline.handler)
+        log.propagate = False
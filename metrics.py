@@ -0,0 +1,227 @@
+"""
+Per-request performance instrumentation.
+
+Every request is counted by endpoint and status. For a sampled request
+(METRICS_SAMPLE_RATE, default 1.0) every peewee query is also counted and
+timed, and named phases (catalog lookup, pricing, history, serialization)
+are timed with ``timed()``. The result is returned in a Server-Timing
+header and aggregated into histograms that ``render()`` turns into the
+Prometheus text format for /metrics.
+
+Beyond that count, unsampled requests and code running outside a request
+(e.g. the history flusher thread) only pay for one thread-local attribute
+lookup.
+"""
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+
+SAMPLE_RATE = float(os.environ.get('METRICS_SAMPLE_RATE', 1.0))
+
+_state = threading.local()
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+class Histogram(object):
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = [(k, list(v)) for k, v in self._series.items()]
+        for label_values, series in sorted(items):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_format_labels(self.labels, label_values, ("le", bound))} {cumulative}')
+            lines.append(f'{self.name}_bucket{_format_labels(self.labels, label_values, ("le", "+Inf"))} {series[-1]}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labels, label_values)} {series[-2]}')
+            lines.append(f'{self.name}_count{_format_labels(self.labels, label_values)} {series[-1]}')
+        return lines
+
+
+class Counter(object):
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            items = sorted(self._values.items())
+        for label_values, value in items:
+            lines.append(f'{self.name}{_format_labels(self.labels, label_values)} {value}')
+        return lines
+
+
+def gauge_lines(name, help, value, type='gauge'):
+    """
+    Render a single unlabeled value, for counters kept elsewhere.
+    """
+    return [f'# HELP {name} {help}', f'# TYPE {name} {type}', f'{name} {value}']
+
+
+REQUEST_DURATION = Histogram(
+    'pricing_http_request_duration_seconds', 'Request duration', ('endpoint', 'method', 'status'))
+PHASE_DURATION = Histogram(
+    'pricing_request_phase_duration_seconds', 'Duration of request phases', ('endpoint', 'phase'))
+QUERIES_PER_REQUEST = Histogram(
+    'pricing_db_queries_per_request', 'SQL queries issued per request', ('endpoint',), COUNT_BUCKETS)
+REQUESTS = Counter('pricing_http_requests_total', 'Requests handled', ('endpoint', 'status'))
+
+_metrics = [REQUEST_DURATION, PHASE_DURATION, QUERIES_PER_REQUEST, REQUESTS]
+_collectors = []
+
+
+def register_collector(collector):
+    """
+    Add a callable returning extra exposition lines (gauges from other subsystems).
+    """
+    _collectors.append(collector)
+    return collector
+
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for collector in _collectors:
+        lines.extend(collector())
+    return '\n'.join(lines) + '\n'
+
+
+class RequestTimings(object):
+    __slots__ = ('started', 'queries', 'query_time', 'phases')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.query_time = 0.0
+        self.phases = {}
+
+
+def begin_request(sample_rate=None):
+    rate = SAMPLE_RATE if sample_rate is None else sample_rate
+    _state.timings = RequestTimings() if rate >= 1.0 or random.random() < rate else None
+
+
+def current():
+    return getattr(_state, 'timings', None)
+
+
+def end_request():
+    timings = current()
+    _state.timings = None
+    return timings
+
+
+@contextmanager
+def timed(phase):
+    """
+    Time a named phase of the current request (no-op when unsampled).
+    """
+    timings = current()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.phases[phase] = timings.phases.get(phase, 0.0) + time.perf_counter() - start
+
+
+def instrument_database(database):
+    """
+    Wrap ``database.execute_sql`` to count and time queries of sampled
+    requests. Safe to call more than once (one app per create_app() call).
+    """
+    if getattr(database, '_metrics_instrumented', False):
+        return database
+    execute_sql = database.execute_sql
+
+    def instrumented(sql, *args, **kwargs):
+        timings = getattr(_state, 'timings', None)
+        if timings is None:
+            return execute_sql(sql, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return execute_sql(sql, *args, **kwargs)
+        finally:
+            timings.queries += 1
+            timings.query_time += time.perf_counter() - start
+
+    database.execute_sql = instrumented
+    database._metrics_instrumented = True
+    return database
+
+
+def server_timing(timings, total):
+    """
+    Build the Server-Timing header value (durations in milliseconds).
+    """
+    parts = [f'db;dur={timings.query_time * 1000:.3f};desc="{timings.queries} queries"']
+    for phase, seconds in timings.phases.items():
+        parts.append(f'{phase};dur={seconds * 1000:.3f}')
+    parts.append(f'total;dur={total * 1000:.3f}')
+    return ', '.join(parts)
+
+
+def count(endpoint, status):
+    """
+    Count one finished request, sampled or not.
+    """
+    REQUESTS.inc(1, endpoint, status)
+
+
+def observe(timings, endpoint, method, status):
+    """
+    Fold one finished, sampled request into the histograms. Returns the
+    total duration.
+    """
+    total = time.perf_counter() - timings.started
+    REQUEST_DURATION.observe(total, endpoint, method, status)
+    QUERIES_PER_REQUEST.observe(timings.queries, endpoint)
+    PHASE_DURATION.observe(timings.query_time, endpoint, 'db')
+    for phase, seconds in timings.phases.items():
+        PHASE_DURATION.observe(seconds, endpoint, phase)
+    return total
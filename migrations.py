@@ -0,0 +1,335 @@
+"""
+Versioned schema migrations.
+
+``init_db()`` only creates missing tables, which never changes a table that
+already exists (and on MySQL does not add indexes to it either). Changes to
+existing tables are migrations, built on playhouse.migrate and recorded in
+the schema_migrations table so each one runs once per database:
+
+    python migrations.py status
+    python migrations.py up [--to VERSION]
+    python migrations.py down --to VERSION
+
+`flask --app app migrate` creates missing tables and then applies every
+pending migration. Index migrations check the existing indexes first, so
+on a database created from the current models they only record themselves.
+Migrations that rewrite many rows are not run in one transaction; they
+commit chunk by chunk and can simply be run again after a failure.
+"""
+import argparse
+import datetime
+import json
+import sys
+from contextlib import nullcontext
+
+from peewee import BigIntegerField, CharField, DateTimeField, IntegerField, fn
+from playhouse.migrate import SchemaMigrator, migrate
+
+from models import database, BaseModel, Parameter, ParameterOption, ParameterSet, PriceCalculation, init_db
+
+
+class MigrationError(Exception):
+    pass
+
+
+class SchemaMigration(BaseModel):
+    version = IntegerField(primary_key=True)
+    name = CharField()
+    applied_at = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        table_name = 'schema_migrations'
+
+
+def find_index(table, columns, unique=False):
+    for index in database.get_indexes(table):
+        if tuple(index.columns) == tuple(columns) and (index.unique or not unique):
+            return index
+    return None
+
+
+def add_index(migrator, table, columns, unique=False, log=print):
+    if find_index(table, columns, unique) is not None:
+        log(f"  {table}({', '.join(columns)}) already indexed")
+        return
+    log(f"  adding {'unique ' if unique else ''}index on {table}({', '.join(columns)})")
+    migrate(migrator.add_index(table, columns, unique))
+
+
+def drop_index(migrator, table, columns, unique=False, log=print):
+    index = find_index(table, columns, unique)
+    if index is not None:
+        log(f"  dropping index {index.name}")
+        migrate(migrator.drop_index(table, index.name))
+
+
+class Migration(object):
+    def __init__(self, version, name, up, down, transaction=True):
+        self.version = version
+        self.name = name
+        self.up = up
+        self.down = down
+        self.transaction = transaction
+
+
+# Migration 1 -----------------------------------------------------------------
+# Keyset index of the history export and of per-service time range reads.
+# (service_id, timestamp) is its prefix, so no separate index is needed.
+
+HISTORY_INDEX = ('price_calculations', ('service_id', 'timestamp', 'id'))
+
+
+def history_index_up(migrator, log):
+    add_index(migrator, *HISTORY_INDEX, log=log)
+
+
+def history_index_down(migrator, log):
+    drop_index(migrator, *HISTORY_INDEX, log=log)
+
+
+# Migration 2 -----------------------------------------------------------------
+# One parameter name per service. Duplicates cannot be merged automatically
+# (both are applied to every quote today), so they have to be fixed first.
+
+PARAMETER_INDEX = ('parameters', ('service_id', 'name'))
+
+
+def unique_parameters_up(migrator, log):
+    P = Parameter
+    duplicates = list(P.select(P.service, P.name, fn.COUNT(P.id))
+                      .group_by(P.service, P.name)
+                      .having(fn.COUNT(P.id) > 1)
+                      .tuples())
+    if duplicates:
+        listed = ', '.join(f"service {service} '{name}' ({count}x)" for service, name, count in duplicates[:20])
+        raise MigrationError(f"Rename or delete duplicate parameters first: {listed}")
+    add_index(migrator, *PARAMETER_INDEX, unique=True, log=log)
+
+
+def unique_parameters_down(migrator, log):
+    drop_index(migrator, *PARAMETER_INDEX, unique=True, log=log)
+
+
+# Migration 3 -----------------------------------------------------------------
+# One option per value and parameter. The catalog already prices duplicated
+# values with the lowest id, so the others are deleted without changing prices.
+
+OPTION_INDEX = ('parameter_options', ('parameter_id', 'value'))
+
+
+def unique_options_up(migrator, log):
+    O = ParameterOption
+    duplicates = list(O.select(O.parameter, O.value, fn.MIN(O.id))
+                      .group_by(O.parameter, O.value)
+                      .having(fn.COUNT(O.id) > 1)
+                      .tuples())
+    deleted = 0
+    for parameter_id, value, keep in duplicates:
+        deleted += O.delete().where((O.parameter == parameter_id) & (O.value == value) & (O.id != keep)).execute()
+    if deleted:
+        log(f"  deleted {deleted} duplicate options, kept the lowest id of each")
+    add_index(migrator, *OPTION_INDEX, unique=True, log=log)
+
+
+def unique_options_down(migrator, log):
+    drop_index(migrator, *OPTION_INDEX, unique=True, log=log)
+
+
+# Migration 4 -----------------------------------------------------------------
+# Request parameters stored once per distinct set (history.py). Rows whose
+# inline JSON is exactly {"service_id": <the row's service>, "parameters": ...}
+# are moved to parameter sets; anything else stays inline.
+
+COMPACT_CHUNK_SIZE = 1000
+
+
+def _column(table, name):
+    for column in database.get_columns(table):
+        if column.name == name:
+            return column
+    return None
+
+
+def _inline_parameters(service_id, input_params):
+    try:
+        document = json.loads(input_params)
+    except ValueError:
+        return None
+    if (not isinstance(document, dict) or set(document) != {'service_id', 'parameters'}
+            or str(document['service_id']) != str(service_id)):
+        return None
+    return document['parameters']
+
+
+def compact_parameters_up(migrator, log):
+    from history import store_parameter_set
+    PC = PriceCalculation
+    database.create_tables([ParameterSet])
+    if _column('price_calculations', 'parameter_set_id') is None:
+        log("  adding price_calculations.parameter_set_id")
+        migrate(migrator.add_column('price_calculations', 'parameter_set_id', BigIntegerField(null=True)))
+    if not _column('price_calculations', 'input_params').null:
+        migrate(migrator.drop_not_null('price_calculations', 'input_params'))
+
+    last = 0
+    moved = kept = 0
+    while True:
+        rows = list(PC.select(PC.id, PC.service, PC.input_params)
+                    .where((PC.id > last) & PC.parameter_set_id.is_null() & PC.input_params.is_null(False))
+                    .order_by(PC.id)
+                    .limit(COMPACT_CHUNK_SIZE)
+                    .tuples())
+        if not rows:
+            break
+        last = rows[-1][0]
+        by_set = {}
+        for id, service_id, input_params in rows:
+            parameters = _inline_parameters(service_id, input_params)
+            set_id = None if parameters is None else store_parameter_set(parameters)
+            if set_id is None:
+                kept += 1
+            else:
+                by_set.setdefault(set_id, []).append(id)
+        with database.atomic():
+            for set_id, ids in by_set.items():
+                PC.update(parameter_set_id=set_id, input_params=None).where(PC.id.in_(ids)).execute()
+                moved += len(ids)
+    log(f"  {moved} calculations moved to parameter sets, {kept} kept inline")
+
+
+def compact_parameters_down(migrator, log):
+    from history import parameter_sets
+    PC = PriceCalculation
+    if _column('price_calculations', 'parameter_set_id') is None:
+        return
+    last = 0
+    while True:
+        rows = list(PC.select(PC.id, PC.service, ParameterSet.parameters)
+                    .join(ParameterSet, on=(PC.parameter_set_id == ParameterSet.id))
+                    .where(PC.id > last)
+                    .order_by(PC.id)
+                    .limit(COMPACT_CHUNK_SIZE)
+                    .tuples())
+        if not rows:
+            break
+        last = rows[-1][0]
+        by_document = {}
+        for id, service_id, parameters in rows:
+            document = json.dumps({'service_id': service_id, 'parameters': json.loads(parameters)})
+            by_document.setdefault(document, []).append(id)
+        with database.atomic():
+            for document, ids in by_document.items():
+                PC.update(input_params=document, parameter_set_id=None).where(PC.id.in_(ids)).execute()
+    log("  restoring inline input_params")
+    migrate(migrator.drop_column('price_calculations', 'parameter_set_id'),
+            migrator.add_not_null('price_calculations', 'input_params'))
+    ParameterSet.drop_table()
+    parameter_sets.clear()
+
+
+# Migration 5 -----------------------------------------------------------------
+# Client-side calculation ids (history.py). Rows written before keep a NULL
+# uid, which the unique index allows any number of.
+
+UID_INDEX = ('price_calculations', ('uid',))
+
+
+def calculation_uid_up(migrator, log):
+    if _column('price_calculations', 'uid') is None:
+        log("  adding price_calculations.uid")
+        migrate(migrator.add_column('price_calculations', 'uid', CharField(max_length=26, null=True)))
+    add_index(migrator, *UID_INDEX, unique=True, log=log)
+
+
+def calculation_uid_down(migrator, log):
+    drop_index(migrator, *UID_INDEX, unique=True, log=log)
+    if _column('price_calculations', 'uid') is not None:
+        migrate(migrator.drop_column('price_calculations', 'uid'))
+
+
+MIGRATIONS = [
+    Migration(1, 'price_calculations (service_id, timestamp, id) index', history_index_up, history_index_down),
+    Migration(2, 'unique parameter name per service', unique_parameters_up, unique_parameters_down),
+    Migration(3, 'unique option value per parameter', unique_options_up, unique_options_down),
+    Migration(4, 'calculation parameters stored once per distinct set', compact_parameters_up,
+              compact_parameters_down, transaction=False),
+    Migration(5, 'price_calculations.uid column', calculation_uid_up, calculation_uid_down),
+]
+
+
+def applied_versions():
+    database.create_tables([SchemaMigration])
+    return {m.version for m in SchemaMigration.select(SchemaMigration.version)}
+
+
+def migrate_up(target=None, log=print):
+    """
+    Apply pending migrations up to ``target`` (all by default). Returns the
+    versions applied.
+    """
+    done = applied_versions()
+    migrator = SchemaMigrator.from_database(database)
+    applied = []
+    for migration in MIGRATIONS:
+        if migration.version in done or (target is not None and migration.version > target):
+            continue
+        log(f"{migration.version}: {migration.name}")
+        with database.atomic() if migration.transaction else nullcontext():
+            migration.up(migrator, log)
+            SchemaMigration.create(version=migration.version, name=migration.name)
+        applied.append(migration.version)
+    return applied
+
+
+def migrate_down(target, log=print):
+    """
+    Revert applied migrations newer than ``target``, newest first.
+    """
+    done = applied_versions()
+    migrator = SchemaMigrator.from_database(database)
+    reverted = []
+    for migration in reversed(MIGRATIONS):
+        if migration.version not in done or migration.version <= target:
+            continue
+        log(f"reverting {migration.version}: {migration.name}")
+        with database.atomic() if migration.transaction else nullcontext():
+            migration.down(migrator, log)
+            SchemaMigration.delete().where(SchemaMigration.version == migration.version).execute()
+        reverted.append(migration.version)
+    return reverted
+
+
+def status():
+    done = applied_versions()
+    return [(m.version, m.name, m.version in done) for m in MIGRATIONS]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Apply schema migrations')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('status', help='list migrations and whether they are applied')
+    up_parser = commands.add_parser('up', help='create missing tables and apply pending migrations')
+    up_parser.add_argument('--to', type=int, help='stop after this version')
+    down_parser = commands.add_parser('down', help='revert migrations newer than a version')
+    down_parser.add_argument('--to', type=int, required=True)
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == 'status':
+            for version, name, applied in status():
+                print(f"{version:>4}  {'applied' if applied else 'pending'}  {name}")
+        elif args.command == 'up':
+            init_db()
+            applied = migrate_up(args.to)
+            print(f"applied {len(applied)} migrations")
+        else:
+            reverted = migrate_down(args.to)
+            print(f"reverted {len(reverted)} migrations")
+    except MigrationError as e:
+        print(f"migration failed: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
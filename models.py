@@ -0,0 +1,107 @@
+from peewee import *
+import datetime
+from enum import Enum
+from config import get_db
+from router import DatabaseRouter
+try:
+    from config import get_replicas
+except ImportError:
+    # config.py copied before read replicas were supported
+    get_replicas = lambda: []
+
+database = get_db()
+# Reads that tolerate replication lag go through router.reader() (router.py)
+router = DatabaseRouter(database, get_replicas())
+
+# Base Model Class
+class BaseModel(Model):
+    class Meta:
+        database = database
+
+# Parameter Types Enum
+class ParameterType(Enum):
+    MULTIPLIER = 'multiplier'
+    FIXED = 'fixed'
+    QUANTITY = 'quantity'
+
+# Models
+class Service(BaseModel):
+    name = CharField(unique=True)
+    description = TextField(null=True)
+    base_price = DecimalField(decimal_places=2)
+    
+    class Meta:
+        table_name = 'services'
+
+class Parameter(BaseModel):
+    service = ForeignKeyField(Service, backref='parameters')
+    name = CharField()
+    description = TextField(null=True)
+    parameter_type = CharField()
+    is_required = BooleanField(default=False)
+    default_value = CharField(null=True)
+    
+    class Meta:
+        table_name = 'parameters'
+        indexes = (
+            (('service', 'name'), True),
+        )
+
+class ParameterOption(BaseModel):
+    parameter = ForeignKeyField(Parameter, backref='options')
+    value = CharField()
+    modifier = DecimalField(decimal_places=4)
+    
+    class Meta:
+        table_name = 'parameter_options'
+        indexes = (
+            (('parameter', 'value'), True),
+        )
+
+class ParameterSet(BaseModel):
+    # Distinct request parameters of calculations, keyed by a 64 bit hash of
+    # their canonical JSON (history.parameter_set)
+    id = BigIntegerField(primary_key=True)
+    parameters = TextField()
+
+    class Meta:
+        table_name = 'parameter_sets'
+
+class PriceCalculation(BaseModel):
+    uid = CharField(max_length=26, unique=True, null=True)
+    timestamp = DateTimeField(default=datetime.datetime.now)
+    service = ForeignKeyField(Service, backref='calculations')
+    # Either a ParameterSet id or the request inline as JSON text. No foreign
+    # key, so the table can still be partitioned (retention.py).
+    parameter_set_id = BigIntegerField(null=True)
+    input_params = TextField(null=True)
+    calculated_price = DecimalField(decimal_places=2)
+    base_price = DecimalField(decimal_places=2)
+    
+    class Meta:
+        table_name = 'price_calculations'
+        indexes = (
+            # Keyset order of the history export
+            (('service', 'timestamp', 'id'), False),
+        )
+
+class CalculationRollup(BaseModel):
+    service = ForeignKeyField(Service, backref='rollups')
+    period = CharField(max_length=8)  # 'hour' or 'day'
+    bucket = DateTimeField()  # start of the period
+    count = BigIntegerField(default=0)
+    total = DecimalField(max_digits=20, decimal_places=2, default=0)
+    min_price = DecimalField(decimal_places=2)
+    max_price = DecimalField(decimal_places=2)
+    
+    class Meta:
+        table_name = 'calculation_rollups'
+        indexes = (
+            (('service', 'period', 'bucket'), True),
+        )
+
+MODELS = [Service, Parameter, ParameterOption, ParameterSet, PriceCalculation, CalculationRollup]
+
+def init_db():
+    # Only creates missing tables; existing ones are changed by migrations.py
+    database.create_tables([model for model in MODELS if not model.table_exists()])
@@ -0,0 +1,93 @@
+"""
+Instrumented connection pool.
+
+Wraps peewee's pooled databases to record how long checkouts wait, how many
+connections are in use and how often the pool is exhausted. ``pre_ping``
+controls whether a pooled connection is pinged before it is handed out.
+"""
+import threading
+import time
+
+from playhouse.pool import MaxConnectionsExceeded, PooledMySQLDatabase
+
+
+class PoolMetrics(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.exhausted = 0  # checkouts that found the pool full
+        self.timeouts = 0   # checkouts that gave up waiting
+
+    def observe(self, wait, exhausted, timed_out):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_seconds_total += wait
+            if wait > self.wait_seconds_max:
+                self.wait_seconds_max = wait
+            if exhausted:
+                self.exhausted += 1
+            if timed_out:
+                self.timeouts += 1
+
+
+class InstrumentedPoolMixin(object):
+    def __init__(self, *args, **kwargs):
+        self.pre_ping = kwargs.pop('pre_ping', True)
+        self.pool_metrics = PoolMetrics()
+        self._checkout = threading.local()
+        super(InstrumentedPoolMixin, self).__init__(*args, **kwargs)
+
+    def connect(self, reuse_if_open=False):
+        if reuse_if_open and not self.is_closed():
+            return False
+        self._checkout.exhausted = False
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            return super(InstrumentedPoolMixin, self).connect(reuse_if_open)
+        except MaxConnectionsExceeded:
+            timed_out = True
+            raise
+        finally:
+            self.pool_metrics.observe(
+                time.perf_counter() - start, self._checkout.exhausted, timed_out)
+
+    def _connect(self):
+        try:
+            return super(InstrumentedPoolMixin, self)._connect()
+        except MaxConnectionsExceeded:
+            self._checkout.exhausted = True
+            raise
+
+    def _is_closed(self, conn):
+        if not self.pre_ping:
+            return False
+        return super(InstrumentedPoolMixin, self)._is_closed(conn)
+
+
+class InstrumentedPooledMySQLDatabase(InstrumentedPoolMixin, PooledMySQLDatabase):
+    pass
+
+
+def pool_stats(database):
+    """
+    Pool gauges and counters for ``database``. Databases that are not pooled
+    (e.g. SQLite in tests) report only what they have.
+    """
+    stats = {}
+    if hasattr(database, '_in_use'):
+        stats['in_use'] = len(database._in_use)
+        stats['idle'] = len(database._connections)
+        stats['max_connections'] = database._max_connections
+    metrics = getattr(database, 'pool_metrics', None)
+    if metrics is not None:
+        stats.update({
+            'checkouts': metrics.checkouts,
+            'wait_seconds_total': metrics.wait_seconds_total,
+            'wait_seconds_max': metrics.wait_seconds_max,
+            'exhausted': metrics.exhausted,
+            'timeouts': metrics.timeouts,
+        })
+    return stats
@@ -0,0 +1,135 @@
+"""
+Price matrices for product configurators.
+
+A service's prices over every combination of its multiplier and fixed
+options are an outer product: with M the products of all multiplier
+combinations and F the sums of all fixed combinations,
+
+    price[i][j] = max(base_price * M[i] + F[j], 0)
+
+so only the two axes are computed and cached (len(M) + len(F) values), and
+each cell costs one multiply-add when a page of the matrix is read. Prices
+are per unit; quantity parameters are not part of the matrix. With the
+integer pricing engine cells are rounded to minor units like its quotes.
+
+Cached matrices are keyed on a signature of the service's compiled pricing
+data, so they stay valid until that service's base price, parameters or
+options change, whatever happens to the rest of the catalog.
+"""
+import os
+
+from pricing import FIXED, MULTIPLIER, ONE, ZERO, IntegerPricingPlan, PricingError, round_price
+from quote_cache import QuoteCache
+
+MAX_MATRIX_AXIS = int(os.environ.get('MAX_MATRIX_AXIS', 100000))
+
+
+def _axis(parameters, kind, max_size):
+    """
+    Enumerate the combinations of ``parameters`` in mixed-radix order (first
+    parameter most significant). Returns (value tuples, combined modifiers).
+    Optional parameters without a default can also be left out (value None).
+    """
+    values = [()]
+    totals = [ONE if kind == MULTIPLIER else ZERO]
+    for parameter in parameters:
+        choices = list(parameter.options.items())
+        if not parameter.is_required and parameter.default_value is None:
+            choices.append((None, ONE if kind == MULTIPLIER else ZERO))
+        if len(values) * len(choices) > max_size:
+            raise PricingError(
+                f'The {kind} options of this service have more than {max_size} combinations')
+        values = [v + (value,) for v in values for value, _ in choices]
+        if kind == MULTIPLIER:
+            totals = [t * modifier for t in totals for _, modifier in choices]
+        else:
+            totals = [t + modifier for t in totals for _, modifier in choices]
+    return values, totals
+
+
+def signature(service):
+    """
+    Hashable summary of everything the matrix of ``service`` depends on.
+    """
+    return (service.base_price, tuple(
+        (p.name, p.parameter_type, p.is_required, p.default_value, tuple(p.options.items()))
+        for p in service.parameters if p.parameter_type in (MULTIPLIER, FIXED)
+    ))
+
+
+class PriceMatrix(object):
+    __slots__ = ('service_id', 'base_price', 'multiplier_names', 'multiplier_values', 'multipliers',
+                 'fixed_names', 'fixed_values', 'fixed', 'size', 'rounding')
+
+    def __init__(self, service_id, base_price, multiplier_names, multiplier_values, multipliers,
+                 fixed_names, fixed_values, fixed, rounding=None):
+        self.service_id = service_id
+        self.base_price = base_price
+        self.multiplier_names = multiplier_names
+        self.multiplier_values = multiplier_values
+        self.multipliers = multipliers
+        self.fixed_names = fixed_names
+        self.fixed_values = fixed_values
+        self.fixed = fixed
+        self.size = len(multipliers) * len(fixed)
+        self.rounding = rounding  # None keeps exact Decimal prices
+
+    @classmethod
+    def build(cls, service, max_axis=None):
+        """
+        Compute both axes for a catalog CompiledService. Raises PricingError
+        when an axis would exceed ``max_axis`` combinations.
+        """
+        max_axis = MAX_MATRIX_AXIS if max_axis is None else max_axis
+        multiplier_params = [p for p in service.parameters if p.parameter_type == MULTIPLIER]
+        fixed_params = [p for p in service.parameters if p.parameter_type == FIXED]
+        multiplier_values, multipliers = _axis(multiplier_params, MULTIPLIER, max_axis)
+        fixed_values, fixed = _axis(fixed_params, FIXED, max_axis)
+        rounding = service.plan.rounding if isinstance(service.plan, IntegerPricingPlan) else None
+        return cls(service.id, service.base_price,
+                   tuple(p.name for p in multiplier_params), multiplier_values, multipliers,
+                   tuple(p.name for p in fixed_params), fixed_values, fixed, rounding)
+
+    def cells(self, offset=0, limit=None):
+        """
+        Yield {'parameters', 'price'} cells in row-major order (multiplier
+        combination, then fixed combination), starting at ``offset``.
+        """
+        end = self.size if limit is None else min(self.size, offset + limit)
+        if offset >= end:
+            return
+        width = len(self.fixed)
+        row, column = divmod(offset, width)
+        index = offset
+        while index < end:
+            scaled = self.base_price * self.multipliers[row]
+            prefix = {name: value for name, value in zip(self.multiplier_names, self.multiplier_values[row])
+                      if value is not None}
+            stop = min(width, column + end - index)
+            for j in range(column, stop):
+                params = dict(prefix)
+                for name, value in zip(self.fixed_names, self.fixed_values[j]):
+                    if value is not None:
+                        params[name] = value
+                price = scaled + self.fixed[j]
+                if price <= ZERO:
+                    price = ZERO
+                elif self.rounding is not None:
+                    price = round_price(price, self.rounding)
+                yield {'parameters': params, 'price': float(price)}
+            index += stop - column
+            row += 1
+            column = 0
+
+
+matrix_cache = QuoteCache(
+    max_size=int(os.environ.get('PRICE_MATRIX_CACHE_SIZE', 64)),
+    ttl=float(os.environ.get('PRICE_MATRIX_CACHE_TTL', 3600)))
+
+
+def price_matrix(service):
+    """
+    Return the (cached) PriceMatrix of a catalog CompiledService.
+    """
+    return matrix_cache.get_or_compute(
+        (service.id, signature(service)), lambda: PriceMatrix.build(service))
@@ -0,0 +1,520 @@
+"""
+Compiled pricing plans.
+
+Every calculation route prices through a PricingPlan built once per compiled
+catalog service. Each parameter becomes a small ``__slots__`` evaluator with
+its option -> modifier table already resolved, and a quote is evaluated in a
+single pass over them:
+
+    total = max((base_price * product(multipliers) + sum(fixed)) * quantity, 0)
+
+Values missing from the request fall back to the parameter's default value.
+
+Two engines evaluate that formula (PRICING_ENGINE):
+
+* ``integer`` (default): IntegerPricingPlan keeps base prices and modifiers
+  as integers scaled by 10**4, the precision of the DecimalFields in
+  models.py, and parses quantities into exact (digits, exponent) pairs
+  (of at most QUANTITY_DIGITS digits). The whole
+  formula is evaluated exactly in integer arithmetic and rounded once
+  to minor units (cents) with PRICING_ROUNDING (default ROUND_HALF_UP, how
+  MySQL rounds values stored into DECIMAL(10, 2) columns).
+* ``decimal``: PricingPlan evaluates with Decimal and returns the unrounded
+  result.
+
+engine_diff.py checks that both agree on every quote once rounded.
+
+``what_if()`` prices every single-parameter alternative of a selection for
+the configurator: the selection is resolved once into its multiplier,
+fixed and quantity terms, and each alternative swaps a single term.
+"""
+import decimal
+import os
+from decimal import Decimal, InvalidOperation
+
+from models import ParameterType
+
+MULTIPLIER = ParameterType.MULTIPLIER.value
+FIXED = ParameterType.FIXED.value
+QUANTITY = ParameterType.QUANTITY.value
+
+ZERO = Decimal('0.0')
+ONE = Decimal('1.0')
+CENTS = Decimal('0.01')
+
+SCALE_DIGITS = 4  # DecimalField(decimal_places=4) on ParameterOption.modifier
+SCALE = 10 ** SCALE_DIGITS
+MINOR_DIGITS = 2  # DecimalField(decimal_places=2) on prices
+QUANTITY_DIGITS = 28  # the Decimal engine's context precision
+QUANTITY_LIMIT = 10 ** QUANTITY_DIGITS
+
+ENGINE = os.environ.get('PRICING_ENGINE', 'integer')
+ROUNDING = os.environ.get('PRICING_ROUNDING', decimal.ROUND_HALF_UP)
+ROUNDING_MODES = (decimal.ROUND_HALF_UP, decimal.ROUND_HALF_EVEN, decimal.ROUND_DOWN, decimal.ROUND_UP)
+if ROUNDING not in ROUNDING_MODES:
+    raise ValueError(f"PRICING_ROUNDING must be one of {', '.join(ROUNDING_MODES)}")
+
+
+class PricingError(ValueError):
+    pass
+
+
+class ParameterEvaluator(object):
+    __slots__ = ('name', 'kind', 'is_required', 'default_value', 'options')
+
+    def __init__(self, name, kind, is_required, default_value, options):
+        self.name = name
+        self.kind = kind
+        self.is_required = is_required
+        self.default_value = default_value
+        self.options = options  # option value -> Decimal modifier
+
+    def resolve(self, params):
+        """
+        Return the value for this parameter and its Decimal modifier (the
+        quantity itself for quantity parameters), or (None, None) when the
+        parameter is absent and optional.
+        """
+        value = params.get(self.name, self.default_value)
+        if value is None:
+            if self.is_required:
+                raise PricingError(f"Required parameter '{self.name}' is missing")
+            return None, None
+        if self.kind == QUANTITY:
+            try:
+                return value, Decimal(str(value))
+            except InvalidOperation:
+                raise PricingError(f"Invalid quantity '{value}' for parameter '{self.name}'")
+        modifier = self.options.get(str(value))
+        if modifier is None:
+            raise PricingError(f"Invalid value '{value}' for parameter '{self.name}'")
+        return value, modifier
+
+
+class PricingPlan(object):
+    __slots__ = ('service_id', 'base_price', 'evaluators')
+
+    # Neutral multiplier, fixed and quantity terms of the engine
+    _ONE = ONE
+    _ZERO = ZERO
+    _UNIT = ONE
+
+    def __init__(self, service_id, base_price, evaluators):
+        self.service_id = service_id
+        self.base_price = base_price
+        self.evaluators = evaluators
+
+    @classmethod
+    def compile(cls, service):
+        """
+        Build a plan from a catalog CompiledService.
+        """
+        return cls(service.id, service.base_price, tuple(
+            ParameterEvaluator(p.name, p.parameter_type, p.is_required, p.default_value, p.options)
+            for p in service.parameters
+        ))
+
+    def evaluate(self, params, breakdown=None):
+        """
+        Price ``params``. Pass a list as ``breakdown`` to have the resolved
+        (evaluator, value, modifier) of every parameter appended to it; see
+        itemize(). Raises PricingError for invalid or missing values.
+        """
+        multiplier = ONE
+        fixed = ZERO
+        quantity = ONE
+        for evaluator in self.evaluators:
+            value, modifier = evaluator.resolve(params)
+            if value is None:
+                continue
+            kind = evaluator.kind
+            if kind == MULTIPLIER:
+                multiplier *= modifier
+            elif kind == FIXED:
+                fixed += modifier
+            elif kind == QUANTITY:
+                quantity = modifier
+            if breakdown is not None:
+                breakdown.append((evaluator, value, modifier))
+        total = (self.base_price * multiplier + fixed) * quantity
+        return total if total > ZERO else ZERO
+
+    def _option_tables(self):
+        return [evaluator.options for evaluator in self.evaluators]
+
+    def _resolve_terms(self, params):
+        return [evaluator.resolve(params) for evaluator in self.evaluators]
+
+    def _price(self, multiplier, multiplier_count, fixed, quantity):
+        total = (self.base_price * multiplier + fixed) * quantity
+        return total if total > ZERO else ZERO
+
+    def what_if(self, params):
+        """
+        Price ``params`` and every selection that differs from it in one
+        multiplier or fixed parameter, switched to another of its options.
+
+        Returns (price of ``params``, alternatives), alternatives being one
+        (evaluator, current value, [(option value, price), ...]) per
+        multiplier or fixed parameter, in catalog order. Quantity
+        parameters have no options and are not varied. Raises PricingError
+        when ``params`` itself cannot be priced.
+        """
+        terms = self._resolve_terms(params)
+        size = len(terms)
+        # Products of the multiplier terms before and after each parameter,
+        # so leaving one out needs no division (a modifier may be 0)
+        before = [self._ONE] * (size + 1)
+        after = [self._ONE] * (size + 1)
+        for i, (evaluator, (value, modifier)) in enumerate(zip(self.evaluators, terms)):
+            used = value is not None and evaluator.kind == MULTIPLIER
+            before[i + 1] = before[i] * modifier if used else before[i]
+        for i in range(size - 1, -1, -1):
+            value, modifier = terms[i]
+            used = value is not None and self.evaluators[i].kind == MULTIPLIER
+            after[i] = after[i + 1] * modifier if used else after[i + 1]
+
+        multiplier_count = 0
+        fixed = self._ZERO
+        quantity = self._UNIT
+        for evaluator, (value, modifier) in zip(self.evaluators, terms):
+            if value is None:
+                continue
+            if evaluator.kind == MULTIPLIER:
+                multiplier_count += 1
+            elif evaluator.kind == FIXED:
+                fixed += modifier
+            elif evaluator.kind == QUANTITY:
+                quantity = modifier
+        multiplier = before[size]
+        price = self._price(multiplier, multiplier_count, fixed, quantity)
+
+        alternatives = []
+        for i, (evaluator, options, (value, modifier)) in enumerate(
+                zip(self.evaluators, self._option_tables(), terms)):
+            current = None if value is None else str(value)
+            if evaluator.kind == MULTIPLIER:
+                others = before[i] * after[i + 1]
+                count = multiplier_count - (value is not None) + 1
+                prices = [(option, self._price(others * option_modifier, count, fixed, quantity))
+                          for option, option_modifier in options.items() if option != current]
+            elif evaluator.kind == FIXED:
+                others = fixed - modifier if value is not None else fixed
+                prices = [(option, self._price(multiplier, multiplier_count, others + option_modifier, quantity))
+                          for option, option_modifier in options.items() if option != current]
+            else:
+                continue
+            alternatives.append((evaluator, value, prices))
+        return price, alternatives
+
+    def itemize(self, breakdown):
+        """
+        Turn a recorded breakdown into per-parameter costs.
+
+        The quantity line costs base_price * quantity. Multipliers are
+        attributed in catalog order as the increase they cause, and fixed
+        amounts as modifier * quantity, so before the zero floor the lines
+        add up to the total (plus base_price when no quantity is given).
+        """
+        quantity = ONE
+        for evaluator, value, modifier in breakdown:
+            if evaluator.kind == QUANTITY:
+                quantity = modifier
+
+        subtotal = self.base_price
+        lines = []
+        for evaluator, value, modifier in breakdown:
+            kind = evaluator.kind
+            if kind == QUANTITY:
+                cost = self.base_price * quantity
+            elif kind == MULTIPLIER:
+                cost = subtotal * (modifier - ONE) * quantity
+                subtotal *= modifier
+            elif kind == FIXED:
+                cost = modifier * quantity
+            else:
+                cost = ZERO
+            lines.append({
+                'parameter': evaluator.name,
+                'type': kind,
+                'value': value,
+                'modifier': modifier,
+                'cost': cost
+            })
+        return lines
+
+    def evaluate_many(self, params_list):
+        """
+        Price many parameter sets at once.
+
+        Each parameter is resolved column-wise into multiplier, fixed and
+        quantity arrays and the totals are computed for the whole group.
+        Returns a list of (price, error message) tuples in input order.
+        """
+        size = len(params_list)
+        errors = [None] * size
+        multipliers = [ONE] * size
+        fixed = [ZERO] * size
+        quantities = [ONE] * size
+
+        for i, params in enumerate(params_list):
+            if not isinstance(params, dict):
+                errors[i] = "Parameters must be an object"
+
+        for evaluator in self.evaluators:
+            kind = evaluator.kind
+            for i, params in enumerate(params_list):
+                if errors[i] is not None:
+                    continue
+                try:
+                    value, modifier = evaluator.resolve(params)
+                except PricingError as e:
+                    errors[i] = str(e)
+                    continue
+                if value is None:
+                    continue
+                if kind == MULTIPLIER:
+                    multipliers[i] *= modifier
+                elif kind == FIXED:
+                    fixed[i] += modifier
+                elif kind == QUANTITY:
+                    quantities[i] = modifier
+
+        base_price = self.base_price
+        return [
+            (None, error) if error is not None
+            else (max((base_price * multiplier + fixed_amount) * quantity, ZERO), None)
+            for multiplier, fixed_amount, quantity, error
+            in zip(multipliers, fixed, quantities, errors)
+        ]
+
+
+def round_price(price, rounding=None):
+    """
+    Round a Decimal price to minor units the way the integer engine does.
+    """
+    return price.quantize(CENTS, rounding=rounding or ROUNDING)
+
+
+def _scaled(value):
+    """
+    ``value`` (a Decimal) as an integer scaled by SCALE, or None when it has
+    more than SCALE_DIGITS decimals.
+    """
+    sign, digits, exponent = value.as_tuple()
+    if not isinstance(exponent, int) or exponent < -SCALE_DIGITS:
+        return None
+    number = int(''.join(map(str, digits)) or 0) * 10 ** (exponent + SCALE_DIGITS)
+    return -number if sign else number
+
+
+def _parse_quantity(value, name):
+    """
+    Parse a quantity into an exact (integer, decimal exponent) pair, i.e.
+    value == integer * 10 ** -exponent. Quantities needing more than
+    QUANTITY_DIGITS digits or decimals are rejected, so a quote never
+    builds huge integers.
+    """
+    if isinstance(value, int) and not isinstance(value, bool):
+        if -QUANTITY_LIMIT < value < QUANTITY_LIMIT:
+            return value, 0
+        raise PricingError(f"Quantity for parameter '{name}' is out of range")
+    if isinstance(value, str) and value.isascii() and value.isdecimal() and len(value) <= QUANTITY_DIGITS:
+        return int(value), 0
+    try:
+        sign, digits, exponent = Decimal(str(value)).as_tuple()
+    except InvalidOperation:
+        raise PricingError(f"Invalid quantity '{value}' for parameter '{name}'")
+    if not isinstance(exponent, int):
+        raise PricingError(f"Invalid quantity '{value}' for parameter '{name}'")
+    # Trailing zeros only move the exponent: 1.000 == 1, 1E+2 == 100
+    coefficient = ''.join(map(str, digits))
+    significant = coefficient.rstrip('0')
+    if not significant:
+        return 0, 0
+    exponent += len(coefficient) - len(significant)
+    if len(significant) + max(exponent, 0) > QUANTITY_DIGITS or exponent < -QUANTITY_DIGITS:
+        raise PricingError(f"Quantity for parameter '{name}' is out of range")
+    number = int(significant)
+    if sign:
+        number = -number
+    if exponent > 0:
+        return number * 10 ** exponent, 0
+    return number, -exponent
+
+
+def _round_division(numerator, denominator, rounding):
+    """
+    numerator / denominator rounded to an integer, for numerator >= 0.
+    """
+    quotient, remainder = divmod(numerator, denominator)
+    if not remainder or rounding == decimal.ROUND_DOWN:
+        return quotient
+    if rounding == decimal.ROUND_UP:
+        return quotient + 1
+    twice = remainder * 2
+    if twice > denominator:
+        return quotient + 1
+    if twice == denominator and (rounding == decimal.ROUND_HALF_UP or quotient % 2):
+        return quotient + 1
+    return quotient
+
+
+def _unscaled(kind, modifier):
+    """
+    The Decimal of a modifier as IntegerPricingPlan._resolve() returns it.
+    """
+    if kind == QUANTITY:
+        number, exponent = modifier
+        return Decimal(number).scaleb(-exponent)
+    return Decimal(modifier).scaleb(-SCALE_DIGITS)
+
+
+def _from_minor(units):
+    return Decimal(f'{units // 100}.{units % 100:02d}')
+
+
+class IntegerPricingPlan(PricingPlan):
+    """
+    PricingPlan evaluated in scaled integer arithmetic. Results are Decimals
+    rounded to minor units; breakdowns and itemize() are the same as for
+    the Decimal plan.
+    """
+    __slots__ = ('base_scaled', 'scaled_options', 'rounding')
+
+    _ONE = 1
+    _ZERO = 0
+    _UNIT = (1, 0)
+
+    def __init__(self, service_id, base_price, evaluators, base_scaled, scaled_options, rounding=None):
+        super().__init__(service_id, base_price, evaluators)
+        self.base_scaled = base_scaled
+        self.scaled_options = scaled_options  # per evaluator: option value -> scaled modifier
+        self.rounding = rounding or ROUNDING
+
+    @classmethod
+    def compile(cls, service, rounding=None):
+        """
+        Build an integer plan, or a Decimal PricingPlan when some price or
+        modifier has more decimals than the integer scale can hold exactly.
+        """
+        plan = PricingPlan.compile(service)
+        base_scaled = _scaled(plan.base_price)
+        scaled_options = []
+        for evaluator in plan.evaluators:
+            options = {value: _scaled(modifier) for value, modifier in evaluator.options.items()}
+            if None in options.values():
+                return plan
+            scaled_options.append(options)
+        if base_scaled is None:
+            return plan
+        return cls(plan.service_id, plan.base_price, plan.evaluators, base_scaled,
+                   tuple(scaled_options), rounding)
+
+    def _resolve(self, evaluator, options, params):
+        """
+        Like ParameterEvaluator.resolve(), with the modifier as a scaled
+        integer, or as an (integer, exponent) pair for quantities.
+        """
+        value = params.get(evaluator.name, evaluator.default_value)
+        if value is None:
+            if evaluator.is_required:
+                raise PricingError(f"Required parameter '{evaluator.name}' is missing")
+            return None, None
+        if evaluator.kind == QUANTITY:
+            return value, _parse_quantity(value, evaluator.name)
+        modifier = options.get(str(value))
+        if modifier is None:
+            raise PricingError(f"Invalid value '{value}' for parameter '{evaluator.name}'")
+        return value, modifier
+
+    def _total(self, multipliers, multiplier_count, fixed, quantity, quantity_exponent):
+        # base * product(multipliers) carries SCALE ** (1 + multiplier_count)
+        exponent = SCALE_DIGITS * (1 + multiplier_count)
+        total = (self.base_scaled * multipliers + fixed * 10 ** (exponent - SCALE_DIGITS)) * quantity
+        exponent += quantity_exponent
+        if total <= 0:
+            return _from_minor(0)
+        return _from_minor(_round_division(total, 10 ** (exponent - MINOR_DIGITS), self.rounding))
+
+    def _option_tables(self):
+        return self.scaled_options
+
+    def _resolve_terms(self, params):
+        return [self._resolve(evaluator, options, params)
+                for evaluator, options in zip(self.evaluators, self.scaled_options)]
+
+    def _price(self, multiplier, multiplier_count, fixed, quantity):
+        return self._total(multiplier, multiplier_count, fixed, *quantity)
+
+    def evaluate(self, params, breakdown=None):
+        multipliers = 1
+        multiplier_count = 0
+        fixed = 0
+        quantity, quantity_exponent = 1, 0
+        for evaluator, options in zip(self.evaluators, self.scaled_options):
+            value, modifier = self._resolve(evaluator, options, params)
+            if value is None:
+                continue
+            kind = evaluator.kind
+            if kind == MULTIPLIER:
+                multipliers *= modifier
+                multiplier_count += 1
+            elif kind == FIXED:
+                fixed += modifier
+            elif kind == QUANTITY:
+                quantity, quantity_exponent = modifier
+            if breakdown is not None:
+                breakdown.append((evaluator, value, _unscaled(kind, modifier)))
+        return self._total(multipliers, multiplier_count, fixed, quantity, quantity_exponent)
+
+    def evaluate_many(self, params_list):
+        size = len(params_list)
+        errors = [None] * size
+        multipliers = [1] * size
+        counts = [0] * size
+        fixed = [0] * size
+        quantities = [(1, 0)] * size
+
+        for i, params in enumerate(params_list):
+            if not isinstance(params, dict):
+                errors[i] = "Parameters must be an object"
+
+        for evaluator, options in zip(self.evaluators, self.scaled_options):
+            kind = evaluator.kind
+            for i, params in enumerate(params_list):
+                if errors[i] is not None:
+                    continue
+                try:
+                    value, modifier = self._resolve(evaluator, options, params)
+                except PricingError as e:
+                    errors[i] = str(e)
+                    continue
+                if value is None:
+                    continue
+                if kind == MULTIPLIER:
+                    multipliers[i] *= modifier
+                    counts[i] += 1
+                elif kind == FIXED:
+                    fixed[i] += modifier
+                elif kind == QUANTITY:
+                    quantities[i] = modifier
+
+        return [
+            (None, error) if error is not None
+            else (self._total(multiplier, count, fixed_amount, *quantity), None)
+            for multiplier, count, fixed_amount, quantity, error
+            in zip(multipliers, counts, fixed, quantities, errors)
+        ]
+
+
+def compile_plan(service, engine=None):
+    """
+    Compile a catalog service with the configured pricing engine.
+    """
+    engine = engine or ENGINE
+    if engine == 'integer':
+        return IntegerPricingPlan.compile(service)
+    if engine == 'decimal':
+        return PricingPlan.compile(service)
+    raise ValueError(f"Unknown PRICING_ENGINE {engine!r}, expected 'integer' or 'decimal'")
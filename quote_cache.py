@@ -0,0 +1,130 @@
+"""
+Memoization of quote results.
+
+Most traffic repeats the same few hundred configurations, so evaluated
+prices are kept in a bounded LRU with a TTL. Keys contain the catalog
+version, which means entries can never outlive a catalog change. Concurrent
+requests for the same key are coalesced: one thread computes, the others
+wait for its result.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+def canonical_params(service, params):
+    """
+    Canonical, hashable form of ``params`` for a compiled service.
+
+    Only the service's own parameters are kept, in catalog order, with
+    defaults from Parameter.default_value filled in. Non-string values keep
+    their type so that e.g. ``2`` and ``"2"`` never share an entry.
+    """
+    values = []
+    for parameter in service.parameters:
+        value = params.get(parameter.name, parameter.default_value)
+        if value is None:
+            continue
+        if not isinstance(value, str):
+            value = (type(value).__name__, value)
+        values.append((parameter.name, value))
+    return tuple(values)
+
+
+class _Flight(object):
+    __slots__ = ('event', 'value', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class QuoteCache(object):
+    def __init__(self, max_size=None, ttl=None):
+        if max_size is None:
+            max_size = int(os.environ.get('QUOTE_CACHE_SIZE', 10000))
+        if ttl is None:
+            ttl = float(os.environ.get('QUOTE_CACHE_TTL', 300))
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get_or_compute(self, key, compute):
+        """
+        Return the cached value for ``key`` or call ``compute()`` once to
+        produce it. Exceptions are not cached.
+        """
+        if self.max_size <= 0:
+            return compute()
+        try:
+            hash(key)
+        except TypeError:
+            return compute()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+                self.expirations += 1
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            value = compute()
+        except Exception as e:
+            flight.error = e
+            raise
+        else:
+            flight.value = value
+            with self._lock:
+                self._entries[key] = (time.monotonic() + self.ttl, value)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+            return value
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            flight.event.set()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'capacity': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+
+quote_cache = QuoteCache()
@@ -0,0 +1,120 @@
+"""
+Conditional, cached responses for catalog reads.
+
+Catalog reads such as GET /services return the same bytes until the
+catalog changes, so their serialized body is cached per catalog version
+(and query arguments) in a bounded LRU. Responses carry an ETag. A client
+that sends it back in If-None-Match gets a 304, without any query or
+serialization once the body of the current version has been cached.
+
+The ETag is a hash of the body rather than the version number: without the
+shared snapshot every worker counts catalog versions on its own, so the
+same number can stand for different contents in two workers.
+
+Bodies are encoded with orjson when it is installed (FAST_JSON=0 uses the
+standard library), and bodies of at least GZIP_MIN_SIZE bytes are gzipped
+once when cached, for clients that accept gzip.
+"""
+import gzip
+import hashlib
+import json
+import os
+
+from flask import Response, request
+from flask.json.provider import DefaultJSONProvider
+
+from metrics import timed
+from quote_cache import QuoteCache
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+FAST_JSON = orjson is not None and os.environ.get('FAST_JSON', '1') == '1'
+GZIP_MIN_SIZE = int(os.environ.get('GZIP_MIN_SIZE', 1024))
+
+# Same output conventions as jsonify: sorted keys, compact, Decimal as string, HTTP dates
+_default = DefaultJSONProvider.default
+if orjson is not None:
+    _ORJSON_OPTIONS = orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+
+def dumps(obj):
+    """
+    Encode ``obj`` as JSON bytes.
+    """
+    if FAST_JSON:
+        return orjson.dumps(obj, default=_default, option=_ORJSON_OPTIONS)
+    return json.dumps(obj, default=_default, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+def dumps_text(obj):
+    return dumps(obj).decode('utf-8')
+
+
+class CachedBody(object):
+    __slots__ = ('body', 'etag', 'gzipped', 'headers')
+
+    def __init__(self, body, headers=None):
+        self.body = body
+        self.etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+        self.gzipped = gzip.compress(body, 6, mtime=0) if len(body) >= GZIP_MIN_SIZE else None
+        self.headers = headers or {}
+
+
+body_cache = QuoteCache(
+    max_size=int(os.environ.get('READ_CACHE_SIZE', 256)),
+    ttl=float(os.environ.get('READ_CACHE_TTL', 3600)))
+
+
+def cached_json(key, version, build, headers=None):
+    """
+    CachedBody of ``build()`` (a JSON serializable value) for catalog
+    ``version``. ``headers`` may be a callable taking the built value.
+    """
+    def compute():
+        value = build()
+        with timed('serialize'):
+            body = dumps(value)
+        return CachedBody(body, headers(value) if callable(headers) else headers)
+    return body_cache.get_or_compute((key, version), compute)
+
+
+def accepts_gzip():
+    return request.accept_encodings['gzip'] > 0
+
+
+def conditional_response(etag, body=None, gzipped=None, headers=None, mimetype='application/json'):
+    """
+    Build the response for a body with a known ETag: 304 when the client
+    already has it, gzipped when both sides allow, otherwise ``body``.
+    ``body`` may be a callable producing it (or an iterable of chunks), so
+    a 304 never pays for it.
+    """
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        if gzipped is not None and accepts_gzip():
+            response = Response(gzipped, mimetype=mimetype)
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response = Response(body() if callable(body) else body, mimetype=mimetype)
+        if gzipped is not None:
+            response.vary.add('Accept-Encoding')
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    if headers:
+        response.headers.update(headers)
+    return response
+
+
+def cached_response(entry):
+    return conditional_response(entry.etag, entry.body, entry.gzipped, entry.headers)
+
+
+def etag_of(*parts):
+    """
+    ETag for a response fully determined by ``parts`` (their repr).
+    """
+    return hashlib.blake2b(repr(parts).encode('utf-8'), digest_size=16).hexdigest()
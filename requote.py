@@ -0,0 +1,330 @@
+"""
+Re-quote stored calculations against the current catalog.
+
+After a change to base prices or option modifiers, this shows how the
+stored quotes would price now:
+
+    python requote.py --output requote/                      # every calculation
+    python requote.py --output requote/ --service-id 3 --start 2025-01-01
+    python requote.py --output requote/ --resume             # continue an interrupted run
+
+The history is read in keyset chunks (see history.iter_calculation_chunks)
+and each chunk is decoded and priced by a pool of worker processes, each of
+which compiles the catalog once when it starts. Only a few chunks are in
+flight at a time, so memory does not depend on the size of the table.
+
+The output directory gets
+
+- diff.ndjson: one line per quote whose price changed or that can no
+  longer be priced (every quote with --all), with old and new price;
+- summary.json: per service and in total, the number of quotes, changed
+  and failed ones, old and new totals, delta minimum/maximum and the
+  distribution of relative deltas;
+- checkpoint.json: the position of the last completed chunk with the
+  summary so far, written after every chunk. --resume continues from it,
+  truncating diff.ndjson to what the checkpoint covers.
+"""
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import sys
+from collections import deque
+from decimal import Decimal
+
+from models import database, router
+from history import decode_input_params, iter_calculation_chunks, row_key
+from pricing import round_price
+
+CENTS = Decimal('0.01')
+# Upper bounds (percent) of the relative delta buckets; larger deltas go to '>50%'
+DELTA_BUCKETS = (-50, -20, -10, -5, -1, 0, 1, 5, 10, 20, 50)
+DIFF_FILE = 'diff.ndjson'
+SUMMARY_FILE = 'summary.json'
+CHECKPOINT_FILE = 'checkpoint.json'
+
+_services = None  # compiled catalog of this worker
+
+
+class RequoteError(Exception):
+    pass
+
+
+def delta_bucket(old_price, delta):
+    if not old_price:
+        return 'from 0'
+    percent = delta * 100 / old_price
+    for bound in DELTA_BUCKETS:
+        if percent <= bound:
+            return f'<={bound}%'
+    return f'>{DELTA_BUCKETS[-1]}%'
+
+
+def load_catalog():
+    """
+    Compile the current catalog into this process. Reads the primary, so a
+    run started right after a catalog change sees it.
+    """
+    global _services
+    from catalog import _fetch
+    with router.use_primary():
+        _services = _fetch()
+    database.close()
+
+
+def requote_chunk(rows):
+    """
+    Price a chunk of (id, service_id, timestamp, input_params, parameter set,
+    old price) tuples against the worker's catalog. Returns (id, service_id,
+    timestamp, old price, new price or None, error or None) tuples.
+    """
+    if _services is None:
+        load_catalog()
+    results = [None] * len(rows)
+    groups = {}
+    for index, (id, service_id, timestamp, input_params, parameters, old_price) in enumerate(rows):
+        old_price = Decimal(str(old_price)).quantize(CENTS)
+        try:
+            params = decode_input_params(service_id, input_params, parameters).get('parameters', {})
+        except (ValueError, AttributeError):
+            results[index] = (id, service_id, timestamp, old_price, None, 'Undecodable input parameters')
+            continue
+        results[index] = (id, service_id, timestamp, old_price, None, None)
+        groups.setdefault(service_id, []).append((index, params))
+
+    for service_id, items in groups.items():
+        service = _services.get(service_id)
+        if service is None:
+            priced = [(None, f'Service {service_id} no longer exists')] * len(items)
+        else:
+            priced = service.plan.evaluate_many([params for _, params in items])
+        for (index, _), (price, error) in zip(items, priced):
+            id, service_id, timestamp, old_price, _, _ = results[index]
+            new_price = None if error is not None else round_price(price)
+            results[index] = (id, service_id, timestamp, old_price, new_price, error)
+    return results
+
+
+class ServiceDiff(object):
+    def __init__(self, quotes=0, unchanged=0, changed=0, errors=0, old_total='0', new_total='0',
+                 delta_min=None, delta_max=None, distribution=None):
+        self.quotes = quotes
+        self.unchanged = unchanged
+        self.changed = changed
+        self.errors = errors
+        self.old_total = Decimal(old_total)
+        self.new_total = Decimal(new_total)
+        self.delta_min = None if delta_min is None else Decimal(delta_min)
+        self.delta_max = None if delta_max is None else Decimal(delta_max)
+        self.distribution = distribution or {}
+
+    def add(self, old_price, new_price):
+        self.quotes += 1
+        if new_price is None:
+            self.errors += 1
+            return
+        delta = new_price - old_price
+        self.old_total += old_price
+        self.new_total += new_price
+        if delta:
+            self.changed += 1
+            bucket = delta_bucket(old_price, delta)
+            self.distribution[bucket] = self.distribution.get(bucket, 0) + 1
+        else:
+            self.unchanged += 1
+        if self.delta_min is None or delta < self.delta_min:
+            self.delta_min = delta
+        if self.delta_max is None or delta > self.delta_max:
+            self.delta_max = delta
+
+    def merge(self, other):
+        merged = ServiceDiff(**self.to_dict())
+        merged.quotes += other.quotes
+        merged.unchanged += other.unchanged
+        merged.changed += other.changed
+        merged.errors += other.errors
+        merged.old_total += other.old_total
+        merged.new_total += other.new_total
+        for attribute, pick in (('delta_min', min), ('delta_max', max)):
+            values = [v for v in (getattr(merged, attribute), getattr(other, attribute)) if v is not None]
+            setattr(merged, attribute, pick(values) if values else None)
+        for bucket, count in other.distribution.items():
+            merged.distribution[bucket] = merged.distribution.get(bucket, 0) + count
+        return merged
+
+    def to_dict(self):
+        return {
+            'quotes': self.quotes,
+            'unchanged': self.unchanged,
+            'changed': self.changed,
+            'errors': self.errors,
+            'old_total': str(self.old_total),
+            'new_total': str(self.new_total),
+            'delta_min': None if self.delta_min is None else str(self.delta_min),
+            'delta_max': None if self.delta_max is None else str(self.delta_max),
+            'distribution': dict(self.distribution),
+        }
+
+
+def diff_line(id, service_id, timestamp, old_price, new_price, error):
+    line = {'id': id, 'service_id': service_id, 'timestamp': timestamp, 'old_price': str(old_price)}
+    if error is not None:
+        line['error'] = error
+    else:
+        line['new_price'] = str(new_price)
+        line['delta'] = str(new_price - old_price)
+    return json.dumps(line)
+
+
+def _write_json(path, value):
+    # Written next to the target and renamed, so a crash never leaves half a file
+    with open(path + '.tmp', 'w') as f:
+        json.dump(value, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def _chunks(options, after, chunk_size):
+    start, end = (None if options[key] is None else datetime.datetime.fromisoformat(options[key])
+                  for key in ('start', 'end'))
+    for rows in iter_calculation_chunks(options['service_id'], start, end, chunk_size, router.reader(), after):
+        yield ([(row[0], row[2], row[3].isoformat(), row[4], row[5], row[6]) for row in rows], row_key(rows[-1]))
+
+
+def run(output_dir, service_id=None, start=None, end=None, workers=None, chunk_size=1000,
+        include_unchanged=False, resume=False, max_chunks=None, log=print):
+    """
+    Re-quote the calculations selected by ``service_id``, ``start`` and
+    ``end`` (ISO strings) with ``workers`` processes (0 prices in this
+    process). ``max_chunks`` stops after that many chunks, to be continued
+    with ``resume``. Returns the summary dict written to summary.json.
+    """
+    options = {'service_id': service_id, 'start': start, 'end': end, 'include_unchanged': include_unchanged}
+    os.makedirs(output_dir, exist_ok=True)
+    diff_path = os.path.join(output_dir, DIFF_FILE)
+    checkpoint_path = os.path.join(output_dir, CHECKPOINT_FILE)
+
+    after = None
+    rows_done = 0
+    services = {}
+    diff_offset = 0
+    if resume:
+        if not os.path.exists(checkpoint_path):
+            raise RequoteError(f'No checkpoint in {output_dir} to resume from')
+        with open(checkpoint_path) as f:
+            checkpoint = json.load(f)
+        if checkpoint['options'] != options:
+            raise RequoteError(f"The checkpoint was written with different options: {checkpoint['options']}")
+        if checkpoint['after'] is not None:
+            service, timestamp, id = checkpoint['after']
+            after = (service, datetime.datetime.fromisoformat(timestamp), id)
+        rows_done = checkpoint['rows']
+        services = {int(k): ServiceDiff(**v) for k, v in checkpoint['services'].items()}
+        diff_offset = checkpoint['diff_offset']
+        if checkpoint['done']:
+            log(f'already complete: {rows_done} calculations')
+            return write_summary(output_dir, options, rows_done, services)
+        log(f'resuming after {rows_done} calculations')
+
+    def save_checkpoint(done):
+        _write_json(checkpoint_path, {
+            'options': options,
+            'after': None if after is None else [after[0], after[1].isoformat(), after[2]],
+            'rows': rows_done,
+            'services': {str(k): v.to_dict() for k, v in services.items()},
+            'diff_offset': diff_offset,
+            'done': done,
+        })
+
+    workers = os.cpu_count() if workers is None else workers
+    # Connections must not be shared with forked workers
+    if hasattr(database, 'close_all'):
+        database.close_all()
+    elif not database.is_closed():
+        database.close()
+    router.close_all()
+    pool = multiprocessing.Pool(workers, initializer=load_catalog) if workers else None
+
+    with open(diff_path, 'a+') as diff:
+        diff.truncate(diff_offset)
+        diff.seek(diff_offset)
+        try:
+            pending = deque()
+            chunks = _chunks(options, after, chunk_size)
+            submitted = 0
+            while True:
+                # Keep every worker busy with at most two chunks each
+                while (max_chunks is None or submitted < max_chunks) and len(pending) < max(1, workers) * 2:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+                    rows, key = chunk
+                    result = pool.apply_async(requote_chunk, (rows,)) if pool else requote_chunk(rows)
+                    pending.append((result, key))
+                    submitted += 1
+                if not pending:
+                    break
+                result, key = pending.popleft()
+                for id, service, timestamp, old_price, new_price, error in (result.get() if pool else result):
+                    services.setdefault(service, ServiceDiff()).add(old_price, new_price)
+                    if error is not None or new_price != old_price or include_unchanged:
+                        diff.write(diff_line(id, service, timestamp, old_price, new_price, error) + '\n')
+                    rows_done += 1
+                diff.flush()
+                diff_offset = diff.tell()
+                after = key
+                save_checkpoint(False)
+                log(f'{rows_done} calculations re-quoted')
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    done = max_chunks is None or submitted < max_chunks
+    save_checkpoint(done)
+    return write_summary(output_dir, options, rows_done, services)
+
+
+def write_summary(output_dir, options, rows, services):
+    total = ServiceDiff()
+    for diff in services.values():
+        total = total.merge(diff)
+    summary = {
+        'options': options,
+        'calculations': rows,
+        'total': total.to_dict(),
+        'services': [dict(service_id=service_id, **services[service_id].to_dict())
+                     for service_id in sorted(services)],
+    }
+    _write_json(os.path.join(output_dir, SUMMARY_FILE), summary)
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Re-quote stored calculations against the current catalog')
+    parser.add_argument('--output', required=True, help='directory for the diff, summary and checkpoint')
+    parser.add_argument('--service-id', type=int, help='only re-quote this service')
+    parser.add_argument('--start', help='only calculations at or after this ISO timestamp')
+    parser.add_argument('--end', help='only calculations before this ISO timestamp')
+    parser.add_argument('--workers', type=int, help='worker processes (default: CPU count, 0 = none)')
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--all', action='store_true', help='write unchanged quotes to the diff too')
+    parser.add_argument('--resume', action='store_true', help='continue from the checkpoint in --output')
+    parser.add_argument('--max-chunks', type=int, help='stop after this many chunks (continue with --resume)')
+    args = parser.parse_args(argv)
+
+    try:
+        summary = run(args.output, args.service_id, args.start, args.end, args.workers, args.chunk_size,
+                      args.all, args.resume, args.max_chunks)
+    except RequoteError as e:
+        print(f'requote failed: {e}', file=sys.stderr)
+        return 1
+    print(f"{'service':>8} {'quotes':>8} {'changed':>8} {'errors':>7} {'old total':>14} {'new total':>14}")
+    for line in summary['services'] + [dict(service_id='total', **summary['total'])]:
+        print(f"{line['service_id']:>8} {line['quotes']:>8} {line['changed']:>8} {line['errors']:>7} "
+              f"{line['old_total']:>14} {line['new_total']:>14}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
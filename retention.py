@@ -0,0 +1,356 @@
+"""
+Retention and archival of the calculation history.
+
+Calculations older than RETENTION_MONTHS whole months are moved out of
+price_calculations into gzip NDJSON files, one per month
+(ARCHIVE_DIR/price_calculations-YYYY-MM.ndjson.gz). The job works in
+chunks of RETENTION_CHUNK_SIZE rows in id order: a chunk is appended to its
+month file(s) as a new gzip member and fsynced, then deleted in a short
+transaction of its own, so no lock is held for longer than one chunk. If
+the delete fails the appended data is truncated again; only a crash between
+the two steps can leave a chunk both archived and in the table, to be
+archived a second time on the next run (rows keep their id and uid).
+
+On MySQL the table can also be range-partitioned by month (see
+``python retention.py partition-ddl``). The job then keeps partitions for
+the coming months and drops old partitions once they have been archived,
+which gives the space back immediately.
+
+Rollups (see rollups.py) are not touched, so statistics survive retention.
+
+Run it with RETENTION_ENABLED=1 (a background thread in one gunicorn worker
+per master, see gunicorn.conf.py; a lock file in ARCHIVE_DIR keeps runs on
+the same host apart) or from cron with ``python retention.py run``. The
+lock does not reach across hosts or containers: with several of them,
+enable the thread in none and run the cron job from one place.
+"""
+import argparse
+import datetime
+import fcntl
+import gzip
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+
+from peewee import MySQLDatabase
+from models import database, PriceCalculation
+from history import calculation_dict, select_calculations
+
+log = logging.getLogger('pricing.retention')
+
+TABLE = PriceCalculation._meta.table_name
+ARCHIVE_PATTERN = re.compile(r'^price_calculations-(\d{4}-\d{2})\.ndjson\.gz$')
+PARTITION_PATTERN = re.compile(r'^p(\d{4})(\d{2})$')
+
+
+def month_start(value):
+    return datetime.datetime(value.year, value.month, 1)
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return datetime.datetime(index // 12, index % 12 + 1, 1)
+
+
+def parse_month(text):
+    """
+    Parse 'YYYY-MM' into the first moment of that month.
+    """
+    try:
+        return datetime.datetime.strptime(text, '%Y-%m')
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid month {text!r}, expected YYYY-MM")
+
+
+def partition_name(month):
+    return month.strftime('p%Y%m')
+
+
+def _partition_clause(month):
+    return (f"PARTITION {partition_name(month)} VALUES LESS THAN "
+            f"(TO_DAYS('{add_months(month, 1):%Y-%m-%d}'))")
+
+
+def partition_ddl(first_month, months_ahead=3):
+    """
+    Statements converting price_calculations to monthly RANGE partitions,
+    from ``first_month`` (the oldest data) to ``months_ahead`` months ahead.
+    MySQL requires the partitioning column in every unique key and does not
+    allow foreign keys on partitioned tables, so the primary key becomes
+    (id, timestamp), the uid index stops being unique and the service
+    foreign key has to be dropped beforehand.
+    """
+    last = add_months(month_start(datetime.datetime.now()), months_ahead)
+    months = []
+    month = month_start(first_month)
+    while month <= last:
+        months.append(month)
+        month = add_months(month, 1)
+    partitions = ',\n    '.join([_partition_clause(m) for m in months] + ['PARTITION pmax VALUES LESS THAN MAXVALUE'])
+    return [
+        f"-- Drop the service_id foreign key first, see SHOW CREATE TABLE {TABLE}",
+        f"ALTER TABLE {TABLE} DROP PRIMARY KEY, ADD PRIMARY KEY (id, timestamp), "
+        f"DROP INDEX price_calculations_uid, ADD INDEX price_calculations_uid (uid);",
+        f"ALTER TABLE {TABLE} PARTITION BY RANGE (TO_DAYS(timestamp)) (\n    {partitions}\n);",
+    ]
+
+
+def partitions():
+    """
+    Names of the table's partitions, empty when it is not partitioned.
+    """
+    if not isinstance(database, MySQLDatabase):
+        return []
+    cursor = database.execute_sql(
+        "SELECT PARTITION_NAME FROM information_schema.PARTITIONS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL "
+        "ORDER BY PARTITION_ORDINAL_POSITION", (TABLE,))
+    return [row[0] for row in cursor.fetchall()]
+
+
+class RetentionJob(object):
+    def __init__(self, retention_months=None, archive_dir=None, chunk_size=None, pause=None,
+                 interval=None, months_ahead=None, enabled=None):
+        env = os.environ.get
+        self.enabled = env('RETENTION_ENABLED', '0') == '1' if enabled is None else enabled
+        self.retention_months = (int(env('RETENTION_MONTHS', 12))
+                                 if retention_months is None else retention_months)
+        self.archive_dir = env('ARCHIVE_DIR', 'archive') if archive_dir is None else archive_dir
+        self.chunk_size = int(env('RETENTION_CHUNK_SIZE', 1000)) if chunk_size is None else chunk_size
+        self.pause = float(env('RETENTION_PAUSE', 0.05)) if pause is None else pause
+        self.interval = float(env('RETENTION_INTERVAL', 3600)) if interval is None else interval
+        self.months_ahead = int(env('PARTITION_MONTHS_AHEAD', 3)) if months_ahead is None else months_ahead
+        self._thread = None
+        self._pid = None
+        self._stopping = threading.Event()
+        self._start_lock = threading.Lock()
+        self.runs = 0
+        self.archived = 0
+        self.failures = 0
+        self.partitions_added = 0
+        self.partitions_dropped = 0
+        self.last_run = None
+        self.last_error = None
+
+    def cutoff(self, now=None):
+        """
+        Calculations before this moment are archived. Always the start of a
+        month, so every archive file holds whole months.
+        """
+        return add_months(month_start(now or datetime.datetime.now()), -self.retention_months)
+
+    def archive_path(self, month):
+        return os.path.join(self.archive_dir, f'price_calculations-{month:%Y-%m}.ndjson.gz')
+
+    def run_once(self, now=None):
+        """
+        Apply the policy once. Returns the number of archived calculations,
+        or None when another process is already running the job.
+        """
+        os.makedirs(self.archive_dir, exist_ok=True)
+        with open(os.path.join(self.archive_dir, '.retention.lock'), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return None
+            try:
+                names = partitions()
+                if 'pmax' in names:
+                    self.ensure_partitions(names, now)
+                archived = 0
+                if self.retention_months > 0:
+                    cutoff = self.cutoff(now)
+                    archived = self.archive_before(cutoff)
+                    if names:
+                        self.drop_partitions(names, cutoff)
+                self.runs += 1
+                self.last_run = datetime.datetime.now()
+                return archived
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def archive_before(self, cutoff):
+        PC = PriceCalculation
+        total = 0
+        while not self._stopping.is_set():
+            rows = list(select_calculations()
+                        .where(PC.timestamp < cutoff)
+                        .order_by(PC.id)
+                        .limit(self.chunk_size)
+                        .tuples())
+            if not rows:
+                break
+            by_month = {}
+            for row in rows:
+                by_month.setdefault(month_start(row[3]), []).append(row)
+
+            appended = {}
+            try:
+                for month, month_rows in sorted(by_month.items()):
+                    path = self.archive_path(month)
+                    appended[path] = os.path.getsize(path) if os.path.exists(path) else 0
+                    self._append(path, month_rows)
+                with database.atomic():
+                    PC.delete().where(PC.id.in_([row[0] for row in rows])).execute()
+            except Exception:
+                # Leave the archive as it was so the next run starts clean
+                for path, size in appended.items():
+                    os.truncate(path, size)
+                raise
+            total += len(rows)
+            self.archived += len(rows)
+            if self.pause:
+                time.sleep(self.pause)
+        return total
+
+    def _append(self, path, rows):
+        with open(path, 'ab') as f:
+            with gzip.GzipFile(fileobj=f, mode='wb') as archive:
+                for row in rows:
+                    archive.write((json.dumps(calculation_dict(*row)) + '\n').encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def ensure_partitions(self, names, now=None):
+        """
+        Split pmax so that partitions exist for the current and the next
+        ``months_ahead`` months. pmax is empty then, so this is quick.
+        """
+        current = month_start(now or datetime.datetime.now())
+        last = None
+        for name in names:
+            match = PARTITION_PATTERN.match(name)
+            if match:
+                month = datetime.datetime(int(match.group(1)), int(match.group(2)), 1)
+                last = month if last is None or month > last else last
+        month = current if last is None else max(current, add_months(last, 1))
+        while month <= add_months(current, self.months_ahead):
+            database.execute_sql(
+                f"ALTER TABLE {TABLE} REORGANIZE PARTITION pmax INTO "
+                f"({_partition_clause(month)}, PARTITION pmax VALUES LESS THAN MAXVALUE)")
+            self.partitions_added += 1
+            month = add_months(month, 1)
+
+    def drop_partitions(self, names, cutoff):
+        """
+        Drop monthly partitions before ``cutoff`` once archival emptied them.
+        """
+        for name in names:
+            match = PARTITION_PATTERN.match(name)
+            if not match or datetime.datetime(int(match.group(1)), int(match.group(2)), 1) >= cutoff:
+                continue
+            if database.execute_sql(f"SELECT 1 FROM {TABLE} PARTITION ({name}) LIMIT 1").fetchone():
+                continue
+            database.execute_sql(f"ALTER TABLE {TABLE} DROP PARTITION {name}")
+            self.partitions_dropped += 1
+
+    def ensure_started(self):
+        # Threads do not survive a fork, so start one per worker process.
+        if not self.enabled or (self._thread is not None and self._pid == os.getpid()):
+            return
+        with self._start_lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name='retention', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                with database.connection_context():
+                    self.run_once()
+                self.last_error = None
+            except Exception as e:
+                self.failures += 1
+                self.last_error = str(e)
+                log.error('retention: run failed: %s', e)
+            self._stopping.wait(self.interval)
+
+    def stop(self):
+        self._stopping.set()
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'retention_months': self.retention_months,
+            'runs': self.runs,
+            'archived': self.archived,
+            'failures': self.failures,
+            'partitions_added': self.partitions_added,
+            'partitions_dropped': self.partitions_dropped,
+            'last_run': self.last_run.isoformat() if self.last_run else None,
+            'last_error': self.last_error,
+        }
+
+    def archives(self):
+        """
+        List the archive files as {'month', 'size'} dicts, oldest first.
+        """
+        if not os.path.isdir(self.archive_dir):
+            return []
+        found = []
+        for name in sorted(os.listdir(self.archive_dir)):
+            match = ARCHIVE_PATTERN.match(name)
+            if match:
+                found.append({'month': match.group(1), 'size': os.path.getsize(os.path.join(self.archive_dir, name))})
+        return found
+
+    def iter_archive(self, month, service_id=None, start=None, end=None):
+        """
+        Stream the calculations of an archived month back as dicts, in the
+        export format, optionally filtered like /calculations/export.
+        Raises FileNotFoundError when the month has no archive.
+        """
+        path = self.archive_path(parse_month(month))
+        with gzip.open(path, 'rt', encoding='utf-8') as archive:
+            for line in archive:
+                row = json.loads(line)
+                if service_id is not None and row['service_id'] != service_id:
+                    continue
+                if start is not None or end is not None:
+                    timestamp = datetime.datetime.fromisoformat(row['timestamp'])
+                    if (start is not None and timestamp < start) or (end is not None and timestamp >= end):
+                        continue
+                yield row
+
+
+retention_job = RetentionJob()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Calculation history retention')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help='archive and delete calculations past the retention period')
+    run_parser.add_argument('--months', type=int, help='override RETENTION_MONTHS')
+    ddl_parser = commands.add_parser('partition-ddl', help='print the MySQL statements to partition the table')
+    ddl_parser.add_argument('--from', dest='first_month', required=True, help='oldest month, YYYY-MM')
+    ddl_parser.add_argument('--months-ahead', type=int, default=3)
+    cat_parser = commands.add_parser('cat', help='print an archived month as NDJSON')
+    cat_parser.add_argument('month', help='YYYY-MM')
+    cat_parser.add_argument('--service-id', type=int)
+    args = parser.parse_args(argv)
+
+    if args.command == 'partition-ddl':
+        print('\n'.join(partition_ddl(parse_month(args.first_month), args.months_ahead)))
+    elif args.command == 'cat':
+        for row in retention_job.iter_archive(args.month, args.service_id):
+            sys.stdout.write(json.dumps(row) + '\n')
+    else:
+        if args.months is not None:
+            retention_job.retention_months = args.months
+        archived = retention_job.run_once()
+        if archived is None:
+            print('retention job is already running elsewhere')
+            return 1
+        print(f"archived {archived} calculations before {retention_job.cutoff():%Y-%m-%d}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
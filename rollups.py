@@ -0,0 +1,222 @@
+"""
+Incrementally maintained calculation rollups.
+
+Every batch of PriceCalculation rows is folded into calculation_rollups
+(count, sum, min and max of calculated_price per service and per hour/day
+bucket), so reports read a few rows per bucket instead of scanning the
+history. Synchronous inserts update them right after committing, in a
+transaction of their own; in write-behind mode a whole flushed batch
+becomes one upsert per touched bucket, in the flush's transaction.
+
+Existing history is loaded with the backfill command:
+
+    python rollups.py backfill [--service-id ID]
+
+It rebuilds the rollups of one service at a time from the history, in one
+transaction per service; run it when few calculations are being written,
+since rows inserted while a service is being rebuilt may be counted twice
+or not at all. Only buckets from the oldest calculation still in the table
+on are rebuilt: older ones cover history that retention.py has archived,
+and are kept as they are (do not run it while retention is archiving).
+"""
+import argparse
+import datetime
+import os
+import sys
+from decimal import Decimal
+
+from peewee import Case, EXCLUDED, MySQLDatabase, fn
+from models import database, CalculationRollup, PriceCalculation, Service
+
+PERIODS = ('hour', 'day')
+ENABLED = os.environ.get('ROLLUPS_ENABLED', '1') == '1'
+
+
+def bucket_start(timestamp, period):
+    if period == 'hour':
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    if period == 'day':
+        return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+    raise ValueError(f"Unknown period {period!r}, expected one of {', '.join(PERIODS)}")
+
+
+def aggregate(rows, aggregates=None):
+    """
+    Fold (service_id, timestamp, price) tuples into
+    {(service_id, period, bucket): [count, total, min, max]}.
+    """
+    aggregates = {} if aggregates is None else aggregates
+    for service_id, timestamp, price in rows:
+        price = Decimal(str(price))
+        for period in PERIODS:
+            key = (service_id, period, bucket_start(timestamp, period))
+            entry = aggregates.get(key)
+            if entry is None:
+                aggregates[key] = [1, price, price, price]
+            else:
+                entry[0] += 1
+                entry[1] += price
+                if price < entry[2]:
+                    entry[2] = price
+                if price > entry[3]:
+                    entry[3] = price
+    return aggregates
+
+
+def _to_rows(aggregates):
+    return [
+        {
+            'service': service_id,
+            'period': period,
+            'bucket': bucket,
+            'count': count,
+            'total': total,
+            'min_price': low,
+            'max_price': high,
+        }
+        for (service_id, period, bucket), (count, total, low, high) in aggregates.items()
+    ]
+
+
+def _upsert(rows):
+    R = CalculationRollup
+    if isinstance(database, MySQLDatabase):
+        # ON DUPLICATE KEY UPDATE has no conflict target and spells EXCLUDED as VALUES()
+        incoming = fn.VALUES
+        conflict_target = None
+    else:
+        incoming = lambda field: getattr(EXCLUDED, field.column_name)
+        conflict_target = [R.service, R.period, R.bucket]
+    update = {
+        R.count: R.count + incoming(R.count),
+        R.total: R.total + incoming(R.total),
+        R.min_price: Case(None, [(incoming(R.min_price) < R.min_price, incoming(R.min_price))], R.min_price),
+        R.max_price: Case(None, [(incoming(R.max_price) > R.max_price, incoming(R.max_price))], R.max_price),
+    }
+    R.insert_many(rows).on_conflict(conflict_target=conflict_target, update=update).execute()
+
+
+def update_rollups(rows):
+    """
+    Add freshly inserted calculation rows (dicts with service, timestamp and
+    calculated_price) to the rollups. Call inside a transaction.
+    """
+    if not ENABLED or not rows:
+        return
+    aggregates = aggregate((row['service'], row['timestamp'], row['calculated_price']) for row in rows)
+    # Upsert in a stable order so concurrent writers lock buckets in the same sequence
+    _upsert(sorted(_to_rows(aggregates), key=lambda r: (r['service'], r['period'], r['bucket'])))
+
+
+def service_stats(service_id, period='day', start=None, end=None):
+    """
+    Read the rollup buckets of a service between ``start`` and ``end``
+    (end exclusive, both aligned down to the period).
+    """
+    R = CalculationRollup
+    if period not in PERIODS:
+        raise ValueError(f"Unknown period {period!r}, expected one of {', '.join(PERIODS)}")
+    query = (R.select(R.bucket, R.count, R.total, R.min_price, R.max_price)
+             .where((R.service == service_id) & (R.period == period))
+             .order_by(R.bucket))
+    if start is not None:
+        query = query.where(R.bucket >= bucket_start(start, period))
+    if end is not None:
+        query = query.where(R.bucket < end)
+
+    buckets = []
+    count, total, low, high = 0, Decimal('0'), None, None
+    for bucket, bucket_count, bucket_total, bucket_min, bucket_max in query.tuples():
+        bucket_total = Decimal(str(bucket_total))
+        bucket_min = Decimal(str(bucket_min))
+        bucket_max = Decimal(str(bucket_max))
+        buckets.append({
+            'bucket': bucket.isoformat(),
+            'count': bucket_count,
+            'sum': float(bucket_total),
+            'average': float(bucket_total / bucket_count) if bucket_count else None,
+            'min': float(bucket_min),
+            'max': float(bucket_max),
+        })
+        count += bucket_count
+        total += bucket_total
+        low = bucket_min if low is None or bucket_min < low else low
+        high = bucket_max if high is None or bucket_max > high else high
+    return {
+        'service_id': service_id,
+        'period': period,
+        'buckets': buckets,
+        'totals': {
+            'count': count,
+            'sum': float(total),
+            'average': float(total / count) if count else None,
+            'min': None if low is None else float(low),
+            'max': None if high is None else float(high),
+        },
+    }
+
+
+def backfill_service(service_id, chunk_size=5000):
+    """
+    Rebuild the rollups of one service from its history, from the bucket of
+    its oldest remaining calculation on. Returns the number of calculations
+    read.
+    """
+    PC = PriceCalculation
+    R = CalculationRollup
+    aggregates = {}
+    seen = 0
+    with database.atomic():
+        oldest = list(PC.select(PC.timestamp).where(PC.service == service_id)
+                      .order_by(PC.timestamp).limit(1).tuples())
+        if not oldest:
+            return 0
+        for period in PERIODS:
+            R.delete().where((R.service == service_id) & (R.period == period) &
+                             (R.bucket >= bucket_start(oldest[0][0], period))).execute()
+        last = None
+        while True:
+            query = (PC.select(PC.id, PC.timestamp, PC.calculated_price)
+                     .where(PC.service == service_id))
+            if last is not None:
+                query = query.where((PC.timestamp > last[0]) | ((PC.timestamp == last[0]) & (PC.id > last[1])))
+            rows = list(query.order_by(PC.timestamp, PC.id).limit(chunk_size).tuples())
+            aggregate(((service_id, timestamp, price) for _, timestamp, price in rows), aggregates)
+            seen += len(rows)
+            if len(rows) < chunk_size:
+                break
+            last = (rows[-1][1], rows[-1][0])
+        rows = _to_rows(aggregates)
+        for start in range(0, len(rows), 500):
+            CalculationRollup.insert_many(rows[start:start + 500]).execute()
+    return seen
+
+
+def backfill(service_id=None, chunk_size=5000, log=print):
+    service_ids = [service_id] if service_id is not None else [
+        i for (i,) in Service.select(Service.id).order_by(Service.id).tuples()]
+    total = 0
+    for sid in service_ids:
+        started = datetime.datetime.now()
+        seen = backfill_service(sid, chunk_size)
+        total += seen
+        log(f"service {sid}: {seen} calculations in {(datetime.datetime.now() - started).total_seconds():.1f}s")
+    return total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Maintain calculation rollups')
+    commands = parser.add_subparsers(dest='command', required=True)
+    backfill_parser = commands.add_parser('backfill', help='rebuild rollups from the calculation history')
+    backfill_parser.add_argument('--service-id', type=int, help='only rebuild this service')
+    backfill_parser.add_argument('--chunk-size', type=int, default=5000)
+    args = parser.parse_args(argv)
+
+    database.create_tables([CalculationRollup])
+    total = backfill(args.service_id, args.chunk_size)
+    print(f"rebuilt rollups from {total} calculations")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,173 @@
+"""
+Read/write splitting between the primary database and read replicas.
+
+Models stay bound to the primary, so every write (and every query nobody
+routed) goes there. Read paths that tolerate a little replication lag (the
+full catalog load, GET /services, GET /parameters and the history export)
+bind their queries to ``router.reader()``:
+
+    services = Service.select().bind(router.reader())
+
+``reader()`` picks the replicas round-robin, skipping any that are further
+behind than ``max_lag`` seconds or that cannot be reached, and falls back to
+the primary when none is usable. Reads go to the primary as well
+
+- for the rest of a request after ``wrote()`` was called (read your writes),
+  and in the whole worker for a lag window after that, so caches rebuilt
+  right after a catalog write cannot pick up the old rows from a replica;
+- inside ``with router.use_primary():``, and for requests sent with
+  ``X-Consistent-Read: 1``.
+
+Replica lag is read from SHOW REPLICA STATUS on MySQL and assumed to be 0 for
+other databases, so two SQLite files can stand in for primary and replica.
+"""
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from peewee import MySQLDatabase
+
+MAX_LAG = float(os.environ.get('DB_REPLICA_MAX_LAG', 5))
+LAG_CHECK_INTERVAL = float(os.environ.get('DB_REPLICA_LAG_CHECK_INTERVAL', 2))
+
+
+def replica_lag(database):
+    """
+    Seconds ``database`` is behind its primary. 0 when it is not a MySQL
+    replica, None when replication is stopped.
+    """
+    if not isinstance(database, MySQLDatabase):
+        return 0.0
+    for statement in ('SHOW REPLICA STATUS', 'SHOW SLAVE STATUS'):
+        try:
+            cursor = database.execute_sql(statement)
+        except Exception:
+            continue  # the other spelling, depending on the server version
+        row = cursor.fetchone()
+        if row is None:
+            return 0.0
+        status = dict(zip([column[0] for column in cursor.description], row))
+        lag = status.get('Seconds_Behind_Source', status.get('Seconds_Behind_Master'))
+        return None if lag is None else float(lag)
+    raise RuntimeError('Could not read the replication status')
+
+
+class DatabaseRouter(object):
+    def __init__(self, primary, replicas=(), max_lag=None, lag_check_interval=None, lag_probe=replica_lag):
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.max_lag = MAX_LAG if max_lag is None else max_lag
+        self.lag_check_interval = LAG_CHECK_INTERVAL if lag_check_interval is None else lag_check_interval
+        self.lag_probe = lag_probe
+        self._lags = {}  # replica index -> (checked at, lag or None when unusable)
+        self._next = itertools.count()
+        self._primary_until = 0.0
+        self._state = threading.local()
+        self.replica_reads = 0
+        self.primary_reads = 0
+        self.fallbacks = 0
+
+    @property
+    def databases(self):
+        return [self.primary] + self.replicas
+
+    def _pinned(self):
+        return getattr(self._state, 'pinned', 0) > 0
+
+    @contextmanager
+    def use_primary(self):
+        """
+        Send this thread's reads to the primary inside the block.
+        """
+        self._state.pinned = getattr(self._state, 'pinned', 0) + 1
+        try:
+            yield self.primary
+        finally:
+            self._state.pinned -= 1
+
+    def pin_request(self):
+        """
+        Send the rest of the current request's reads to the primary.
+        """
+        self._state.pinned = getattr(self._state, 'pinned', 0) + 1
+        self._state.request_pins = getattr(self._state, 'request_pins', 0) + 1
+
+    def wrote(self):
+        """
+        Record a write: the current request keeps reading from the primary,
+        and so does the whole worker until replicas have caught up with it.
+        """
+        if not self.replicas:
+            return
+        self.pin_request()
+        self._primary_until = time.monotonic() + self.max_lag + self.lag_check_interval
+
+    def end_request(self):
+        """
+        Drop the request's read-your-writes pin and close replica connections.
+        """
+        pins = getattr(self._state, 'request_pins', 0)
+        if pins:
+            self._state.pinned -= pins
+            self._state.request_pins = 0
+        for replica in self.replicas:
+            if not replica.is_closed():
+                replica.close()
+
+    def close_all(self):
+        for replica in self.replicas:
+            if hasattr(replica, 'close_all'):
+                replica.close_all()
+            elif not replica.is_closed():
+                replica.close()
+
+    def lag(self, index):
+        """
+        Lag of replica ``index``, probed at most every lag_check_interval
+        seconds. None when the replica is stopped or unreachable.
+        """
+        now = time.monotonic()
+        checked = self._lags.get(index)
+        if checked is not None and now - checked[0] < self.lag_check_interval:
+            return checked[1]
+        try:
+            lag = self.lag_probe(self.replicas[index])
+        except Exception:
+            lag = None
+        self._lags[index] = (now, lag)
+        return lag
+
+    def primary_only(self):
+        """
+        Whether reads of the current thread must go to the primary right now.
+        """
+        return not self.replicas or self._pinned() or time.monotonic() < self._primary_until
+
+    def reader(self):
+        """
+        Database for a read that may lag by up to ``max_lag`` seconds.
+        """
+        if self.primary_only():
+            self.primary_reads += 1
+            return self.primary
+        start = next(self._next)
+        for offset in range(len(self.replicas)):
+            index = (start + offset) % len(self.replicas)
+            lag = self.lag(index)
+            if lag is not None and lag <= self.max_lag:
+                self.replica_reads += 1
+                return self.replicas[index]
+        self.fallbacks += 1
+        self.primary_reads += 1
+        return self.primary
+
+    def stats(self):
+        return {
+            'replicas': len(self.replicas),
+            'replica_reads': self.replica_reads,
+            'primary_reads': self.primary_reads,
+            'fallbacks': self.fallbacks,
+            'lag': [None if self._lags.get(i) is None else self._lags[i][1] for i in range(len(self.replicas))],
+        }
@@ -1,6 +1,10 @@
 import pytest
 from flask import json
 from app import app, Service, Parameter, ParameterOption, PriceCalculation, calculate_service_price, init_db, database
+from catalog import catalog
+from models import MODELS, CalculationRollup, ParameterSet
+from migrations import SchemaMigration
+from history import parameter_sets
 from decimal import Decimal
 
 # Fixture to set up the Flask app and database
@@ -13,6 +17,8 @@ def client():
 
     # Initialize the database
     init_db()
+    catalog.clear()
+    parameter_sets.clear()
 
     # Create a test client
     with app.test_client() as client:
@@ -21,7 +27,10 @@ def client():
 
     # Clean up the database after the test
     with app.app_context():
+        SchemaMigration.drop_table()
+        CalculationRollup.drop_table()
         PriceCalculation.drop_table()
+        ParameterSet.drop_table()
         ParameterOption.drop_table()
         Parameter.drop_table()
         Service.drop_table()
@@ -179,4 +188,1023 @@ class TestGetServices:
 		data = response.get_json()
 		assert isinstance(data, list)
 		assert len(data) == 2
-		assert all('name' in service for service in data)
\ No newline at end of file
+		assert all('name' in service for service in data)
+# Test that pricing is served from the compiled catalog without database reads
+def test_calculate_service_price_uses_catalog(client, monkeypatch):
+    test_create_parameter(client)
+    assert calculate_service_price(1, {'test_param': '2'}) == Decimal('150.0')
+
+    def no_queries(*args, **kwargs):
+        raise AssertionError('unexpected query')
+    monkeypatch.setattr(database, 'execute_sql', no_queries)
+    assert calculate_service_price(1, {'test_param': '1'}) == Decimal('100.0')
+
+# Test that writes patch the catalog and bump its version
+def test_catalog_version_bumped_on_write(client):
+    test_create_parameter(client)
+    data = {'service_id': 1, 'parameters': {'test_param': '2'}}
+    first = json.loads(client.post('/calculate-price', data=json.dumps(data), content_type='application/json').data)
+
+    option = {
+        'service_id': 1,
+        'name': 'rush',
+        'parameter_type': 'fixed',
+        'options': [{'value': 'yes', 'modifier': 10}]
+    }
+    client.post('/parameters', data=json.dumps(option), content_type='application/json')
+    data['parameters']['rush'] = 'yes'
+    second = json.loads(client.post('/calculate-price', data=json.dumps(data), content_type='application/json').data)
+    assert second['catalog_version'] > first['catalog_version']
+    assert second['calculated_price'] == 160.0
+
+    # Periodic reloads only move the version when something changed
+    from catalog import Catalog
+    worker = Catalog(max_age=0)
+    assert worker.load() == worker.load() == 1
+    ParameterOption.update(modifier=2).where(ParameterOption.value == '2').execute()
+    assert worker.load() == 2
+    assert worker.get(1).plan.evaluate({'test_param': '2'}) == Decimal('200')
+
+def test_catalog_unknown_ids_and_concurrent_patches(client, monkeypatch):
+    import catalog as catalog_module
+    from catalog import Catalog
+    test_create_parameter(client)
+    worker = Catalog(max_age=0)
+    worker.load()
+    fetched = []
+    fetch = catalog_module._fetch
+    monkeypatch.setattr(catalog_module, '_fetch', lambda service_ids=None: fetched.append(service_ids) or fetch(service_ids))
+    for _ in range(3):
+        with pytest.raises(Service.DoesNotExist):
+            worker.get(99)
+    assert fetched == [[99]]  # remembered as missing until the next load
+
+    # A service created by another worker is found after the next load
+    Service.create(id=99, name='Late', base_price=5)
+    worker.load()
+    assert worker.get(99).base_price == Decimal('5')
+
+    # A patch landing while a full load fetches is not overwritten by it
+    def fetch_during_patch(service_ids=None):
+        services = fetch(service_ids)
+        if service_ids is None and not fetched[-1:] == ['patched']:
+            Service.update(base_price=7).where(Service.id == 99).execute()
+            fetched.append('patched')
+            worker.refresh_service(99)
+        return services
+    monkeypatch.setattr(catalog_module, '_fetch', fetch_during_patch)
+    worker.load()
+    assert worker.get(99).base_price == Decimal('7')
+
+# Test batch pricing with per-item errors and a single history insert
+def test_calculate_price_batch(client):
+    test_create_parameter(client)
+    data = {
+        'items': [
+            {'service_id': 1, 'parameters': {'test_param': '2'}},
+            {'service_id': 1, 'parameters': {'test_param': 'invalid_value'}},
+            {'service_id': 99, 'parameters': {}},
+            {'parameters': {}},
+            {'service_id': 1, 'parameters': {'test_param': '1'}}
+        ]
+    }
+    catalog.clear()  # the version reported is the one of the reload that priced the items
+    response = client.post('/calculate-price/batch', data=json.dumps(data), content_type='application/json')
+    assert response.status_code == 200
+    results = json.loads(response.data)['results']
+    assert [r.get('calculated_price') for r in results] == [150.0, None, None, None, 100.0]
+    assert json.loads(response.data)['catalog_version'] == catalog.version > 0
+    assert "Invalid value 'invalid_value' for parameter 'test_param'" in results[1]['error']
+    assert 'error' in results[2] and 'error' in results[3]
+    assert PriceCalculation.select().count() == 2
+
+    # A malformed service id fails only its own item
+    data = {'items': [{'service_id': [1], 'parameters': {}}, {'service_id': {'id': 1}}, {'service_id': True},
+                      {'service_id': '1', 'parameters': {'test_param': '2'}}]}
+    response = client.post('/calculate-price/batch', data=json.dumps(data), content_type='application/json')
+    assert response.status_code == 200
+    results = json.loads(response.data)['results']
+    assert [r.get('error') for r in results[:3]] == ['Service ID must be an integer or a string'] * 3
+    assert results[0]['service_id'] == [1] and results[3]['calculated_price'] == 150.0
+
+def test_calculate_price_batch_empty(client):
+    response = client.post('/calculate-price/batch', data=json.dumps({'items': []}), content_type='application/json')
+    assert response.status_code == 400
+
+# Test write-behind persistence: the response carries a ULID and the row is written on flush
+def test_calculate_price_write_behind(client, monkeypatch):
+    from history import history_writer
+    test_create_parameter(client)
+    monkeypatch.setattr(history_writer, 'enabled', True)
+    monkeypatch.setattr(history_writer, 'flush_interval', 60)
+
+    data = {'service_id': 1, 'parameters': {'test_param': '2'}}
+    response = client.post('/calculate-price', data=json.dumps(data), content_type='application/json')
+    assert response.status_code == 200
+    result = json.loads(response.data)
+    assert result['calculation_id'] == result['calculation_uid']
+    assert len(result['calculation_uid']) == 26
+
+    history_writer.stop()
+    calculation = PriceCalculation.get(PriceCalculation.uid == result['calculation_uid'])
+    assert calculation.calculated_price == Decimal('150.00')
+    assert history_writer.stats()['queue_depth'] == 0
+
+def test_history_writer_drops_when_full():
+    from history import HistoryWriter
+    writer = HistoryWriter(enabled=True, max_queue=1, flush_interval=60)
+    writer._ensure_started = lambda: None
+    assert writer.submit({'uid': 'a'})
+    assert not writer.submit({'uid': 'b'})
+    assert writer.stats()['dropped'] == 1
+    assert writer.stats()['queue_depth'] == 1
+
+# Test that GET /parameters uses a fixed number of queries and pages by keyset
+def test_get_parameters_paginated(client, monkeypatch):
+    test_create_parameter(client)
+    for name in ('second', 'third'):
+        data = {
+            'service_id': 1,
+            'name': name,
+            'parameter_type': 'fixed',
+            'options': [{'value': 'a', 'modifier': 1}, {'value': 'b', 'modifier': 2}]
+        }
+        client.post('/parameters', data=json.dumps(data), content_type='application/json')
+    catalog.load()  # responses are cached per catalog version, load it outside the count
+
+    queries = []
+    execute_sql = database.execute_sql
+    def counting(sql, *args, **kwargs):
+        queries.append(sql)
+        return execute_sql(sql, *args, **kwargs)
+    monkeypatch.setattr(database, 'execute_sql', counting)
+
+    response = client.get('/parameters?service_id=1')
+    data = json.loads(response.data)
+    assert [p['name'] for p in data] == ['test_param', 'second', 'third']
+    assert all(p['service_id'] == 1 for p in data)
+    assert len(data[1]['options']) == 2
+    assert len(queries) == 2
+
+    response = client.get('/parameters?limit=2')
+    page = json.loads(response.data)
+    assert len(page) == 2
+    after_id = response.headers['X-Next-After-Id']
+    response = client.get(f'/parameters?limit=2&after_id={after_id}')
+    assert [p['name'] for p in json.loads(response.data)] == ['third']
+    assert 'X-Next-After-Id' not in response.headers
+
+    assert json.loads(client.get('/parameters?service_id=2').data) == []
+
+# Test the NDJSON history export with filters and keyset chunking
+def test_export_calculations(client, monkeypatch):
+    import app as app_module
+    import gzip
+    test_create_parameter(client)
+    data = {'service_id': 1, 'parameters': {'test_param': '2'}}
+    for _ in range(5):
+        client.post('/calculate-price', data=json.dumps(data), content_type='application/json')
+    monkeypatch.setattr(app_module, 'EXPORT_CHUNK_SIZE', 2)
+
+    response = client.get('/calculations/export?service_id=1')
+    assert response.mimetype == 'application/x-ndjson'
+    rows = [json.loads(line) for line in response.data.decode().splitlines()]
+    assert [row['id'] for row in rows] == [1, 2, 3, 4, 5]
+    assert rows[0]['calculated_price'] == '150.00'
+    assert rows[0]['input_params']['parameters'] == {'test_param': '2'}
+
+    response = client.get('/calculations/export?gzip=1&end=2000-01-01T00:00:00')
+    assert gzip.decompress(response.data) == b''
+    response = client.get('/calculations/export?gzip=1')
+    assert len(gzip.decompress(response.data).splitlines()) == 5
+
+    assert client.get('/calculations/export?start=yesterday').status_code == 400
+
+# Test that repeat quotes are served from the quote cache until the catalog changes
+def test_quote_cache(client):
+    from quote_cache import quote_cache
+    test_create_parameter(client)
+    data = {'service_id': 1, 'parameters': {'test_param': '2'}}
+    before = quote_cache.stats()
+    for _ in range(3):
+        response = client.post('/calculate-price', data=json.dumps(data), content_type='application/json')
+        assert json.loads(response.data)['calculated_price'] == 150.0
+    after = quote_cache.stats()
+    assert after['misses'] - before['misses'] == 1
+    assert after['hits'] - before['hits'] == 2
+
+    client.post('/services', data=json.dumps({'name': 'Other', 'base_price': 1}), content_type='application/json')
+    client.post('/calculate-price', data=json.dumps(data), content_type='application/json')
+    assert quote_cache.stats()['misses'] - after['misses'] == 1
+
+def test_quote_cache_single_flight():
+    import threading
+    from quote_cache import QuoteCache
+    cache = QuoteCache(max_size=2, ttl=60)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 42
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(cache.get_or_compute('k', compute)))
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(cache.get_or_compute('k', compute))) for _ in range(3)]
+    for thread in followers:
+        thread.start()
+    while cache.stats()['coalesced'] < 3:
+        pass
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(5)
+    assert results == [42] * 4
+    assert len(calls) == 1
+
+    cache.get_or_compute('a', lambda: 1)
+    cache.get_or_compute('b', lambda: 2)
+    assert cache.stats()['evictions'] == 1
+
+# Test that connections are only checked out when needed and always returned
+def test_connection_released_on_teardown(client, monkeypatch):
+    test_create_parameter(client)
+    client.get('/parameters?limit=1')
+    assert database.is_closed()
+
+    connects = []
+    connect = database.connect
+    monkeypatch.setattr(database, 'connect', lambda *a, **k: connects.append(1) or connect(*a, **k))
+    client.get('/stats')
+    assert connects == []
+
+    data = {'service_id': 1, 'parameters': {'test_param': '2'}}
+    monkeypatch.setattr('app.calculate_price_breakdown', lambda *a, **k: 1 / 0)
+    database.connect()
+    with pytest.raises(ZeroDivisionError):
+        client.post('/calculate-price-details', data=json.dumps(data), content_type='application/json')
+    assert database.is_closed()
+
+def test_pool_metrics_exhaustion(tmp_path):
+    import threading
+    from playhouse.pool import MaxConnectionsExceeded, PooledSqliteDatabase
+    from pool import InstrumentedPoolMixin, pool_stats
+
+    class Pool(InstrumentedPoolMixin, PooledSqliteDatabase):
+        pass
+
+    db = Pool(str(tmp_path / 'pool.db'), max_connections=1, timeout=0.2, check_same_thread=False)
+    db.connect()
+    errors = []
+    def checkout():
+        try:
+            db.connect()
+        except MaxConnectionsExceeded as e:
+            errors.append(e)
+    thread = threading.Thread(target=checkout)
+    thread.start()
+    thread.join()
+    stats = pool_stats(db)
+    assert len(errors) == 1
+    assert stats['in_use'] == 1
+    assert stats['checkouts'] == 2
+    assert stats['exhausted'] == 1 and stats['timeouts'] == 1
+    assert stats['wait_seconds_max'] >= 0.2
+    db.close()
+    assert pool_stats(db)['in_use'] == 0
+
+# Test the benchmark helpers against a small synthetic catalog
+def test_bench_helpers(client):
+    import random
+    import bench
+    assert bench.percentile([1, 2, 3, 4], 50) == 2
+    assert bench.percentile([1, 2, 3, 4], 99) == 4
+
+    spec = bench.catalog_spec(2, 3, 2)
+    service_ids = bench.seed_models(spec)
+    requests = bench.make_requests(spec, service_ids, 5, random.Random(1))
+
+    def call(method, path, body):
+        if method == 'POST':
+            return client.post(path, json=body).status_code
+        return client.get(path).status_code
+    results = {endpoint: bench.measure(call, reqs) for endpoint, reqs in requests.items()}
+    assert all(r['errors'] == 0 and r['requests'] == 5 for r in results.values())
+
+    baseline = {'results': {k: dict(v, p95_ms=v['p95_ms'] * 10, queries_per_request=0) for k, v in results.items()}}
+    slower = {k: dict(v, p95_ms=v['p95_ms'] * 100, queries_per_request=0) for k, v in results.items()}
+    assert bench.compare(results, {'results': results}, 0.25) == []
+    assert len(bench.compare(slower, baseline, 0.25)) == len(results)
+
+# Test Server-Timing headers and the Prometheus /metrics endpoint
+def test_server_timing_and_metrics(client):
+    test_create_parameter(client)
+    data = {'service_id': 1, 'parameters': {'test_param': '2'}}
+    response = client.post('/calculate-price', data=json.dumps(data), content_type='application/json')
+    timing = response.headers['Server-Timing']
+    assert 'db;dur=' in timing and ' queries"' in timing
+    for phase in ('catalog', 'pricing', 'history', 'serialize', 'total'):
+        assert phase + ';dur=' in timing
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    body = response.data.decode()
+    assert 'pricing_http_request_duration_seconds_bucket{endpoint="/calculate-price",method="POST",status="200",le="+Inf"}' in body
+    assert 'pricing_db_queries_per_request_count{endpoint="/calculate-price"}' in body
+    assert 'pricing_quote_cache_misses_total' in body
+
+def test_metrics_sampling_disabled(client, monkeypatch):
+    import metrics
+    monkeypatch.setattr(metrics, 'SAMPLE_RATE', 0.0)
+    monkeypatch.setattr(metrics.REQUESTS, '_values', {})
+    monkeypatch.setattr(metrics.QUERIES_PER_REQUEST, '_series', {})
+    response = client.get('/services')
+    assert 'Server-Timing' not in response.headers
+    client.post('/calculate-price', data=json.dumps({}), content_type='application/json')
+
+    # Unsampled requests are still counted, errors included
+    counts = metrics.REQUESTS._values
+    assert counts[('/services', '200')] == 1 and counts[('/calculate-price', '400')] == 1
+    assert ('/services',) not in metrics.QUERIES_PER_REQUEST._series
+
+# Test that both calculation routes share one pricing plan
+def test_price_details_matches_calculate_price(client):
+    test_create_parameter(client)
+    for data in (
+        {'service_id': 1, 'name': 'level', 'parameter_type': 'multiplier',
+         'options': [{'value': 'gold', 'modifier': 2}]},
+        {'service_id': 1, 'name': 'rush', 'parameter_type': 'fixed',
+         'options': [{'value': 'yes', 'modifier': 10}]},
+    ):
+        client.post('/parameters', data=json.dumps(data), content_type='application/json')
+
+    # No quantity parameter given: multipliers are multiplied, not added
+    data = {'service_id': 1, 'parameters': {'test_param': '2', 'level': 'gold', 'rush': 'yes'}}
+    price = json.loads(client.post('/calculate-price', data=json.dumps(data), content_type='application/json').data)
+    response = client.post('/calculate-price-details', data=json.dumps(data), content_type='application/json')
+    assert response.status_code == 200
+    details = json.loads(response.data)
+    assert price['calculated_price'] == details['calculated_price'] == 310.0  # 100 * 1.5 * 2 + 10
+    costs = [Decimal(line['cost']) for line in details['detailed_breakdown']]
+    assert [line['parameter'] for line in details['detailed_breakdown']] == ['test_param', 'level', 'rush']
+    assert Decimal('100') + sum(costs) == Decimal('310')
+
+    data['parameters']['rush'] = 'no'
+    response = client.post('/calculate-price-details', data=json.dumps(data), content_type='application/json')
+    assert response.status_code == 400
+    assert "Invalid value 'no' for parameter 'rush'" in json.loads(response.data)['error']
+
+def test_pricing_plan_evaluate_many():
+    from catalog import CompiledParameter, CompiledService
+    service = CompiledService(1, 'svc', Decimal('10'), (
+        CompiledParameter(1, 'units', 'quantity', False, None, {}),
+        CompiledParameter(2, 'size', 'multiplier', True, None, {'L': Decimal('1.5')}),
+        CompiledParameter(3, 'fee', 'fixed', False, 'none', {'none': Decimal('0'), 'rush': Decimal('-20')}),
+    ))
+    plan = service.plan
+    params_list = [{'size': 'L'}, {'size': 'L', 'units': '3', 'fee': 'rush'}, {'units': '2'}, {'size': 'XL'}]
+    results = plan.evaluate_many(params_list)
+    assert results[0] == (Decimal('15.0'), None)
+    assert results[1] == (Decimal('0.0'), None)  # (15 - 20) * 3 is floored at zero
+    assert results[2][1] == "Required parameter 'size' is missing"
+    assert results[3][1] == "Invalid value 'XL' for parameter 'size'"
+    assert [r[0] for r in results[:2]] == [plan.evaluate(p) for p in params_list[:2]]
+
+def test_catalog_import(client):
+    records = [
+        {'name': 'Wash', 'base_price': 50, 'parameters': [
+            {'name': 'size', 'parameter_type': 'multiplier', 'is_required': True,
+             'options': [{'value': 'S', 'modifier': 1}, {'value': 'L', 'modifier': 1.5}]},
+            {'name': 'wax', 'parameter_type': 'fixed', 'default_value': 'no',
+             'options': [{'value': 'no', 'modifier': 0}, {'value': 'yes', 'modifier': 20}]}]},
+        {'name': 'Dry', 'base_price': '10.50'},
+    ]
+    body = json.dumps(records)
+    response = client.post('/catalog/import?dry_run=1', data=body, content_type='application/json')
+    assert response.status_code == 200
+    assert json.loads(response.data)['options'] == 4
+    assert Service.select().count() == 0
+
+    response = client.post('/catalog/import', data=body, content_type='application/json')
+    assert response.status_code == 201
+    assert json.loads(response.data)['services'] == 2
+    service_id = Service.get(Service.name == 'Wash').id
+    data = {'service_id': service_id, 'parameters': {'size': 'L', 'wax': 'yes'}}
+    price = json.loads(client.post('/calculate-price', data=json.dumps(data), content_type='application/json').data)
+    assert price['calculated_price'] == 95.0
+
+    # One bad row rejects the whole upload and is reported by line
+    ndjson = '\n'.join([
+        json.dumps({'name': 'Polish', 'base_price': 5}),
+        json.dumps({'name': 'Wash', 'base_price': 5}),
+        json.dumps({'service_id': service_id, 'parameters': [{'name': 'size', 'parameter_type': 'bogus'}]}),
+    ])
+    response = client.post('/catalog/import', data=ndjson, content_type='application/x-ndjson')
+    assert response.status_code == 400
+    errors = json.loads(response.data)['errors']
+    assert [e['row'] for e in errors] == [2, 3]
+    assert "Service 'Wash' already exists" in errors[0]['errors']
+    assert Service.select().count() == 2
+
+    # Parameter names repeated inside the upload are row errors, not integrity errors
+    rush = {'name': 'rush', 'parameter_type': 'fixed', 'options': [{'value': 'yes', 'modifier': 5}]}
+    records = [{'service_id': service_id, 'parameters': [rush, rush]},
+               {'service_id': service_id, 'parameters': [rush]},
+               {'service_id': str(service_id), 'parameters': [rush]}]
+    response = client.post('/catalog/import', data=json.dumps(records), content_type='application/json')
+    assert response.status_code == 400
+    errors = json.loads(response.data)['errors']
+    assert errors[0] == {'row': 1, 'errors': ["parameters[1]: duplicate parameter 'rush'"]}
+    assert errors[1:] == [{'row': row, 'errors': [f"Duplicate parameter 'rush' for service {service_id} (row 1)"]}
+                          for row in (2, 3)]
+    assert Parameter.select().count() == 2
+
+def test_iter_json_array():
+    import io
+    from bulk_import import iter_json_array
+    chunks = list(iter_json_array(io.BytesIO(b' [ {"a": 1.25}, [1, "x"], 12345 ] '), chunk_size=3))
+    assert chunks == [{'a': 1.25}, [1, 'x'], 12345]
+    with pytest.raises(ValueError):
+        list(iter_json_array(io.BytesIO(b'{"a": 1}')))
+
+def test_bulk_services_csv(client):
+    csv_body = 'name,description,base_price\nA,first,10\nB,,12.5\n'
+    response = client.post('/services/bulk', data=csv_body, content_type='text/csv')
+    assert response.status_code == 201
+    assert [s.name for s in Service.select().order_by(Service.id)] == ['A', 'B']
+
+    response = client.post('/services/bulk', data='name,base_price\nC,abc\n', content_type='text/csv')
+    assert response.status_code == 400
+    assert json.loads(response.data)['errors'][0] == {'row': 2, 'errors': ["'base_price' must be a number"]}
+
+def test_price_matrix(client):
+    test_create_parameter(client)  # test_param: '1' -> 1.0, '2' -> 1.5 (multiplier, required)
+    service_id = 1
+    for name, parameter_type, options in (
+            ('level', 'multiplier', [{'value': 'basic', 'modifier': 1}, {'value': 'gold', 'modifier': 2}]),
+            ('rush', 'fixed', [{'value': 'yes', 'modifier': 10}, {'value': 'refund', 'modifier': -500}]),
+            ('units', 'quantity', [])):
+        client.post('/parameters', data=json.dumps({
+            'service_id': service_id, 'name': name, 'parameter_type': parameter_type,
+            'is_required': name == 'level', 'options': options}), content_type='application/json')
+
+    response = client.get(f'/services/{service_id}/price-matrix')
+    assert response.status_code == 200
+    cells = json.loads(response.get_data())
+    # 2 x 2 multiplier combinations times 3 fixed ones (yes, refund or left out)
+    assert len(cells) == int(response.headers['X-Total-Count']) == 12
+    for cell in cells:
+        plan_price = catalog.get(service_id).plan.evaluate(cell['parameters'])
+        assert Decimal(str(cell['price'])) == plan_price
+    assert {'parameters': {'test_param': '2', 'level': 'gold', 'rush': 'yes'}, 'price': 310.0} in cells
+    assert PriceCalculation.select().count() == 0
+
+    page = client.get(f'/services/{service_id}/price-matrix?offset=5&limit=5')
+    assert json.loads(page.data) == cells[5:10]
+    assert page.headers['X-Next-Offset'] == '10'
+    assert 'X-Next-Offset' not in client.get(f'/services/{service_id}/price-matrix?offset=10&limit=5').headers
+    assert client.get('/services/99/price-matrix').status_code == 404
+
+    # A changed option invalidates the cached matrix
+    ParameterOption.update(modifier=3).where(ParameterOption.value == 'gold').execute()
+    catalog.refresh_service(service_id)
+    cells = json.loads(client.get(f'/services/{service_id}/price-matrix').get_data())
+    assert {'parameters': {'test_param': '2', 'level': 'gold', 'rush': 'yes'}, 'price': 460.0} in cells
+
+def test_service_stats_from_rollups(client):
+    import datetime
+    import rollups
+    from history import record_calculations
+    test_create_parameter(client)
+    for value in ('1', '2', '2'):
+        data = {'service_id': 1, 'parameters': {'test_param': value}}
+        client.post('/calculate-price', data=json.dumps(data), content_type='application/json')
+    yesterday = datetime.datetime.now() - datetime.timedelta(days=1)
+    record_calculations([{'uid': f'old{i}', 'timestamp': yesterday, 'service': 1, 'input_params': '{}',
+                          'calculated_price': price, 'base_price': 100} for i, price in enumerate((20, 40))])
+
+    stats = json.loads(client.get('/services/1/stats').data)
+    assert [b['count'] for b in stats['buckets']] == [2, 3]
+    assert stats['buckets'][1]['sum'] == 400.0 and stats['buckets'][1]['min'] == 100.0
+    assert stats['totals'] == {'count': 5, 'sum': 460.0, 'average': 92.0, 'min': 20.0, 'max': 150.0}
+    hourly = json.loads(client.get('/services/1/stats?period=hour&start=' + datetime.date.today().isoformat()).data)
+    assert hourly['totals']['count'] == 3
+    assert client.get('/services/1/stats?period=week').status_code == 400
+
+    # A backfill rebuilds the same numbers from the history alone
+    CalculationRollup.delete().execute()
+    assert rollups.backfill(chunk_size=2, log=lambda message: None) == 5
+    assert json.loads(client.get('/services/1/stats').data) == stats
+
+def test_rollups_updated_after_the_insert_commits(client, monkeypatch):
+    import history
+    test_create_parameter(client)
+    statements = []
+    execute_sql = database.execute_sql
+    def spy(sql, *args, **kwargs):
+        if sql.startswith('INSERT'):
+            statements.append((sql.split('"')[1], database.in_transaction()))
+        return execute_sql(sql, *args, **kwargs)
+    monkeypatch.setattr(database, 'execute_sql', spy)
+    data = json.dumps({'service_id': 1, 'parameters': {'test_param': '2'}})
+    assert client.post('/calculate-price', data=data, content_type='application/json').status_code == 200
+    # The history insert commits on its own before its buckets are locked
+    assert statements[-2:] == [('price_calculations', False), ('calculation_rollups', True)]
+
+    # The calculation is kept when its rollups fail
+    def fail(rows):
+        raise RuntimeError('lock wait timeout')
+    monkeypatch.setattr(history, 'update_rollups', fail)
+    assert client.post('/calculate-price', data=data, content_type='application/json').status_code == 200
+    assert PriceCalculation.select().count() == 2
+
+def test_retention_archives_old_calculations(client, tmp_path):
+    import datetime
+    import gzip
+    from history import record_calculations
+    from retention import RetentionJob, retention_job
+    test_create_service(client)
+    now = datetime.datetime(2025, 6, 15)
+    timestamps = [datetime.datetime(2025, 3, 31, 23), datetime.datetime(2025, 4, 2), datetime.datetime(2025, 4, 3),
+                  datetime.datetime(2025, 5, 1), datetime.datetime(2025, 6, 1)]
+    record_calculations([{'uid': f'u{i}', 'timestamp': ts, 'service': 1, 'input_params': json.dumps({'n': i}),
+                          'calculated_price': 10 + i, 'base_price': 100} for i, ts in enumerate(timestamps)])
+
+    job = RetentionJob(retention_months=1, archive_dir=str(tmp_path), chunk_size=2, pause=0)
+    assert job.cutoff(now) == datetime.datetime(2025, 5, 1)
+    assert job.run_once(now) == 3
+    assert [c.uid for c in PriceCalculation.select().order_by(PriceCalculation.id)] == ['u3', 'u4']
+    assert [a['month'] for a in job.archives()] == ['2025-03', '2025-04']
+    april = list(job.iter_archive('2025-04'))
+    assert [row['uid'] for row in april] == ['u1', 'u2']  # written as two gzip members
+    assert april[0]['input_params'] == {'n': 1} and april[0]['calculated_price'] == '11.00'
+    assert job.run_once(now) == 0
+
+    # Rebuilding the rollups keeps the buckets of archived history
+    from rollups import backfill_service, service_stats
+    days = service_stats(1, 'day')
+    assert days['totals']['count'] == 5
+    assert backfill_service(1) == 2
+    assert service_stats(1, 'day') == days and service_stats(1, 'hour')['totals']['count'] == 5
+
+    # A failed delete leaves neither the table nor the archive changed
+    size = len(open(job.archive_path(datetime.datetime(2025, 4, 1)), 'rb').read())
+    PriceCalculation.update(timestamp=datetime.datetime(2025, 4, 30)).where(PriceCalculation.uid == 'u3').execute()
+    original_delete = PriceCalculation.delete
+    PriceCalculation.delete = classmethod(lambda cls: (_ for _ in ()).throw(RuntimeError('locked')))
+    try:
+        with pytest.raises(RuntimeError):
+            job.run_once(now)
+    finally:
+        PriceCalculation.delete = original_delete
+    assert PriceCalculation.select().count() == 2
+    assert len(open(job.archive_path(datetime.datetime(2025, 4, 1)), 'rb').read()) == size
+
+    original_dir = retention_job.archive_dir
+    retention_job.archive_dir = str(tmp_path)
+    try:
+        assert json.loads(client.get('/calculations/archive').data)[1]['month'] == '2025-04'
+        response = client.get('/calculations/archive/2025-04?start=2025-04-03')
+        assert [json.loads(line)['uid'] for line in response.get_data(as_text=True).splitlines()] == ['u2']
+        raw = client.get('/calculations/archive/2025-04?gzip=1')
+        assert gzip.decompress(raw.get_data()).decode().count('\n') == 2
+        raw.close()
+        assert client.get('/calculations/archive/2024-01').status_code == 404
+        assert client.get('/calculations/archive/last-month').status_code == 400
+    finally:
+        retention_job.archive_dir = original_dir
+
+def test_retention_thread_runs_in_one_worker(client, monkeypatch):
+    import runpy
+    from types import SimpleNamespace
+    from retention import retention_job
+    monkeypatch.setattr(retention_job, 'enabled', True)
+    started = []
+    monkeypatch.setattr(retention_job, 'ensure_started', lambda: started.append(True))
+    client.get('/services')
+    assert started == []  # requests never start it
+
+    hooks = runpy.run_path('gunicorn.conf.py')
+    server = SimpleNamespace(WORKERS={})
+    for pid in (101, 102, 103):
+        worker = SimpleNamespace()
+        hooks['pre_fork'](server, worker)
+        hooks['post_fork'](server, worker)
+        server.WORKERS[pid] = worker
+    assert [w.run_retention for w in server.WORKERS.values()] == [True, False, False]
+    assert started == [True]
+
+    # The next worker forked after it exits takes over
+    del server.WORKERS[101]
+    worker = SimpleNamespace()
+    hooks['pre_fork'](server, worker)
+    assert worker.run_retention
+
+def test_app_factory_migrate_and_warm_up(client, monkeypatch):
+    import gc
+    import app as app_module
+    queries = []
+    execute_sql = database.execute_sql
+    monkeypatch.setattr(database, 'execute_sql', lambda sql, *a, **kw: queries.append(sql) or execute_sql(sql, *a, **kw))
+    second = app_module.create_app()
+    assert queries == []  # building an app runs no DDL and opens no connection
+    assert second.url_map.bind('').match('/services/1/price-matrix')[0] == 'pricing.get_price_matrix'
+
+    result = second.test_cli_runner().invoke(args=['migrate'])
+    assert result.exit_code == 0 and 'up to date' in result.output
+    assert any('CREATE TABLE' in sql for sql in queries)
+
+    test_create_service(client)
+    catalog.clear()
+    monkeypatch.setattr(gc, 'freeze', lambda: None)
+    app_module.warm_up()
+    assert catalog.stats()['services'] == 1
+    assert database.is_closed()
+
+def test_shared_catalog_snapshot(client, tmp_path):
+    from catalog_snapshot import SnapshotCatalog
+    test_create_parameter(client)
+    path = str(tmp_path / 'catalog')
+    worker_a = SnapshotCatalog(path, max_age=0)
+    worker_b = SnapshotCatalog(path, max_age=0)
+    assert worker_b.version == 0
+
+    service = worker_a.get(1)  # nothing published yet, so worker A builds generation 1
+    assert worker_a.version == worker_b.version == 1
+    shared = worker_b.get(1)
+    assert shared.base_price == service.base_price == catalog.get(1).base_price
+    assert shared.parameters[0].options == {'1': Decimal('1.0'), '2': Decimal('1.5')}
+    assert shared.plan.evaluate({'test_param': '2'}) == Decimal('150')
+    assert worker_b.stats()['remaps'] == 1
+
+    # A write through one worker publishes a generation the other remaps to
+    Parameter.create(service=1, name='rush', parameter_type='fixed')
+    ParameterOption.create(parameter=2, value='yes', modifier='12.5')
+    assert worker_a.refresh_service(1) == 2
+    assert worker_b.get(1).plan.evaluate({'test_param': '1', 'rush': 'yes'}) == Decimal('112.5')
+    assert worker_b.version == 2 and worker_b.stats()['remaps'] == 2
+
+    with pytest.raises(Service.DoesNotExist):
+        worker_b.get(99)
+    assert worker_b.version == 2  # unknown ids do not trigger a rebuild
+
+    # An expired snapshot with unchanged data keeps its generation
+    published = worker_b._sync().published_at
+    worker_a.max_age = 1e-9
+    assert worker_a.current_version() == 2
+    assert worker_b._sync().published_at > published and worker_b.stats()['remaps'] == 2
+    ParameterOption.update(modifier='15').where(ParameterOption.value == 'yes').execute()
+    assert worker_a.current_version() == 3
+    assert worker_b.get(1).plan.evaluate({'test_param': '1', 'rush': 'yes'}) == Decimal('115')
+
+def test_integer_engine_matches_decimal():
+    import engine_diff
+    from catalog import CompiledParameter, CompiledService
+    from pricing import IntegerPricingPlan, PricingPlan, compile_plan
+    for rounding in ('ROUND_HALF_UP', 'ROUND_HALF_EVEN', 'ROUND_DOWN'):
+        assert engine_diff.run_random(100, 50, seed=7, rounding=rounding) == []
+
+    # 0.01 * 0.5 lands exactly on a half cent
+    half = CompiledService(1, 'half', Decimal('0.01'), (
+        CompiledParameter(1, 'size', 'multiplier', True, None, {'half': Decimal('0.5000')}),))
+    assert IntegerPricingPlan.compile(half, 'ROUND_HALF_UP').evaluate({'size': 'half'}) == Decimal('0.01')
+    assert IntegerPricingPlan.compile(half, 'ROUND_HALF_EVEN').evaluate({'size': 'half'}) == Decimal('0.00')
+    assert compile_plan(half, engine='decimal').evaluate({'size': 'half'}) == Decimal('0.005')
+
+    # Values below the engine's precision fall back to exact Decimal arithmetic
+    fine = CompiledService(2, 'fine', Decimal('1.00'), (
+        CompiledParameter(2, 'fee', 'fixed', True, None, {'tiny': Decimal('0.00001')}),))
+    plan = compile_plan(fine, engine='integer')
+    assert type(plan) is PricingPlan and plan.evaluate({'fee': 'tiny'}) == Decimal('1.00001')
+
+    # Breakdowns are built from the integer terms and match the Decimal plan's
+    service = CompiledService(3, 'wash', Decimal('40.00'), (
+        CompiledParameter(3, 'size', 'multiplier', True, None, {'L': Decimal('1.5')}),
+        CompiledParameter(4, 'wax', 'fixed', False, None, {'yes': Decimal('2.2')}),
+        CompiledParameter(5, 'cars', 'quantity', False, None, {})))
+    integer_plan, decimal_plan = IntegerPricingPlan.compile(service), PricingPlan.compile(service)
+    params = {'size': 'L', 'wax': 'yes', 'cars': '2.50'}
+    recorded, expected = [], []
+    assert integer_plan.evaluate(params, recorded) == decimal_plan.evaluate(params, expected)
+    assert [m for _, _, m in recorded] == [m for _, _, m in expected] == [Decimal('1.5'), Decimal('2.2'), Decimal('2.5')]
+    assert integer_plan.itemize(recorded) == decimal_plan.itemize(expected)
+
+def test_integer_engine_rejects_out_of_range_quantities():
+    import time
+    from catalog import CompiledParameter, CompiledService
+    from pricing import IntegerPricingPlan, PricingError
+    service = CompiledService(1, 'units', Decimal('2.00'), (
+        CompiledParameter(1, 'q', 'quantity', True, None, {}),))
+    plan = IntegerPricingPlan.compile(service)
+    started = time.perf_counter()
+    for quantity in ('1e-20000000', '1e-2000000', '1e200000', '1' * 29, 10 ** 40, '\u00b2', '0.' + '0' * 28 + '1'):
+        with pytest.raises(PricingError):
+            plan.evaluate({'q': quantity})
+    assert time.perf_counter() - started < 1
+    results = plan.evaluate_many([{'q': '1e200000'}, {'q': '\u00b2'}, {'q': '1.5000000000000000000000000000000'}])
+    assert [price for price, _ in results] == [None, None, Decimal('3.00')]
+    assert results[0][1] == "Quantity for parameter 'q' is out of range"
+    assert plan.evaluate({'q': '1e27'}) == Decimal('2' + '0' * 27 + '.00')
+
+def test_admission_control(client, monkeypatch):
+    import time
+    import admission
+    test_create_parameter(client)
+    quote, read = admission.budgets['quote'], admission.budgets['read']
+    data = json.dumps({'service_id': 1, 'parameters': {'test_param': '2'}})
+    post = lambda **kw: client.post('/calculate-price', data=data, content_type='application/json', **kw)
+    assert post().status_code == 200
+    assert quote.in_flight == 0 and quote.service_time is not None
+
+    # Quote routes at their concurrency limit do not starve catalog reads
+    monkeypatch.setattr(quote, 'max_concurrency', 1)
+    monkeypatch.setattr(quote, 'in_flight', 1)
+    response = post()
+    assert response.status_code == 503 and response.headers['Retry-After'] == '1'
+    assert client.get('/services').status_code == 200
+    monkeypatch.setattr(quote, 'in_flight', 0)
+
+    # Requests that already queued longer than the budget are shed, one probe per Retry-After aside
+    queued = {'X-Request-Start': f't={time.time() - 5:.3f}'}
+    monkeypatch.setattr(quote, 'last_admitted', time.monotonic())
+    assert post(headers=queued).status_code == 503
+    monkeypatch.setattr(quote, 'last_admitted', 0.0)
+    assert post(headers=queued).status_code == 200
+    assert admission.queue_time('t=1700000000000000', now=1700000002.5) == 2.5
+
+    monkeypatch.setattr(read, 'rate_limit', '2 per minute')
+    limiter = admission.limiter
+    limiter.reset()
+    assert [client.get('/services').status_code for _ in range(3)] == [200, 200, 429]
+    response = client.get('/services')
+    assert 'Rate limit exceeded' in json.loads(response.data)['error'] and 'Retry-After' in response.headers
+    assert post().status_code == 200  # separate budget
+    limiter.reset()
+
+    text = client.get('/metrics').data.decode()
+    assert 'pricing_admission_shed_total{budget="quote",reason="concurrency"}' in text
+    assert 'pricing_admission_rate_limited_total{budget="read"}' in text
+    assert json.loads(client.get('/stats').data)['admission']['budgets']['read']['rate_limit'] == '2 per minute'
+
+def test_catalog_reads_etag_and_gzip(client, monkeypatch):
+    import gzip
+    import read_cache
+    test_create_parameter(client)
+    first = client.get('/services')
+    etag = first.headers['ETag']
+    assert first.status_code == 200 and json.loads(first.data)[0]['name'] == 'Test Service'
+
+    # A matching If-None-Match is answered from the cached body's ETag, no query and no encoding
+    response = client.get('/services', headers={'If-None-Match': etag})
+    assert response.status_code == 304 and response.data == b''
+    assert 'desc="0 queries"' in response.headers['Server-Timing']
+
+    # Catalog writes change the version, and so the body and its ETag
+    client.post('/services', data=json.dumps({'name': 'Other', 'base_price': 5}), content_type='application/json')
+    response = client.get('/services', headers={'If-None-Match': etag})
+    assert response.status_code == 200 and response.headers['ETag'] != etag
+    assert len(json.loads(response.data)) == 2
+
+    monkeypatch.setattr(read_cache, 'GZIP_MIN_SIZE', 0)
+    response = client.get('/parameters?service_id=1', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip' and 'Accept-Encoding' in response.headers['Vary']
+    assert json.loads(gzip.decompress(response.data))[0]['name'] == 'test_param'
+    assert client.get('/parameters?service_id=1', headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+    streamed = client.get('/parameters', headers={'Accept-Encoding': 'gzip'})
+    assert json.loads(gzip.decompress(streamed.data))[0]['name'] == 'test_param'
+
+    matrix = client.get('/services/1/price-matrix?limit=10')
+    again = client.get('/services/1/price-matrix?limit=10', headers={'If-None-Match': matrix.headers['ETag']})
+    assert again.status_code == 304 and again.headers['X-Total-Count'] == matrix.headers['X-Total-Count']
+
+    assert read_cache.dumps({'b': Decimal('1.50'), 'a': [1.5]}) == b'{"a":[1.5],"b":"1.50"}'
+    monkeypatch.setattr(read_cache, 'FAST_JSON', False)
+    assert read_cache.dumps({'b': Decimal('1.50'), 'a': [1.5]}) == b'{"a":[1.5],"b":"1.50"}'
+
+def test_router_reads_from_replica(client, monkeypatch, tmp_path):
+    from peewee import SqliteDatabase
+    from models import MODELS, router
+    replica = SqliteDatabase(str(tmp_path / 'replica.db'))
+    with replica.bind_ctx(MODELS):
+        replica.create_tables(MODELS)
+        Service.create(name='Replica Service', base_price=10)
+        PriceCalculation.create(service=1, input_params='{}', calculated_price=10, base_price=10)
+    monkeypatch.setattr(router, 'replicas', [replica])
+    monkeypatch.setattr(router, '_lags', {})
+    test_create_service(client)  # written to the primary
+
+    # Within the lag window after a write this worker keeps reading the primary
+    assert [s['name'] for s in json.loads(client.get('/services').data)] == ['Test Service']
+    monkeypatch.setattr(router, '_primary_until', 0.0)
+    assert [s['name'] for s in json.loads(client.get('/services').data)] == ['Replica Service']
+    consistent = client.get('/services', headers={'X-Consistent-Read': '1'})
+    assert [s['name'] for s in json.loads(consistent.data)] == ['Test Service']
+    export = client.get('/calculations/export').data.decode().splitlines()
+    assert len(export) == 1 and json.loads(export[0])['calculated_price'] == '10.00'
+
+    # Pricing still uses the catalog as written on the primary
+    catalog.refresh_service(1)
+    assert catalog.get(1).name == 'Test Service'
+
+    # A replica lagging too far behind is skipped
+    monkeypatch.setattr(router, '_lags', {})
+    monkeypatch.setattr(router, 'lag_probe', lambda db: 60.0)
+    fallbacks = router.fallbacks
+    assert client.get('/calculations/export').data == b''
+    assert router.fallbacks == fallbacks + 1 and router.stats()['lag'] == [60.0]
+    assert replica.is_closed()
+
+def test_migrations_add_unique_indexes(client):
+    import migrations
+    from migrations import MigrationError, migrate_down, migrate_up
+    log = []
+    # Tables created from the current models already have the indexes
+    assert migrate_up(log=log.append) == [1, 2, 3, 4, 5]
+    assert [line for line in log if 'adding' in line] == []
+
+    # Back to the schema of older deployments, which let duplicates in
+    assert migrate_down(0, log=log.append) == [5, 4, 3, 2, 1]
+    assert migrations.find_index('parameter_options', ('parameter_id', 'value')) is None
+    test_create_parameter(client)
+    ParameterOption.create(parameter=1, value='2', modifier=9)  # ignored by the catalog, lowest id wins
+    Parameter.create(service=1, name='test_param', parameter_type='fixed')
+    with pytest.raises(MigrationError, match="service 1 'test_param' \\(2x\\)"):
+        migrate_up(log=log.append)
+    assert [version for version, _, applied in migrations.status() if applied] == [1]
+
+    Parameter.delete().where(Parameter.id == 2).execute()
+    assert migrate_up(log=log.append) == [2, 3, 4, 5]
+    assert [o.modifier for o in ParameterOption.select().where(ParameterOption.value == '2')] == [Decimal('1.5')]
+    assert migrations.find_index('parameters', ('service_id', 'name'), unique=True) is not None
+    assert '  adding price_calculations.uid' in log
+    response = client.post('/calculate-price', data=json.dumps({'service_id': 1, 'parameters': {'test_param': '2'}}),
+                           content_type='application/json')
+    assert response.status_code == 200
+    assert response.get_json()['calculation_uid'] == PriceCalculation.get().uid
+
+    data = {'service_id': 1, 'name': 'test_param', 'parameter_type': 'fixed', 'options': []}
+    response = client.post('/parameters', data=json.dumps(data), content_type='application/json')
+    assert response.status_code == 409
+
+    # Migrating the original schema gives every table its model's columns
+    for model in MODELS:
+        columns = {column.name for column in database.get_columns(model._meta.table_name)}
+        assert columns == {field.column_name for field in model._meta.sorted_fields}
+
+def test_calculate_price_what_if(client):
+    test_create_parameter(client)  # base price 100, test_param: '1' -> 1.0, '2' -> 1.5 (multiplier, required)
+    for name, parameter_type, options in (
+            ('level', 'multiplier', [{'value': 'basic', 'modifier': 1}, {'value': 'gold', 'modifier': 2},
+                                     {'value': 'free', 'modifier': 0}]),
+            ('rush', 'fixed', [{'value': 'yes', 'modifier': 10}, {'value': 'refund', 'modifier': -500}]),
+            ('units', 'quantity', [])):
+        client.post('/parameters', data=json.dumps({
+            'service_id': 1, 'name': name, 'parameter_type': parameter_type, 'options': options}),
+            content_type='application/json')
+
+    params = {'test_param': '2', 'level': 'free', 'rush': 'yes', 'units': 3}
+    response = client.post('/calculate-price/what-if', data=json.dumps({'service_id': 1, 'parameters': params}),
+                           content_type='application/json')
+    assert response.status_code == 200
+    data = json.loads(response.data)
+    assert data['calculated_price'] == 30.0
+    alternatives = {a['parameter']: a for a in data['alternatives']}
+    assert list(alternatives) == ['test_param', 'level', 'rush']
+    assert alternatives['level']['value'] == 'free'
+    # The zero multiplier is left out of the other alternatives without dividing by it
+    assert alternatives['level']['options'] == [
+        {'value': 'basic', 'price': 480.0, 'difference': 450.0},
+        {'value': 'gold', 'price': 930.0, 'difference': 900.0}]
+    for alternative in data['alternatives']:
+        for option in alternative['options']:
+            switched = dict(params, **{alternative['parameter']: option['value']})
+            assert Decimal(str(option['price'])) == catalog.get(1).plan.evaluate(switched)
+    assert PriceCalculation.select().count() == 0
+
+    missing = client.post('/calculate-price/what-if', data=json.dumps({'service_id': 1, 'parameters': {}}),
+                          content_type='application/json')
+    assert missing.status_code == 400
+    assert json.loads(missing.data)['missing_parameters'] == ['test_param']
+    invalid = client.post('/calculate-price/what-if',
+                          data=json.dumps({'service_id': 1, 'parameters': {'test_param': '9'}}),
+                          content_type='application/json')
+    assert invalid.status_code == 400
+
+def test_structured_quote_logging(client, monkeypatch):
+    import io
+    import logs
+    test_create_parameter(client)
+    stream = io.StringIO()
+    logs.configure(level='DEBUG', stream=stream)
+    monkeypatch.setattr(logs, 'TRACE_SAMPLE_RATE', 0.0)
+    monkeypatch.setattr(logs, 'TRACE_SAMPLE_RATES', logs.parse_rates('1=1'))
+    try:
+        assert not logs.trace_enabled(2)
+        response = client.post('/calculate-price-details', headers={'X-Request-Id': 'req-42'},
+                               data=json.dumps({'service_id': 1, 'parameters': {'test_param': '2'}}),
+                               content_type='application/json')
+        assert response.headers['X-Request-Id'] == 'req-42'
+        logs.pipeline.stop()  # the listener writes everything queued
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+    finally:
+        logs.configure(level='INFO', fmt='json')
+    trace = next(r for r in records if r['logger'] == 'pricing.quotes')
+    assert trace['level'] == 'DEBUG' and trace['message'] == 'quote breakdown'
+    assert trace['request_id'] == 'req-42'
+    assert trace['service_id'] == 1 and Decimal(trace['price']) == 150
+    assert trace['breakdown'][0]['parameter'] == 'test_param'
+    assert 'catalog' in trace['timings']
+    # Without an incoming id one is generated
+    assert client.get('/services').headers['X-Request-Id']
+
+def test_requote_history(client, tmp_path):
+    import requote
+    test_create_parameter(client)  # base price 100, test_param: '1' -> 1.0, '2' -> 1.5
+    for value in ('1', '2', '2', '1', '2'):
+        client.post('/calculate-price', data=json.dumps({'service_id': 1, 'parameters': {'test_param': value}}),
+                    content_type='application/json')
+    PriceCalculation.create(service=1, input_params=json.dumps({'service_id': 1, 'parameters': {'test_param': '9'}}),
+                            calculated_price=100, base_price=100)
+    ParameterOption.update(modifier=2).where(ParameterOption.value == '2').execute()
+
+    output = str(tmp_path)
+    partial = requote.run(output, workers=2, chunk_size=2, max_chunks=2, log=lambda line: None)
+    assert partial['calculations'] == 4
+    with pytest.raises(requote.RequoteError):
+        requote.run(output, service_id=1, resume=True, log=lambda line: None)
+    summary = requote.run(output, workers=2, chunk_size=2, resume=True, log=lambda line: None)
+
+    assert summary['calculations'] == 6
+    total = summary['total']
+    assert (total['quotes'], total['unchanged'], total['changed'], total['errors']) == (6, 2, 3, 1)
+    assert (total['old_total'], total['new_total']) == ('650.00', '800.00')
+    assert total['distribution'] == {'<=50%': 3}
+    with open(tmp_path / 'diff.ndjson') as f:
+        lines = [json.loads(line) for line in f]
+    # Each changed or failed quote once, although the run was interrupted
+    assert sorted(line['id'] for line in lines) == [2, 3, 5, 6]
+    assert {line.get('new_price') for line in lines} == {'200.00', None}
+    assert requote.run(output, resume=True, log=lambda line: None) == summary
+
+def test_parameter_sets_deduplicate_history(client):
+    from history import iter_calculations
+    from migrations import find_index, migrate_down, migrate_up
+    test_create_parameter(client)
+    for value in ('1', '2', '2', '1', '2'):
+        client.post('/calculate-price', data=json.dumps({'service_id': 1, 'parameters': {'test_param': value}}),
+                    content_type='application/json')
+    client.post('/calculate-price/batch', data=json.dumps({'items': [
+        {'service_id': 1, 'parameters': {'test_param': '2'}}]}), content_type='application/json')
+    assert ParameterSet.select().count() == 2
+    assert PriceCalculation.select().where(PriceCalculation.input_params.is_null(False)).count() == 0
+    exported = [row['input_params'] for row in iter_calculations()]
+    assert exported[1] == {'service_id': 1, 'parameters': {'test_param': '2'}}
+
+    # Rows written before the migration store their parameters inline
+    quiet = lambda line: None
+    migrate_up(log=quiet)
+    migrate_down(3, log=quiet)
+    assert find_index('price_calculations', ('service_id', 'timestamp', 'id')) is not None
+    inline = PriceCalculation.select(PriceCalculation.input_params).order_by(PriceCalculation.id).tuples()
+    assert [json.loads(text) for (text,) in inline] == exported
+    PriceCalculation.create(service=1, input_params='{"service_id": "1", "parameters": {"test_param": "1"}}',
+                            calculated_price=100, base_price=100)
+    PriceCalculation.create(service=1, input_params='{"n": 1}', calculated_price=100, base_price=100)
+    parameter_sets.clear()
+    log = []
+    assert migrate_up(log=log.append) == [4, 5]
+    assert '  7 calculations moved to parameter sets, 1 kept inline' in log
+    assert ParameterSet.select().count() == 2
+    rows = [row['input_params'] for row in iter_calculations()]
+    assert rows[:6] == exported
+    assert rows[6:] == [{'service_id': 1, 'parameters': {'test_param': '1'}}, {'n': 1}]
+
+def test_rate_limit_storage_shared_or_per_worker(client, monkeypatch):
+    import runpy
+    from types import SimpleNamespace
+    import admission
+    import logs
+    get_storage = runpy.run_path('config_sample.py')['get_rate_limit_storage']
+    monkeypatch.delenv('RATELIMIT_STORAGE_URI', raising=False)
+    monkeypatch.delenv('REDIS_URL', raising=False)
+    assert get_storage() == 'memory://'
+    monkeypatch.setenv('REDIS_URL', 'redis://cache:6379/0')
+    assert get_storage() == 'redis://cache:6379/0'
+    monkeypatch.setenv('RATELIMIT_STORAGE_URI', 'memcached://cache:11211')
+    assert get_storage() == 'memcached://cache:11211'
+
+    assert client.get('/stats').get_json()['admission']['rate_limit_shared'] is False
+    monkeypatch.setattr(admission.budgets['quote'], 'rate_limit', '20 per second')
+    warnings = []
+    monkeypatch.setattr(logs.log, 'warning', lambda msg, *args: warnings.append(msg % args))
+    hooks = runpy.run_path('gunicorn.conf.py')
+    hooks['warn_per_worker_rate_limits'](SimpleNamespace(cfg=SimpleNamespace(workers=4)))
+    assert 'up to 4 times 20 per second' in warnings.pop()
+    hooks['warn_per_worker_rate_limits'](SimpleNamespace(cfg=SimpleNamespace(workers=1)))
+    monkeypatch.setattr(admission, 'RATE_LIMIT_SHARED', True)
+    hooks['warn_per_worker_rate_limits'](SimpleNamespace(cfg=SimpleNamespace(workers=4)))
+    assert warnings == []